@@ -0,0 +1,304 @@
+import os
+import time
+import random
+import socket
+import struct
+
+from .serializers import IPv4AddressTimestamp
+
+_record = struct.Struct("<4sHQI")
+_file_header = struct.Struct("<4sII")
+_file_record = struct.Struct("<B4sHQIf")
+
+class AddressManager(object):
+    """This class keeps the addresses of the peers received in
+    AddressVector messages. Each address is packed in a compact
+    record (ip, port, services and timestamp) and stored in one of
+    the buckets of the new table (addresses never connected) or of
+    the tried table (addresses connected with success), repeated
+    addresses are merged. The round-trip time of the peers can be
+    tracked with the Ping/Pong nonces and the selection of the peers
+    is biased towards the ones with lower latency.
+
+    Example of use::
+
+        manager = AddressManager()
+        manager.add_many(message.addresses, source="1.2.3.4")
+        address = manager.select(fields.SERVICES["NODE_NETWORK"])
+
+    :param new_buckets: The number of buckets of the new table.
+    :param tried_buckets: The number of buckets of the tried table.
+    :param bucket_size: The maximum number of addresses in a bucket.
+    :param secret: The random value used to place the addresses in
+                   the buckets, a new one is used when omitted.
+    """
+    #: The magic string at the start of the saved files
+    file_magic = "PADR"
+    file_version = 1
+
+    #: The RTT (in seconds) assumed for peers never pinged
+    default_rtt = 0.5
+
+    #: The weight of the last measure in the RTT average
+    rtt_smoothing = 0.3
+
+    #: The time (in seconds) after which a ping is forgotten
+    ping_timeout = 120.0
+
+    def __init__(self, new_buckets=256, tried_buckets=64, bucket_size=64,
+                 secret=None):
+        self.secret = secret if secret is not None else \
+            random.getrandbits(64)
+        self.new = [{} for i in xrange(new_buckets)]
+        self.tried = [{} for i in xrange(tried_buckets)]
+        # The buckets of both tables, the location of each address
+        # is the index of its bucket in this list
+        self.buckets = self.new + self.tried
+        self.bucket_size = bucket_size
+        self.location = {}
+        self.rtt = {}
+        self.pings = {}
+
+    def __len__(self):
+        return len(self.location)
+
+    def __contains__(self, address):
+        return self.make_key(*address) in self.location
+
+    @staticmethod
+    def make_key(ip_address, port):
+        """Returns the compact key (6 bytes) of an address.
+
+        :param ip_address: The IPv4 address as a string
+        :param port: The port number
+        """
+        return socket.inet_aton(ip_address) + struct.pack("<H", port)
+
+    def new_bucket(self, key, source_key):
+        """Returns the index of the new table bucket of an address,
+        the addresses of the same /16 network announced by the same
+        /16 source network share a small set of buckets."""
+        group = key[:2]
+        source_group = source_key[:2]
+        spread = hash((self.secret, group, source_group)) % 16
+        return hash((self.secret, source_group, spread)) % len(self.new)
+
+    def tried_bucket(self, key):
+        """Returns the index of the tried table bucket of an address."""
+        spread = hash((self.secret, key)) % 8
+        return hash((self.secret, key[:2], spread)) % len(self.tried)
+
+    def add(self, address, source=None):
+        """Add an address (IPv4Address or IPv4AddressTimestamp), an
+        address already present is updated with the newer timestamp
+        and the services.
+
+        :param address: The address to add
+        :param source: The IP address of the peer that announced it
+        :returns: True if the address was not present
+        """
+        key = self.make_key(address.ip_address, address.port)
+        timestamp = int(getattr(address, "timestamp", time.time()))
+        location = self.location.get(key)
+        if location is not None:
+            bucket = self.buckets[location]
+            ip, port, services, old_timestamp = _record.unpack(bucket[key])
+            bucket[key] = _record.pack(ip, port, services | address.services,
+                max(timestamp, old_timestamp))
+            return False
+
+        source_key = self.make_key(source, 0) if source else key
+        self.insert_new(key, _record.pack(key[:4], address.port,
+            address.services, timestamp), source_key)
+        return True
+
+    def insert_new(self, key, record, source_key):
+        """Insert a packed record in the new table."""
+        index = self.new_bucket(key, source_key)
+        bucket = self.new[index]
+        if len(bucket) >= self.bucket_size:
+            self.evict(bucket)
+        bucket[key] = record
+        self.location[key] = index
+
+    def add_many(self, addresses, source=None):
+        """Add many addresses, from an AddressVector for instance.
+
+        :param addresses: An iterable with the addresses
+        :param source: The IP address of the peer that announced them
+        :returns: The number of new addresses
+        """
+        added = 0
+        for address in addresses:
+            if self.add(address, source):
+                added += 1
+        return added
+
+    def evict(self, bucket):
+        """Remove the address with the oldest timestamp of a bucket."""
+        oldest = min(bucket, key=lambda key: _record.unpack(bucket[key])[3])
+        del bucket[oldest]
+        del self.location[oldest]
+        self.rtt.pop(oldest, None)
+
+    def mark_good(self, ip_address, port):
+        """Move an address to the tried table, this method should be
+        called after a successful connection (handshake) to the peer.
+
+        :param ip_address: The IPv4 address as a string
+        :param port: The port number
+        """
+        key = self.make_key(ip_address, port)
+        location = self.location.get(key)
+        if location is None or self.is_tried(location):
+            return
+        record = self.buckets[location].pop(key)
+        index = self.tried_bucket(key)
+        bucket = self.tried[index]
+        if len(bucket) >= self.bucket_size:
+            # Move the oldest tried address back to the new table
+            oldest = min(bucket,
+                key=lambda old_key: _record.unpack(bucket[old_key])[3])
+            self.insert_new(oldest, bucket.pop(oldest), oldest)
+        bucket[key] = record
+        self.location[key] = len(self.new) + index
+
+    def is_tried(self, location):
+        """Returns True if the bucket location is in the tried table."""
+        return location >= len(self.new)
+
+    def remove(self, ip_address, port):
+        """Remove an address.
+
+        :param ip_address: The IPv4 address as a string
+        :param port: The port number
+        """
+        key = self.make_key(ip_address, port)
+        location = self.location.pop(key, None)
+        if location is not None:
+            del self.buckets[location][key]
+            self.rtt.pop(key, None)
+
+    def ping_sent(self, ip_address, port, nonce):
+        """Register a Ping sent to a peer.
+
+        :param ip_address: The IPv4 address of the peer
+        :param port: The port of the peer
+        :param nonce: The nonce of the Ping message
+        """
+        now = time.time()
+        self.pings[nonce] = (self.make_key(ip_address, port), now)
+        if len(self.pings) > 4 * len(self.location) + 64:
+            for old_nonce, (key, sent) in self.pings.items():
+                if now - sent > self.ping_timeout:
+                    del self.pings[old_nonce]
+
+    def pong_received(self, nonce):
+        """Register a Pong received and update the RTT of the peer.
+
+        :param nonce: The nonce of the Pong message
+        :returns: The RTT measured, or None for unknown nonces
+        """
+        ping = self.pings.pop(nonce, None)
+        if ping is None:
+            return None
+        key, sent = ping
+        rtt = time.time() - sent
+        if key in self.location:
+            old_rtt = self.rtt.get(key)
+            if old_rtt is None:
+                self.rtt[key] = rtt
+            else:
+                self.rtt[key] = old_rtt + self.rtt_smoothing * (rtt - old_rtt)
+        return rtt
+
+    def get_rtt(self, ip_address, port):
+        """Returns the average RTT of a peer, or None if unknown."""
+        return self.rtt.get(self.make_key(ip_address, port))
+
+    def select(self, services=0, tried_ratio=0.5, max_tries=1000):
+        """Select a random address offering all the services required,
+        the peers with lower RTT have more chance to be selected.
+
+        :param services: The SERVICES bits required
+        :param tried_ratio: The chance of selecting from the tried table
+        :param max_tries: The number of random picks before giving up
+        :returns: An IPv4AddressTimestamp, or None
+        """
+        new = [bucket for bucket in self.new if bucket]
+        tried = [bucket for bucket in self.tried if bucket]
+        if not new and not tried:
+            return None
+        if self.rtt:
+            best_rtt = min(min(self.rtt.itervalues()), self.default_rtt)
+        else:
+            best_rtt = self.default_rtt
+
+        for i in xrange(max_tries):
+            use_tried = tried and (not new or random.random() < tried_ratio)
+            bucket = random.choice(tried if use_tried else new)
+            key = random.choice(bucket.keys())
+            ip, port, key_services, timestamp = _record.unpack(bucket[key])
+            if key_services & services != services:
+                continue
+            rtt = self.rtt.get(key, self.default_rtt)
+            if random.random() * rtt <= best_rtt:
+                return self.make_address(bucket[key])
+        return None
+
+    @staticmethod
+    def make_address(record):
+        """Create an IPv4AddressTimestamp from a packed record."""
+        ip, port, services, timestamp = _record.unpack(record)
+        address = IPv4AddressTimestamp()
+        address.ip_address = socket.inet_ntoa(ip)
+        address.port = port
+        address.services = services
+        address.timestamp = timestamp
+        return address
+
+    def save(self, filename):
+        """Save the addresses, their table and RTT to a file.
+
+        :param filename: The name of the file
+        """
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as fhandle:
+            fhandle.write(_file_header.pack(self.file_magic,
+                self.file_version, len(self.location)))
+            for key, location in self.location.iteritems():
+                record = self.buckets[location][key]
+                ip, port, services, timestamp = _record.unpack(record)
+                is_tried = self.is_tried(location)
+                fhandle.write(_file_record.pack(int(is_tried), ip, port,
+                    services, timestamp, self.rtt.get(key, 0.0)))
+        os.rename(temp_filename, filename)
+
+    @classmethod
+    def load(klass, filename, **kwargs):
+        """Create a new AddressManager with the addresses saved in
+        a file.
+
+        :param filename: The name of the file
+        :param kwargs: The parameters of the constructor
+        """
+        manager = klass(**kwargs)
+        with open(filename, "rb") as fhandle:
+            data = fhandle.read()
+        magic, version, count = _file_header.unpack_from(data, 0)
+        if magic != klass.file_magic or version != klass.file_version:
+            raise ValueError("Invalid address file %s" % filename)
+
+        offset = _file_header.size
+        for i in xrange(count):
+            is_tried, ip, port, services, timestamp, rtt = \
+                _file_record.unpack_from(data, offset)
+            offset += _file_record.size
+            key = ip + struct.pack("<H", port)
+            manager.insert_new(key,
+                _record.pack(ip, port, services, timestamp), key)
+            if rtt > 0:
+                manager.rtt[key] = rtt
+            if is_tried:
+                manager.mark_good(socket.inet_ntoa(ip), port)
+        return manager
@@ -0,0 +1,307 @@
+"""An append-only archive of raw block payloads. The payloads are
+appended to segment files and an index file keeps the position of
+each block, so blocks can be read back by hash or height (from
+memory-mapped segments) without downloading them again.
+"""
+import os
+import mmap
+import struct
+import hashlib
+import threading
+
+from . import fields
+from .serializers import MESSAGE_SERIALIZERS
+
+#: The record of the index file: block hash, segment number, offset,
+#: length and height (-1 when unknown)
+_index_record = struct.Struct("<32sIQIi")
+
+class ArchiveEntry(object):
+    """The position of a block in the archive."""
+    __slots__ = ("block_hash", "segment", "offset", "length", "height")
+
+    def __init__(self, block_hash, segment, offset, length, height):
+        self.block_hash = block_hash
+        self.segment = segment
+        self.offset = offset
+        self.length = length
+        self.height = height
+
+    def __repr__(self):
+        return "<%s Hash=[%s] Segment=[%d] Offset=[%d] Length=[%d] Height=[%s]>" % \
+            (self.__class__.__name__, self.block_hash.to_hex(), self.segment,
+                self.offset, self.length, self.height)
+
+class BlockArchive(object):
+    """This class stores the raw payloads of the block messages. The
+    payloads are appended to segment files of up to segment_size bytes
+    and their positions are appended to an index file, loaded when the
+    archive is opened. The writes are flushed to the disk (fsync) every
+    sync_interval blocks or when sync() is called, after a crash the
+    archive is truncated to the last block indexed.
+
+    The blocks are read from memory-mapped segments, as raw strings
+    (get_payload()), as a buffer and offset to parse without copies
+    (get_buffer()) or deserialized (get_block(), iter_blocks()).
+
+    Example of use::
+
+        archive = BlockArchive("/data/blocks")
+
+        class ArchiveClient(BitcoinClient):
+            def handle_raw_block(self, message_header, payload):
+                archive.append(payload)
+
+        for block in archive.iter_blocks(fields=["timestamp"]):
+            print block.timestamp
+
+    :param directory: The directory of the archive, it is created when
+                      needed.
+    :param segment_size: The maximum size (in bytes) of a segment file.
+    :param sync_interval: The number of blocks appended between the
+                          fsync calls, 0 to sync only on sync() and
+                          close().
+    """
+    segment_format = "blocks%05d.dat"
+    index_filename = "index.dat"
+
+    def __init__(self, directory, segment_size=128 * 1024 * 1024,
+                 sync_interval=100):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+        self.lock = threading.RLock()
+        self.entries = {}
+        self.heights = {}
+        self.order = []
+        self.maps = {}
+        self.unsynced = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.load_index()
+
+        segment, end = 0, 0
+        if self.order:
+            last = self.entries[self.order[-1]]
+            segment, end = last.segment, last.offset + last.length
+        self.open_segment(segment, end)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, block_hash):
+        return fields.hash_to_bytes(block_hash) in self.entries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def segment_path(self, segment):
+        """Returns the path of a segment file."""
+        return os.path.join(self.directory, self.segment_format % segment)
+
+    def load_index(self):
+        """Load the index file, a partially written record at the end
+        of the file is discarded, as the records pointing past the end
+        of their segment file (the index reached the disk before the
+        data) and all the records after them."""
+        path = os.path.join(self.directory, self.index_filename)
+        if os.path.exists(path):
+            with open(path, "rb") as fhandle:
+                data = fhandle.read()
+        else:
+            data = ""
+        segment_sizes = {}
+        count = 0
+        for i in xrange(len(data) // _index_record.size):
+            record = _index_record.unpack_from(data, i * _index_record.size)
+            block_hash, segment, offset, length, height = record
+            if segment not in segment_sizes:
+                segment_path = self.segment_path(segment)
+                segment_sizes[segment] = os.path.getsize(segment_path) \
+                    if os.path.exists(segment_path) else 0
+            if offset + length > segment_sizes[segment]:
+                break
+            self.add_entry(*record)
+            count += 1
+
+        self.index_file = open(path, "a+b")
+        self.index_file.truncate(count * _index_record.size)
+
+    def add_entry(self, block_hash, segment, offset, length, height):
+        """Add a block to the in-memory index."""
+        block_hash = fields.HashValue(block_hash)
+        height = height if height >= 0 else None
+        self.entries[block_hash] = ArchiveEntry(block_hash, segment,
+            offset, length, height)
+        self.order.append(block_hash)
+        if height is not None:
+            self.heights[height] = block_hash
+
+    def open_segment(self, segment, offset):
+        """Open a segment file for appending at the specified offset,
+        the data after it is truncated (load_index() checked that the
+        file isn't shorter)."""
+        self.segment = segment
+        self.segment_file = open(self.segment_path(segment), "a+b")
+        self.segment_file.truncate(offset)
+        self.segment_offset = offset
+
+    def append(self, payload, height=None, block_hash=None):
+        """Append the payload of a block message to the archive, the
+        blocks already present are ignored.
+
+        :param payload: The payload of the block message
+        :param height: The height of the block, if known
+        :param block_hash: The hash of the block, computed from the
+                           payload when omitted.
+        :returns: True if the block was appended
+        """
+        if block_hash is None:
+            h = hashlib.sha256(payload[:80]).digest()
+            block_hash = hashlib.sha256(h).digest()
+        block_hash = fields.HashValue(fields.hash_to_bytes(block_hash))
+        length = len(payload)
+
+        with self.lock:
+            if block_hash in self.entries:
+                return False
+            if self.segment_offset and \
+                    self.segment_offset + length > self.segment_size:
+                self.sync()
+                self.segment_file.close()
+                self.open_segment(self.segment + 1, 0)
+
+            offset = self.segment_offset
+            self.segment_file.write(payload)
+            self.segment_offset += length
+            height = -1 if height is None else height
+            self.index_file.write(_index_record.pack(block_hash,
+                self.segment, offset, length, height))
+            self.add_entry(block_hash, self.segment, offset, length, height)
+
+            self.unsynced += 1
+            if self.sync_interval and self.unsynced >= self.sync_interval:
+                self.sync()
+        return True
+
+    def sync(self):
+        """Flush the segment and index files to the disk, the segment
+        is synced first so the index never points to missing data."""
+        with self.lock:
+            self.segment_file.flush()
+            os.fsync(self.segment_file.fileno())
+            self.index_file.flush()
+            os.fsync(self.index_file.fileno())
+            self.unsynced = 0
+
+    def close(self):
+        """Sync and close the archive files."""
+        with self.lock:
+            self.sync()
+            self.segment_file.close()
+            self.index_file.close()
+            for segment_map in self.maps.itervalues():
+                segment_map.close()
+            self.maps.clear()
+
+    def get_entry(self, block_hash=None, height=None):
+        """Returns the ArchiveEntry of a block, by hash or height.
+
+        :param block_hash: The hash of the block
+        :param height: The height of the block
+        :raises KeyError: When the block isn't in the archive
+        """
+        if block_hash is None:
+            block_hash = self.heights[height]
+        return self.entries[fields.hash_to_bytes(block_hash)]
+
+    def get_map(self, entry):
+        """Returns the memory map of the segment of an entry, the
+        segment being written is mapped again when it grows. The
+        previous map isn't closed, as the buffers already returned
+        may still be read by other threads, it is released when the
+        last of them is dropped."""
+        with self.lock:
+            end = entry.offset + entry.length
+            segment_map = self.maps.get(entry.segment)
+            if segment_map is None or len(segment_map) < end:
+                if entry.segment == self.segment:
+                    self.segment_file.flush()
+                with open(self.segment_path(entry.segment), "rb") as fhandle:
+                    segment_map = mmap.mmap(fhandle.fileno(), 0,
+                        access=mmap.ACCESS_READ)
+                self.maps[entry.segment] = segment_map
+            return segment_map
+
+    def get_buffer(self, block_hash=None, height=None):
+        """Returns the payload of a block without copying it, as a
+        tuple of (buffer, offset, length), where the buffer is the
+        memory map of the segment.
+
+        :param block_hash: The hash of the block
+        :param height: The height of the block
+        """
+        entry = self.get_entry(block_hash, height)
+        return self.get_map(entry), entry.offset, entry.length
+
+    def get_payload(self, block_hash=None, height=None):
+        """Returns the payload of a block as a string.
+
+        :param block_hash: The hash of the block
+        :param height: The height of the block
+        """
+        buffer, offset, length = self.get_buffer(block_hash, height)
+        return buffer[offset:offset + length]
+
+    def get_block(self, block_hash=None, height=None, fields=None):
+        """Returns the Block deserialized from the archive.
+
+        :param block_hash: The hash of the block
+        :param height: The height of the block
+        :param fields: The fields to deserialize, see
+                       Serializer.projection()
+        """
+        buffer, offset, length = self.get_buffer(block_hash, height)
+        return MESSAGE_SERIALIZERS["block"].deserialize_from(buffer,
+            offset, fields)[0]
+
+    def iter_entries(self, by_height=False):
+        """Iterate the ArchiveEntry of the blocks in the order they
+        were appended (the order of the data on disk), or by height,
+        skipping the blocks with unknown height.
+
+        :param by_height: When True, iterate in the height order
+        """
+        if by_height:
+            for height in sorted(self.heights):
+                yield self.entries[self.heights[height]]
+        else:
+            for block_hash in list(self.order):
+                yield self.entries[block_hash]
+
+    def iter_payloads(self, by_height=False):
+        """Iterate the (ArchiveEntry, buffer, offset) of the blocks, the
+        buffer is the memory map of the segment of the block, see
+        iter_entries().
+
+        :param by_height: When True, iterate in the height order
+        """
+        for entry in self.iter_entries(by_height):
+            yield entry, self.get_map(entry), entry.offset
+
+    def iter_blocks(self, by_height=False, fields=None):
+        """Iterate the blocks deserialized, see iter_entries().
+
+        :param by_height: When True, iterate in the height order
+        :param fields: The fields to deserialize, see
+                       Serializer.projection()
+        """
+        serializer = MESSAGE_SERIALIZERS["block"]
+        if fields is not None:
+            fields = serializer.projection(fields)
+        for entry, buffer, offset in self.iter_payloads(by_height):
+            yield serializer.deserialize_from(buffer, offset, fields)[0]
@@ -0,0 +1,302 @@
+"""Reader for the blk*.dat files written by Bitcoin Core. Each record
+of these files is the network magic, the size of the block (4 bytes)
+and the raw block. The files are memory-mapped and the records are
+parsed in place, optionally across a pool of processes.
+
+The transactions serialized with witness data (segwit, BIP 144) are
+deserialized without their witnesses, the Tx model only has the fields
+hashed by the txid. Note that the files written with block obfuscation
+(the xor.dat key of recent Bitcoin Core versions) are not supported.
+"""
+import os
+import glob
+import mmap
+import struct
+import multiprocessing
+
+from . import fields
+from .fields import unpack_varint_from, read_bytes_from
+from .serializers import TxSerializer, BlockSerializer
+
+_record_header = struct.Struct("<4sI")
+
+#: The size of the block header before the transaction count
+_BLOCK_HEADER_SIZE = 80
+
+def block_files(directory):
+    """Returns the paths of the blk*.dat files of a directory, in
+    the order they were written.
+
+    :param directory: The blocks directory of Bitcoin Core
+    """
+    return sorted(glob.glob(os.path.join(directory, "blk[0-9]*.dat")))
+
+def map_file(filename):
+    """Returns a read-only memory map of a file, or None for empty
+    files."""
+    with open(filename, "rb") as fhandle:
+        if not os.fstat(fhandle.fileno()).st_size:
+            return None
+        return mmap.mmap(fhandle.fileno(), 0, access=mmap.ACCESS_READ)
+
+def iter_records(buffer, coin="bitcoin"):
+    """Iterate the block records of the contents of a blk*.dat file,
+    the zero padding preallocated at the end of the files and any
+    damaged data are skipped by scanning for the next magic.
+
+    :param buffer: The contents of the file (str, mmap)
+    :param coin: The coin of the network magic
+    :returns: An iterator of (offset, length), the offset of the
+              raw block in the buffer and its length
+    """
+    magic = struct.pack("<I", fields.MAGIC_VALUES[coin])
+    size = len(buffer)
+    offset = 0
+    while offset + _record_header.size <= size:
+        record_magic, length = _record_header.unpack_from(buffer, offset)
+        if record_magic != magic:
+            offset = buffer.find(magic, offset + 1)
+            if offset < 0:
+                return
+            continue
+        start = offset + _record_header.size
+        if start + length > size:
+            return
+        yield start, length
+        offset = start + length
+
+def is_segwit_block(buffer, offset):
+    """Returns True if the raw block is serialized with witness data,
+    the version of its first transaction (the coinbase, which has a
+    witness in all the segwit blocks) being followed by the 0x00 marker
+    and the 0x01 flag instead of the input count.
+
+    :param buffer: The buffer of the raw block (str, mmap)
+    :param offset: The offset of the raw block in the buffer
+    """
+    tx_count, offset = unpack_varint_from(buffer,
+        offset + _BLOCK_HEADER_SIZE)
+    return tx_count > 0 and buffer[offset + 4:offset + 6] == "\x00\x01"
+
+def skip_witnesses(buffer, offset, input_count):
+    """Returns the offset where the witnesses of the inputs of a
+    transaction end, each witness being a list of stack items.
+
+    :param buffer: The buffer of the transaction (str, mmap)
+    :param offset: The offset of the first witness
+    :param input_count: The number of inputs of the transaction
+    """
+    for i in xrange(input_count):
+        item_count, offset = unpack_varint_from(buffer, offset)
+        for j in xrange(item_count):
+            item_size, offset = unpack_varint_from(buffer, offset)
+            offset += item_size
+    return offset
+
+class WitnessTxSerializer(TxSerializer):
+    """The serializer of the transactions of the blk*.dat files, they
+    can be serialized with witness data (BIP 144): the version is then
+    followed by the 0x00 marker and the 0x01 flag, and the witnesses
+    of the inputs are placed before the lock_time. The witnesses are
+    skipped and the transaction is deserialized from a copy of its
+    serialization without witness."""
+    def witness_span(self, buffer, offset):
+        """Returns the offsets where the inputs and outputs of a
+        transaction with witness data end and where its witnesses end,
+        or None for the transactions without witness data."""
+        if buffer[offset + 4:offset + 6] != "\x00\x01":
+            return None
+        input_count, unused = unpack_varint_from(buffer, offset + 6)
+        outputs_end = self.skip_outputs(buffer, offset + 6)
+        return outputs_end, skip_witnesses(buffer, outputs_end, input_count)
+
+    def skip_outputs(self, buffer, offset):
+        """Returns the offset where the outputs following the inputs
+        at the offset end."""
+        offset = self._fields["tx_in"].skip_from(buffer, offset)
+        return self._fields["tx_out"].skip_from(buffer, offset)
+
+    def deserialize_from(self, buffer, offset=0, fields=None):
+        span = self.witness_span(buffer, offset)
+        if span is None:
+            return TxSerializer.deserialize_from(self, buffer, offset, fields)
+        outputs_end, witnesses_end = span
+        data = read_bytes_from(buffer, offset, 4) + \
+            read_bytes_from(buffer, offset + 6, outputs_end - offset - 6) + \
+            read_bytes_from(buffer, witnesses_end, 4)
+        tx = TxSerializer.deserialize_from(self, data, 0, fields)[0]
+        return tx, witnesses_end + 4
+
+    def skip_from(self, buffer, offset=0):
+        span = self.witness_span(buffer, offset)
+        if span is None:
+            return TxSerializer.skip_from(self, buffer, offset)
+        return span[1] + 4
+
+class WitnessBlockSerializer(BlockSerializer):
+    """The serializer of the blocks of the blk*.dat files, whose
+    transactions can be serialized with witness data."""
+    txns = fields.ListField(WitnessTxSerializer)
+
+#: The serializer used to deserialize the blocks of the files
+BLOCK_SERIALIZER = WitnessBlockSerializer()
+
+def deserialize_block(buffer, offset, fields=None):
+    """Deserialize a raw block of a blk*.dat file, the witnesses of
+    the transactions are skipped.
+
+    :param buffer: The buffer of the raw block (str, mmap)
+    :param offset: The offset of the raw block in the buffer
+    :param fields: The fields to deserialize, see
+                   Serializer.projection()
+    :returns: The Block
+    """
+    return BLOCK_SERIALIZER.deserialize_from(buffer, offset, fields)[0]
+
+class BlockFileReader(object):
+    """This class reads the blocks of the blk*.dat files. The records
+    are read from memory-mapped files without copying them and can be
+    deserialized in the calling process or in a pool of processes, the
+    blocks are in the order of the files, which isn't the height order.
+
+    Example of use::
+
+        def count_outputs(block):
+            return sum(len(tx.tx_out) for tx in block.txns)
+
+        reader = BlockFileReader("/home/user/.bitcoin/blocks")
+        total = sum(reader.map(count_outputs, ordered=False))
+
+    :param filenames: The directory of the blk*.dat files or a list of
+                      paths of the files.
+    :param coin: The coin of the network magic
+    :param processes: The number of worker processes, the number of
+                      CPUs when omitted, 0 to work in the calling
+                      process.
+    :param batch_size: The number of blocks sent to a worker at once.
+    """
+    def __init__(self, filenames, coin="bitcoin", processes=None,
+                 batch_size=64):
+        if isinstance(filenames, basestring):
+            filenames = block_files(filenames)
+        self.filenames = list(filenames)
+        self.coin = coin
+        self.processes = processes
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        return self.iter_blocks()
+
+    def iter_raw(self):
+        """Iterate the raw blocks without copying them.
+
+        :returns: An iterator of (filename, buffer, offset, length),
+                  the buffer being the memory map of the file.
+        """
+        for filename in self.filenames:
+            buffer = map_file(filename)
+            if buffer is None:
+                continue
+            try:
+                for offset, length in iter_records(buffer, self.coin):
+                    yield filename, buffer, offset, length
+            finally:
+                buffer.close()
+
+    def iter_blocks(self, fields=None):
+        """Iterate the blocks deserialized in the calling process.
+
+        :param fields: The fields to deserialize, see
+                       Serializer.projection()
+        """
+        if fields is not None:
+            fields = BLOCK_SERIALIZER.projection(fields)
+        for filename, buffer, offset, length in self.iter_raw():
+            yield deserialize_block(buffer, offset, fields)
+
+    def iter_batches(self):
+        """Iterate the records in batches of (filename, [(offset,
+        length), ...]), the tasks sent to the workers."""
+        for filename in self.filenames:
+            buffer = map_file(filename)
+            if buffer is None:
+                continue
+            try:
+                batch = []
+                for record in iter_records(buffer, self.coin):
+                    batch.append(record)
+                    if len(batch) >= self.batch_size:
+                        yield filename, batch
+                        batch = []
+                if batch:
+                    yield filename, batch
+            finally:
+                buffer.close()
+
+    def map(self, function, ordered=True, raw=False, fields=None):
+        """Call the function with each block in the worker processes,
+        and iterate the results. The function must be defined at the
+        module level, so it can be sent to the workers.
+
+        :param function: The callable receiving the Block, or the
+                         (buffer, offset, length) of the raw block
+                         when raw is True.
+        :param ordered: When False, the results are returned as soon
+                        as they are ready, instead of in the order of
+                        the blocks in the files.
+        :param raw: When True, the function receives the raw block
+                    and can decode just what it needs.
+        :param fields: The fields to deserialize, see
+                       Serializer.projection()
+        """
+        tasks = ((filename, records, function, raw, fields)
+            for filename, records in self.iter_batches())
+        if self.processes == 0:
+            try:
+                for task in tasks:
+                    for result in _map_batch(task):
+                        yield result
+            finally:
+                _close_worker_map()
+            return
+
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            if ordered:
+                batches = pool.imap(_map_batch, tasks)
+            else:
+                batches = pool.imap_unordered(_map_batch, tasks)
+            for results in batches:
+                for result in results:
+                    yield result
+        except BaseException:
+            pool.terminate()
+            pool.join()
+            raise
+        pool.close()
+        pool.join()
+
+#: The memory map of the last file used by the worker process
+_worker_map = [None, None]
+
+def _close_worker_map():
+    """Close the memory map of the last file used."""
+    if _worker_map[1] is not None:
+        _worker_map[1].close()
+    _worker_map[:] = [None, None]
+
+def _map_batch(task):
+    """Run the function of a map() task in a worker process."""
+    filename, records, function, raw, fields = task
+    if _worker_map[0] != filename:
+        _close_worker_map()
+        _worker_map[:] = [filename, map_file(filename)]
+    buffer = _worker_map[1]
+
+    if raw:
+        return [function(buffer, offset, length)
+            for offset, length in records]
+    if fields is not None:
+        fields = BLOCK_SERIALIZER.projection(fields)
+    return [function(deserialize_block(buffer, offset, fields))
+        for offset, length in records]
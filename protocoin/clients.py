@@ -1,59 +1,440 @@
 from cStringIO import StringIO
+from . import fields
 from .serializers import *
-from .exceptions import NodeDisconnectException, InvalidMessageChecksum
+from .exceptions import NodeDisconnectException, NodeTimeoutException
+from .exceptions import NodeMisbehaviorException
+from .exceptions import InvalidMessageChecksum
+from .timers import TimerWheel
+import errno
+import fcntl
+import hashlib
 import os
+import select
+import socket
+import struct
+import threading
+import time
 
 
 class ProtocolBuffer(object):
-    def __init__(self):
+    """The buffer used to extract messages from the raw stream of
+    data received from the socket. The payload checksum is computed
+    incrementally as the payload bytes are written, so only the
+    second SHA256 round is left when the message is complete.
+
+    :param verify_checksum: when False, the payload checksum is
+                            neither computed nor verified, use
+                            only with trusted peers.
+    :param block_stream: when set, the block messages are decoded
+                         while their payload arrives and the
+                         handle_block_start(), handle_block_tx()
+                         and handle_block_end() methods of this
+                         object are called instead of returning
+                         the whole Block.
+    :param commands: a dict mapping the commands to receive to True
+                     (deserialize the payload) or False (return the
+                     raw payload string), the payload of the other
+                     commands is dropped as it arrives without being
+                     buffered or verified. When None, all the known
+                     commands are deserialized.
+    :param coin: the coin of the network magic, used to check the
+                 headers and to resynchronize a corrupt stream.
+    :param max_payload_sizes: a dict with the maximum payload size
+                              of some commands, updating the class
+                              attribute with the same name.
+
+    The headers with a wrong magic or announcing a payload larger
+    than the maximum size of their command, and the messages with
+    a bad checksum, are dropped and the buffer is resynchronized
+    by scanning for the next network magic, instead of buffering
+    the announced payload or raising. These events are counted in
+    the resync_count, oversized_count, bad_checksum_count and
+    discarded_bytes attributes, so the clients can disconnect the
+    misbehaving peers.
+    """
+    #: The maximum payload size (in bytes) of each command
+    max_payload_sizes = {
+        "version": 1024,
+        "verack": 0,
+        "ping": 8,
+        "pong": 8,
+        "getaddr": 0,
+        "mempool": 0,
+        "addr": 3 + 1000 * 30,
+        "inv": 3 + 50000 * 36,
+        "getdata": 3 + 50000 * 36,
+        "notfound": 3 + 50000 * 36,
+        "getblocks": 4 + 1 + 101 * 32 + 32,
+        "getheaders": 4 + 1 + 101 * 32 + 32,
+        "headers": 3 + 2000 * 81,
+    }
+
+    #: The maximum payload size (in bytes) of the other commands
+    default_max_payload_size = 4 * 1000 * 1000
+
+    def __init__(self, verify_checksum=True, block_stream=None,
+                 commands=None, coin="bitcoin", max_payload_sizes=None):
         self.buffer = StringIO()
         self.header_size = MessageHeaderSerializer.calcsize()
+        self.verify_checksum = verify_checksum
+        self.block_stream = block_stream
+        self.commands = commands
+        self.magic = fields.MAGIC_VALUES[coin]
+        self.magic_bytes = struct.pack("<I", self.magic)
+        if max_payload_sizes is not None:
+            self.max_payload_sizes = dict(self.max_payload_sizes,
+                **max_payload_sizes)
+        self.resync_count = 0
+        self.oversized_count = 0
+        self.bad_checksum_count = 0
+        self.discarded_bytes = 0
+        self.reset_message()
+
+    def reset_message(self):
+        """This method will reset the state of the message being
+        currently received."""
+        self.message_header = None
+        self.header_data = None
+        self.payload_hash = None
+        self.payload_hashed = 0
+        self.payload_received = 0
+        self.block_decoder = None
+        self.skip_payload = False
 
     def write(self, data):
+        self.buffer.seek(0, os.SEEK_END)
         self.buffer.write(data)
+        if self.payload_hash is not None:
+            self.update_checksum(data)
+
+    def update_checksum(self, data):
+        """This method will feed the running payload hash with the
+        part of the data that belongs to the current payload.
+
+        :param data: The data received, starting at the first
+                     payload byte not yet hashed.
+        """
+        missing = self.message_header.length - self.payload_hashed
+        if missing <= 0:
+            return
+        if len(data) > missing:
+            data = data[:missing]
+        self.payload_hash.update(data)
+        self.payload_hashed += len(data)
 
     def receive_message(self):
         """This method will attempt to extract a header and message.
         It will return a tuple of (header, message) and set whichever
-        can be set so far (None otherwise).
+        can be set so far (None otherwise). The message is the raw
+        payload for the commands not deserialized, and None for the
+        commands skipped. A message dropped for its bad checksum
+        returns (None, None), like an incomplete header.
         """
         # Calculate the size of the buffer
         self.buffer.seek(0, os.SEEK_END)
         buffer_size = self.buffer.tell()
 
-        # Check if a complete header is present
-        if buffer_size < self.header_size:
-            return (None, None)
+        if self.message_header is None:
+            buffer_size = self.receive_header()
+            if buffer_size is None:
+                return (None, None)
 
-        # Go to the beginning of the buffer
-        self.buffer.reset()
+        message_header = self.message_header
 
-        message_model = None
-        message_header_serial = MessageHeaderSerializer()
-        message_header = message_header_serial.deserialize(self.buffer)
-        total_length = self.header_size + message_header.length
+        if self.skip_payload:
+            return self.receive_skipped()
+
+        if self.block_stream is not None and \
+                message_header.command == "block":
+            return self.receive_block_stream()
 
         # Incomplete message
-        if buffer_size < total_length:
-            self.buffer.seek(0, os.SEEK_END)
+        if buffer_size < message_header.length:
             return (message_header, None)
 
+        self.buffer.reset()
         payload = self.buffer.read(message_header.length)
         remaining = self.buffer.read()
         self.buffer = StringIO()
         self.buffer.write(remaining)
-        payload_checksum = MessageHeaderSerializer.calc_checksum(payload)
+        payload_hash = self.payload_hash
+        header_data = self.header_data
+        self.reset_message()
+
+        if not self.checksum_ok(message_header, payload_hash):
+            # The message is dropped and the next header is searched
+            # from the byte after the magic, the length may be wrong
+            self.bad_checksum_count += 1
+            self.resync(header_data + payload + remaining)
+            return (None, None)
+
+        command = message_header.command
+        if self.commands is not None:
+            deserialize = self.commands.get(command)
+            if deserialize is None:
+                # Unregistered while its payload was received, skipped
+                return (message_header, None)
+            if not deserialize:
+                return (message_header, payload)
+
+        message_model = None
+        if command in MESSAGE_MAPPING:
+            deserializer = MESSAGE_SERIALIZERS[command]
+            message_model, unused_offset = \
+                deserializer.deserialize_from(payload)
+
+        return (message_header, message_model)
+
+    def receive_header(self):
+        """This method will parse the header of the next message,
+        keeping just the payload in the buffer, and resynchronize
+        the stream while the header is not valid.
+
+        :returns: The size of the payload data in the buffer, or
+                  None when no complete header is present.
+        """
+        header_size = self.header_size
+        while True:
+            # Check if a complete header is present
+            self.buffer.seek(0, os.SEEK_END)
+            if self.buffer.tell() < header_size:
+                return None
+
+            # Parse the header only once
+            self.buffer.reset()
+            header_data = self.buffer.read(header_size)
+            message_header, unused_offset = \
+                MESSAGE_HEADER_SERIALIZER.deserialize_from(header_data)
+            remaining = self.buffer.read()
+
+            command = message_header.command
+            max_size = self.max_payload_sizes.get(command,
+                self.default_max_payload_size)
+            if message_header.magic != self.magic:
+                self.resync(header_data + remaining)
+                continue
+            if message_header.length > max_size:
+                self.oversized_count += 1
+                self.resync(header_data + remaining)
+                continue
+            break
+
+        self.message_header = message_header
+        self.header_data = header_data
+        self.buffer = StringIO()
+        self.buffer.write(remaining)
+
+        streamed = self.block_stream is not None and command == "block"
+        if self.commands is not None and not streamed and \
+                command not in self.commands:
+            self.skip_payload = True
+        elif self.verify_checksum:
+            self.payload_hash = hashlib.sha256()
+            self.update_checksum(remaining)
+        return len(remaining)
+
+    def resync(self, data):
+        """This method will drop the data before the next network
+        magic found after the first byte of the data, the start of a
+        corrupt message, and keep the rest in the buffer.
+
+        :param data: The data from the start of the corrupt message
+        """
+        self.resync_count += 1
+        position = data.find(self.magic_bytes, 1)
+        if position < 0:
+            # Keep the bytes that can be the start of a magic
+            position = max(len(data) - len(self.magic_bytes) + 1, 1)
+        self.discarded_bytes += position
+        self.reset_message()
+        self.buffer = StringIO()
+        self.buffer.write(data[position:])
+
+    def receive_messages(self):
+        """This method will extract all the complete messages present
+        in the buffer, yielding a tuple of (header, message) for each
+        of them (see receive_message()). The messages dropped for their
+        bad checksum are not yielded."""
+        while True:
+            bad_checksum_count = self.bad_checksum_count
+            message_header, message = self.receive_message()
+            if self.bad_checksum_count != bad_checksum_count:
+                # Dropped, the buffer was resynchronized on the next magic
+                continue
+            if message_header is None or self.message_header is not None:
+                return
+            yield (message_header, message)
+
+    def receive_skipped(self):
+        """This method will drop the payload received so far of a
+        message skipped. It will return a tuple of (header, None).
+        """
+        message_header = self.message_header
+        self.buffer.reset()
+        missing = message_header.length - self.payload_received
+        self.payload_received += len(self.buffer.read(missing))
+        remaining = self.buffer.read()
+        self.buffer = StringIO()
+        self.buffer.write(remaining)
+        if self.payload_received >= message_header.length:
+            self.reset_message()
+        return (message_header, None)
+
+    def receive_block_stream(self):
+        """This method will decode the block payload received so far
+        and dispatch the decoded block header and transactions to the
+        block stream object. Only the bytes of the transaction being
+        received are kept in memory.
+        It will return a tuple of (header, None).
+        """
+        message_header = self.message_header
+        if self.block_decoder is None:
+            self.block_decoder = BlockStreamDecoder()
+
+        self.buffer.reset()
+        missing = message_header.length - self.payload_received
+        data = self.buffer.read(missing)
+        remaining = self.buffer.read()
+        self.buffer = StringIO()
+        self.buffer.write(remaining)
+        self.payload_received += len(data)
+
+        for item in self.block_decoder.feed(data):
+            if isinstance(item, Tx):
+                self.block_stream.handle_block_tx(message_header, item)
+            else:
+                self.block_stream.handle_block_start(message_header, item)
 
-        # Check if the checksum is valid
-        if payload_checksum != message_header.checksum:
+        if self.payload_received < message_header.length:
+            return (message_header, None)
+
+        payload_hash = self.payload_hash
+        self.reset_message()
+        if not self.checksum_ok(message_header, payload_hash):
+            # The transactions were already dispatched, so the
+            # error can't be hidden by a resync.
+            self.bad_checksum_count += 1
             msg = "Bad checksum for command %s" % message_header.command
             raise InvalidMessageChecksum(msg)
+        self.block_stream.handle_block_end(message_header)
+        return (message_header, None)
 
-        if message_header.command in MESSAGE_MAPPING:
-            deserializer = MESSAGE_MAPPING[message_header.command]()
-            message_model = deserializer.deserialize(StringIO(payload))
+    def checksum_ok(self, message_header, payload_hash):
+        """Check the payload checksum against the message header.
 
-        return (message_header, message_model)
+        :param message_header: The message header
+        :param payload_hash: The SHA256 hash object fed with the
+                             payload, or None to skip the check.
+        :returns: False when the checksum doesn't match
+        """
+        if payload_hash is None:
+            return True
+        payload_checksum = \
+            MessageHeaderSerializer.finish_checksum(payload_hash)
+        return payload_checksum == message_header.checksum
+
+class SendQueue(object):
+    """The outbound queue of a peer. The messages are serialized
+    directly at the end of a single buffer, so many small messages
+    are coalesced and written to the socket with a single call when
+    the socket is ready. The queue can be written by many threads.
+
+    :param high_watermark: when the number of queued bytes reaches
+                           this value, the queue is paused and the
+                           on_high_watermark callback is called.
+    :param low_watermark: when a paused queue drains to this number
+                          of bytes, the queue is resumed and the
+                          on_low_watermark callback is called.
+    :param on_high_watermark: a callable receiving the SendQueue
+    :param on_low_watermark: a callable receiving the SendQueue
+    """
+    #: The number of sent bytes kept at the start of the buffer
+    #: before it is compacted
+    compact_size = 64 * 1024
+
+    def __init__(self, high_watermark=4 * 1024 * 1024,
+                 low_watermark=1024 * 1024, on_high_watermark=None,
+                 on_low_watermark=None):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.on_high_watermark = on_high_watermark
+        self.on_low_watermark = on_low_watermark
+        self.paused = False
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.buffer) - self.offset
+
+    def push_message(self, message, coin="bitcoin"):
+        """Serialize the message, with header, at the end of the queue.
+
+        :param message: The message object to queue
+        :param coin: The coin used to set the magic of the header
+        """
+        with self.lock:
+            message.serialize_message_into(self.buffer, len(self.buffer),
+                coin)
+            self.check_watermarks()
+
+    def push(self, data):
+        """Add raw bytes at the end of the queue.
+
+        :param data: The bytes to queue
+        """
+        with self.lock:
+            self.buffer.extend(data)
+            self.check_watermarks()
+
+    def flush(self, sock, blocking=False):
+        """Write the queued bytes to the socket. When not blocking,
+        only the bytes that fit in the socket buffer are written.
+
+        :param sock: The socket to write
+        :param blocking: when True, wait until all bytes are written
+        :returns: The number of bytes written
+        """
+        with self.lock:
+            if not len(self):
+                return 0
+            flags = 0 if blocking else getattr(socket, "MSG_DONTWAIT", 0)
+            view = memoryview(self.buffer)[self.offset:]
+            try:
+                if blocking:
+                    sock.sendall(view)
+                    sent = len(view)
+                else:
+                    sent = sock.send(view, flags)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                sent = 0
+            finally:
+                del view
+
+            self.offset += sent
+            if self.offset == len(self.buffer):
+                del self.buffer[:]
+                self.offset = 0
+            elif self.offset >= self.compact_size and \
+                    self.offset * 2 >= len(self.buffer):
+                del self.buffer[:self.offset]
+                self.offset = 0
+
+            self.check_watermarks()
+            return sent
+
+    def check_watermarks(self):
+        """Pause or resume the queue according to the watermarks."""
+        if not self.paused and len(self) >= self.high_watermark:
+            self.paused = True
+            if self.on_high_watermark is not None:
+                self.on_high_watermark(self)
+        elif self.paused and len(self) <= self.low_watermark:
+            self.paused = False
+            if self.on_low_watermark is not None:
+                self.on_low_watermark(self)
 
 class BitcoinBasicClient(object):
     """The base class for a Bitcoin network client, this class
@@ -61,70 +442,363 @@ class BitcoinBasicClient(object):
 
     :param socket: a socket that supports the makefile()
                    method.
+    :param verify_checksum: when False, the checksum of the
+                            received messages is not verified,
+                            use only with trusted local peers.
+    :param timers: the TimerWheel advanced by the loop(), a new
+                   one is created when omitted.
+
+    The messages are dispatched to the handle_[command](message_header,
+    message) methods, which receive the deserialized message, and to
+    the handle_raw_[command](message_header, payload) methods, which
+    receive the raw payload string. The handlers are resolved once,
+    when the client is created, use register_handler() to add others
+    later. The payload of the commands without a handler is dropped
+    without being deserialized.
     """
 
     coin = "bitcoin"
 
-    def __init__(self, socket):
+    #: The time (in seconds) without receiving data after which
+    #: handle_timeout("idle") is called, None to disable it.
+    idle_timeout = None
+
+    #: When True, the block messages are decoded while they arrive
+    #: and dispatched to handle_block_start(), handle_block_tx()
+    #: and handle_block_end() instead of handle_block().
+    stream_blocks = False
+
+    #: The send queue size (in bytes) that pauses the reading of
+    #: new messages until the queue drains to send_low_watermark.
+    send_high_watermark = 4 * 1024 * 1024
+    send_low_watermark = 1024 * 1024
+
+    #: The interval (in seconds) used to check receive_paused()
+    #: again while the reading is paused by it.
+    receive_pause_interval = 0.05
+
+    #: A dict with the maximum payload size of some commands, see
+    #: ProtocolBuffer.max_payload_sizes for the defaults.
+    max_payload_sizes = None
+
+    #: The number of corrupt messages (wrong magic, oversized or bad
+    #: checksum) after which handle_misbehavior() is called, None to
+    #: disable it.
+    max_corrupt_messages = 10
+
+    def __init__(self, socket, verify_checksum=True, timers=None):
         self.socket = socket
-        self.buffer = ProtocolBuffer()
+        block_stream = self if self.stream_blocks else None
+        self.handlers = {}
+        self.buffer = ProtocolBuffer(verify_checksum, block_stream, {},
+            self.coin, self.max_payload_sizes)
+        for command in MESSAGE_MAPPING:
+            raw_handler = getattr(self, "handle_raw_" + command, None)
+            handler = getattr(self, "handle_" + command, None)
+            if raw_handler is not None:
+                self.register_handler(command, raw_handler, raw=True)
+            elif handler is not None:
+                self.register_handler(command, handler)
+        self.send_queue = SendQueue(self.send_high_watermark,
+            self.send_low_watermark, self.handle_send_high_watermark,
+            self.handle_send_low_watermark)
+        self.looping = False
+        self.loop_thread = None
+        self.wake_fds = None
+        self.wake_lock = threading.Lock()
+        self.timers = timers if timers is not None else TimerWheel()
+        self.last_receive = time.time()
+        self.idle_timer = None
+        if self.idle_timeout is not None:
+            self.idle_timer = self.timers.schedule(self.idle_timeout,
+                self.check_idle)
 
     def close_stream(self):
         """This method will close the socket stream."""
         self.socket.close()
 
+    def register_handler(self, command, handler, raw=False):
+        """Register the handler of a command, replacing the current
+        one. Commands unknown to MESSAGE_MAPPING need a raw handler.
+
+        :param command: The message command
+        :param handler: A callable receiving the message header and
+                        the message (or payload).
+        :param raw: When True, the handler receives the raw payload
+                    string instead of the deserialized message.
+        """
+        if not raw and command not in MESSAGE_MAPPING:
+            raise ValueError("Unknown command %s, use a raw handler" %
+                command)
+        self.handlers[command] = handler
+        self.buffer.commands[command] = not raw
+
+    def unregister_handler(self, command):
+        """Remove the handler of a command, its messages will be
+        skipped.
+
+        :param command: The message command
+        """
+        self.handlers.pop(command, None)
+        self.buffer.commands.pop(command, None)
+
     def handle_message_header(self, message_header, payload):
-        """This method will be called for every message before the
-        message payload deserialization.
+        """This method will be called for every message received,
+        including the messages skipped, before calling its handler.
+
+        :param message_header: The message header
+        :param payload: The data received from the socket
+        """
+        pass
+
+    def handle_block_start(self, message_header, block_header):
+        """This method will be called when the header of a streamed
+        block is decoded, see the stream_blocks attribute.
+
+        :param message_header: The message header
+        :param block_header: The BlockHeader of the block
+        """
+        pass
+
+    def handle_block_tx(self, message_header, tx):
+        """This method will be called for every transaction of a
+        streamed block as soon as it is decoded.
+
+        :param message_header: The message header
+        :param tx: The Tx decoded
+        """
+        pass
+
+    def handle_block_end(self, message_header):
+        """This method will be called when all the payload of a
+        streamed block was received and its checksum verified.
 
         :param message_header: The message header
-        :param payload: The payload of the message
+        """
+        pass
+
+    def handle_timeout(self, reason):
+        """This method will be called when a timeout expires, by
+        default it closes the socket stream and raises the
+        NodeTimeoutException from the loop().
+
+        :param reason: The timeout name ("idle", "handshake")
+        """
+        self.close_stream()
+        raise NodeTimeoutException("Node timeout: %s." % reason)
+
+    def check_misbehavior(self):
+        """This method will be called by the loop() after corrupt data
+        was dropped from the stream, it calls handle_misbehavior()
+        once the buffer resynchronized the stream max_corrupt_messages
+        times. Override it to use the resync_count, oversized_count
+        and bad_checksum_count of the buffer differently."""
+        buffer = self.buffer
+        if self.max_corrupt_messages is not None and \
+                buffer.resync_count >= self.max_corrupt_messages:
+            self.handle_misbehavior("%d corrupt messages "
+                "(%d oversized, %d bad checksums)" % (buffer.resync_count,
+                    buffer.oversized_count, buffer.bad_checksum_count))
+
+    def handle_misbehavior(self, reason):
+        """This method will be called when the peer sends too many
+        corrupt messages, by default it closes the socket stream and
+        raises the NodeMisbehaviorException from the loop().
+
+        :param reason: The description of the misbehavior
+        """
+        self.close_stream()
+        raise NodeMisbehaviorException("Node misbehavior: %s." % reason)
+
+    def check_idle(self):
+        """Timer callback that checks the idle timeout, the timer
+        is moved to the new deadline while data is received, so the
+        receive path doesn't touch the timers."""
+        idle = time.time() - self.last_receive
+        if idle >= self.idle_timeout:
+            self.handle_timeout("idle")
+        else:
+            self.timers.reschedule(self.idle_timer, self.idle_timeout - idle)
+
+    def receive_paused(self):
+        """This method will be called by the loop() before reading the
+        socket, return True to stop reading until it returns False, so
+        the backpressure of the consumers of the messages reaches the
+        socket. It is checked at every receive_pause_interval.
+        """
+        return False
+
+    def handle_send_high_watermark(self, send_queue):
+        """This method will be called when the send queue reaches
+        the send_high_watermark, the client stops reading messages
+        until the queue drains.
+
+        :param send_queue: The SendQueue of the client
+        """
+        pass
+
+    def handle_send_low_watermark(self, send_queue):
+        """This method will be called when the send queue drains
+        to the send_low_watermark after reaching the high one.
+
+        :param send_queue: The SendQueue of the client
         """
         pass
 
     def send_message(self, message):
         """This method will serialize the message using the
         appropriate serializer based on the message command
-        and then it will send it to the socket stream.
+        and then it will queue it to the socket stream. Inside
+        the loop() the queue is written when the socket is ready,
+        otherwise it is written before returning. When called from
+        another thread while the loop() runs, the bytes that fit in
+        the socket buffer are written at once and the loop is woken
+        up to write the rest, as it may be waiting in select() without
+        checking the socket for writes.
 
         :param message: The message object to send
         """
-        self.socket.sendall(message.get_message(self.coin))
+        send_queue = self.send_queue
+        send_queue.push_message(message, self.coin)
+        if not self.looping:
+            send_queue.flush(self.socket, blocking=True)
+        elif self.loop_thread is not threading.current_thread():
+            send_queue.flush(self.socket)
+            if len(send_queue):
+                self.wake_loop()
+
+    def wake_loop(self):
+        """Wake the loop() up from select(), so it checks the send
+        queue again. This method can be called from any thread."""
+        with self.wake_lock:
+            if self.wake_fds is None:
+                return
+            try:
+                os.write(self.wake_fds[1], "\0")
+            except OSError as e:
+                # A full pipe already wakes the loop up
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def open_wake_pipe(self):
+        """Create the pipe used by wake_loop(), its read end is
+        selected by the loop()."""
+        wake_fds = os.pipe()
+        for fd in wake_fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        with self.wake_lock:
+            self.wake_fds = wake_fds
+        return wake_fds[0]
+
+    def close_wake_pipe(self):
+        """Close the pipe used by wake_loop()."""
+        with self.wake_lock:
+            if self.wake_fds is not None:
+                for fd in self.wake_fds:
+                    os.close(fd)
+                self.wake_fds = None
 
     def loop(self):
         """This is the main method of the client, it will enter
-        in a receive/send loop."""
-
-        while True:
-            data = self.socket.recv(1024*8)
-
-            if len(data) <= 0:
-                raise NodeDisconnectException("Node disconnected.")
-            
-            self.buffer.write(data)
-            message_header, message = self.buffer.receive_message()
-
-            if message_header is not None:
-                self.handle_message_header(message_header, data)
-
-            if not message:
-                continue
-
-            handle_func_name = "handle_" + message_header.command
-            handle_func = getattr(self, handle_func_name, None)
-            if handle_func:
-                handle_func(message_header, message)
+        in a receive/send loop. The send queue is written when the
+        socket is ready and, while it is above the high watermark,
+        no more data is read from the socket. The timers are
+        advanced between the socket events, and the loop is woken
+        up by wake_loop() when another thread queues messages."""
+        self.looping = True
+        self.loop_thread = threading.current_thread()
+        wake_fd = self.open_wake_pipe()
+        try:
+            while True:
+                send_queue = self.send_queue
+                wlist = [self.socket] if len(send_queue) else []
+                rlist = [self.socket, wake_fd]
+                timeout = self.timers.timeout()
+                if send_queue.paused:
+                    rlist = [wake_fd]
+                elif self.receive_paused():
+                    rlist = [wake_fd]
+                    if timeout is None or \
+                            timeout > self.receive_pause_interval:
+                        timeout = self.receive_pause_interval
+                readable, writable, unused = \
+                    select.select(rlist, wlist, [], timeout)
+                if writable:
+                    send_queue.flush(self.socket)
+                self.timers.advance()
+                if wake_fd in readable:
+                    os.read(wake_fd, 4096)
+                if self.socket not in readable:
+                    continue
+
+                data = self.socket.recv(1024*8)
+
+                if len(data) <= 0:
+                    raise NodeDisconnectException("Node disconnected.")
+                self.last_receive = time.time()
+
+                self.buffer.write(data)
+                handlers = self.handlers
+                resync_count = self.buffer.resync_count
+                for message_header, message in \
+                        self.buffer.receive_messages():
+                    self.handle_message_header(message_header, data)
+                    if message is None:
+                        continue
+                    handle_func = handlers.get(message_header.command)
+                    if handle_func is not None:
+                        handle_func(message_header, message)
+                if self.buffer.resync_count != resync_count:
+                    self.check_misbehavior()
+        finally:
+            self.close_wake_pipe()
+            self.looping = False
+            self.loop_thread = None
 
 class BitcoinClient(BitcoinBasicClient):
     """This class implements all the protocol rules needed
     for a client to stay up in the network. It will handle
-    the handshake rules as well answer the ping messages."""
+    the handshake rules as well answer the ping messages.
+    After the handshake, a Ping is sent at every ping_interval
+    to keep the connection alive."""
+
+    #: The time (in seconds) to wait for the VerAck message
+    handshake_timeout = 60.0
+
+    #: The interval (in seconds) between the Ping messages sent,
+    #: None to disable them
+    ping_interval = 120.0
+
+    #: Disconnect the nodes silent for 20 minutes
+    idle_timeout = 20 * 60.0
 
     def handshake(self):
         """This method will implement the handshake of the
         Bitcoin protocol. It will send the Version message."""
         version = Version()
         self.send_message(version)
+        self.handshake_timer = self.timers.schedule(self.handshake_timeout,
+            self.handle_timeout, "handshake")
+
+    def handle_verack(self, message_header, message):
+        """This method will handle the VerAck message, completing
+        the handshake and starting the keepalive Ping messages.
+
+        :param message_header: The VerAck message header
+        :param message: The VerAck message
+        """
+        handshake_timer = getattr(self, "handshake_timer", None)
+        if handshake_timer is not None:
+            handshake_timer.cancel()
+        if self.ping_interval is not None:
+            self.ping_timer = self.timers.schedule_periodic(
+                self.ping_interval, self.send_ping)
+
+    def send_ping(self):
+        """This method will send a Ping message, it is called
+        by the keepalive timer."""
+        self.send_message(Ping())
 
     def handle_version(self, message_header, message):
         """This method will handle the Version message and
@@ -0,0 +1,158 @@
+"""Columnar extraction of blocks and transactions into NumPy arrays.
+The block payloads are parsed straight into columns, without creating
+the Block, Tx, TxIn and TxOut models, so statistics over the chain can
+be computed with vectorized operations. This module requires NumPy.
+"""
+import struct
+import hashlib
+
+import numpy
+
+from .fields import unpack_varint_from
+
+_block_header = struct.Struct("<I32s32sIII")
+_outpoint = struct.Struct("<32sI")
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+
+#: The columns (and their data types) of each table
+COLUMNS = {
+    "blocks": [
+        ("block_hash", "V32"),
+        ("version", numpy.uint32),
+        ("prev_block", "V32"),
+        ("merkle_root", "V32"),
+        ("timestamp", numpy.uint32),
+        ("bits", numpy.uint32),
+        ("nonce", numpy.uint32),
+        ("tx_count", numpy.uint32),
+    ],
+    "txs": [
+        ("block_index", numpy.uint32),
+        ("txid", "V32"),
+        ("version", numpy.uint32),
+        ("lock_time", numpy.uint32),
+        ("input_count", numpy.uint32),
+        ("output_count", numpy.uint32),
+        ("size", numpy.uint32),
+    ],
+    "inputs": [
+        ("tx_index", numpy.uint64),
+        ("prev_hash", "V32"),
+        ("prev_index", numpy.uint32),
+        ("script_length", numpy.uint32),
+        ("sequence", numpy.uint32),
+    ],
+    "outputs": [
+        ("tx_index", numpy.uint64),
+        ("value", numpy.int64),
+        ("script_length", numpy.uint32),
+    ],
+}
+
+class BlockColumns(object):
+    """The columns extracted from one or many blocks. Each table
+    (blocks, txs, inputs and outputs) is a dict mapping the column
+    name to a NumPy array, the rows of the tables are linked by the
+    block_index and tx_index columns. The hashes (block_hash, txid,
+    prev_hash, etc) are kept as raw 32-byte values ("V32" columns) in
+    the same byte order used by the protocol, .tobytes() returns the
+    string of a single element.
+
+    Example of use::
+
+        columns = extract_blocks(payloads)
+        total = columns.outputs["value"].sum()
+    """
+    def __init__(self, blocks, txs, inputs, outputs):
+        self.blocks = blocks
+        self.txs = txs
+        self.inputs = inputs
+        self.outputs = outputs
+
+    def __repr__(self):
+        return "<%s Blocks=[%d] Txs=[%d] Inputs=[%d] Outputs=[%d]>" % \
+            (self.__class__.__name__, len(self.blocks["version"]),
+                len(self.txs["txid"]), len(self.inputs["tx_index"]),
+                len(self.outputs["tx_index"]))
+
+def extract_block(payload):
+    """Extract the columns of a single block.
+
+    :param payload: The payload of the block message.
+    :returns: A BlockColumns instance
+    """
+    return extract_blocks([payload])
+
+def extract_blocks(payloads):
+    """Extract the columns of many blocks.
+
+    :param payloads: An iterable with the payloads of the block messages,
+                     they can be strings, bytearrays, memoryviews or mmaps.
+    :returns: A BlockColumns instance
+    """
+    tables = dict((table, dict((name, []) for name, unused in columns))
+        for table, columns in COLUMNS.iteritems())
+    blocks = tables["blocks"]
+    txs = tables["txs"]
+    inputs = tables["inputs"]
+    outputs = tables["outputs"]
+
+    tx_index = 0
+    for block_index, payload in enumerate(payloads):
+        version, prev_block, merkle_root, timestamp, bits, nonce = \
+            _block_header.unpack_from(payload, 0)
+        h = hashlib.sha256(payload[:80]).digest()
+        blocks["block_hash"].append(hashlib.sha256(h).digest())
+        blocks["version"].append(version)
+        blocks["prev_block"].append(prev_block)
+        blocks["merkle_root"].append(merkle_root)
+        blocks["timestamp"].append(timestamp)
+        blocks["bits"].append(bits)
+        blocks["nonce"].append(nonce)
+        tx_count, offset = unpack_varint_from(payload, 80)
+        blocks["tx_count"].append(tx_count)
+
+        for i in xrange(tx_count):
+            tx_start = offset
+            tx_version = _uint32.unpack_from(payload, offset)[0]
+            input_count, offset = unpack_varint_from(payload, offset + 4)
+            for j in xrange(input_count):
+                prev_hash, prev_index = _outpoint.unpack_from(payload, offset)
+                script_length, offset = unpack_varint_from(payload, offset + 36)
+                offset += script_length
+                inputs["tx_index"].append(tx_index)
+                inputs["prev_hash"].append(prev_hash)
+                inputs["prev_index"].append(prev_index)
+                inputs["script_length"].append(script_length)
+                inputs["sequence"].append(
+                    _uint32.unpack_from(payload, offset)[0])
+                offset += 4
+
+            output_count, offset = unpack_varint_from(payload, offset)
+            for j in xrange(output_count):
+                value = _int64.unpack_from(payload, offset)[0]
+                script_length, offset = unpack_varint_from(payload, offset + 8)
+                offset += script_length
+                outputs["tx_index"].append(tx_index)
+                outputs["value"].append(value)
+                outputs["script_length"].append(script_length)
+
+            lock_time = _uint32.unpack_from(payload, offset)[0]
+            offset += 4
+            h = hashlib.sha256(payload[tx_start:offset]).digest()
+            txs["block_index"].append(block_index)
+            txs["txid"].append(hashlib.sha256(h).digest())
+            txs["version"].append(tx_version)
+            txs["lock_time"].append(lock_time)
+            txs["input_count"].append(input_count)
+            txs["output_count"].append(output_count)
+            txs["size"].append(offset - tx_start)
+            tx_index += 1
+
+    for table, columns in COLUMNS.iteritems():
+        values = tables[table]
+        for name, dtype in columns:
+            values[name] = numpy.array(values[name], dtype=dtype)
+
+    return BlockColumns(blocks, txs, inputs, outputs)
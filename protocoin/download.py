@@ -0,0 +1,328 @@
+import time
+import threading
+from collections import deque
+
+from . import fields
+from .serializers import GetData, Inventory
+
+class PeerDownload(object):
+    """The download state of a single peer.
+
+    :param peer: The BitcoinClient used to request the blocks
+    :param window: The initial number of blocks in flight
+    """
+    def __init__(self, peer, window):
+        self.peer = peer
+        self.window = window
+        self.in_flight = set()
+        self.blocks_per_second = None
+        self.blocks_received = 0
+        self.bytes_received = 0
+        self.stalls = 0
+
+    def __repr__(self):
+        rate = self.blocks_per_second or 0.0
+        return "<%s Window=[%d] In Flight=[%d] Rate=[%.2f blocks/s]>" % \
+            (self.__class__.__name__, self.window, len(self.in_flight), rate)
+
+class BlockDownloader(object):
+    """This class schedules the download of a list of blocks across
+    many peers. Each peer keeps a window of GetData requests in flight,
+    the window size is adapted to the throughput measured for the peer,
+    requests older than the stall timeout are moved to other peers and
+    the blocks are delivered to the consumer in the order of the list.
+
+    The requests run at most max_ahead blocks ahead of the next block to
+    deliver, so a slow peer holding that block can't make the others
+    fill the memory with the following blocks: once the limit is
+    reached, the blocking block is requested again from the peers with
+    room in their window. The requests moved from a peer (stalled,
+    removed or answering with NotFound) are sent at once to the peers
+    with room in their window, through their send_message(), which can
+    be called from any thread; the messages are sent after releasing
+    the lock of the downloader. Example of use::
+
+        class DownloadClient(BitcoinClient):
+            def handle_verack(self, message_header, message):
+                BitcoinClient.handle_verack(self, message_header, message)
+                downloader.add_peer(self)
+                self.timers.schedule_periodic(downloader.stall_timeout / 2,
+                    downloader.check_stalls, self)
+
+            def handle_block(self, message_header, message):
+                downloader.block_received(self, message,
+                    message_header.length)
+
+            def handle_notfound(self, message_header, message):
+                downloader.not_found(self, message)
+
+    :param block_hashes: The hashes of the wanted blocks, in the order
+                         they must be delivered.
+    :param consumer: A callable receiving each Block in order.
+    :param window: The initial window size of each peer.
+    :param min_window: The minimum window size.
+    :param max_window: The maximum window size.
+    :param window_time: The window of a peer is sized to hold the
+                        number of blocks it delivers in this time
+                        (in seconds).
+    :param stall_timeout: The time (in seconds) after which a request
+                          is considered stalled and moved to another
+                          peer.
+    :param max_ahead: The maximum distance (in blocks) between the next
+                      block to deliver and the blocks requested.
+    """
+    #: The weight of the last measure in the throughput average
+    rate_smoothing = 0.2
+
+    def __init__(self, block_hashes, consumer, window=16, min_window=2,
+                 max_window=128, window_time=2.0, stall_timeout=10.0,
+                 max_ahead=1024):
+        self.consumer = consumer
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window_time = window_time
+        self.stall_timeout = stall_timeout
+        self.max_ahead = max_ahead
+        self.lock = threading.RLock()
+
+        # The repeated hashes are downloaded and delivered once
+        self.order = []
+        self.position = {}
+        for block_hash in block_hashes:
+            block_hash = fields.HashValue(fields.hash_to_bytes(block_hash))
+            if block_hash not in self.position:
+                self.position[block_hash] = len(self.order)
+                self.order.append(block_hash)
+        self.wanted = set(self.order)
+        self.queue = deque(self.order)
+        self.next_index = 0
+        self.received = {}
+        self.in_flight = {}
+        self.peers = {}
+
+    def done(self):
+        """Returns True when all the blocks were delivered."""
+        return self.next_index == len(self.order)
+
+    def add_peer(self, peer):
+        """Add a peer to the download and request its first blocks.
+
+        :param peer: The BitcoinClient to add
+        """
+        with self.lock:
+            if peer not in self.peers:
+                self.peers[peer] = PeerDownload(peer, self.window)
+            requests = [(peer, self.request_blocks(peer))]
+        self.send_requests(requests)
+
+    def remove_peer(self, peer):
+        """Remove a peer (disconnected, for instance) from the download,
+        its requests in flight are given to the other peers.
+
+        :param peer: The BitcoinClient to remove
+        """
+        with self.lock:
+            state = self.peers.pop(peer, None)
+            if state is None:
+                return
+            for block_hash in state.in_flight:
+                del self.in_flight[block_hash]
+            self.requeue(state.in_flight)
+            requests = self.fill_windows()
+        self.send_requests(requests)
+
+    def block_received(self, peer, block, size=0):
+        """This method must be called for every block received from a
+        peer, the blocks not wanted by the download are ignored.
+
+        :param peer: The BitcoinClient that received the block
+        :param block: The Block received
+        :param size: The payload size, used in the statistics
+        """
+        block_hash = block.calculate_hash_value()
+        now = time.time()
+        with self.lock:
+            if block_hash not in self.wanted or block_hash in self.received:
+                return
+            request = self.in_flight.pop(block_hash, None)
+            if request is not None:
+                owner, request_time = request
+                owner_state = self.peers.get(owner)
+                if owner_state is not None:
+                    owner_state.in_flight.discard(block_hash)
+
+            state = self.peers.get(peer)
+            if state is not None:
+                state.blocks_received += 1
+                state.bytes_received += size
+                if request is not None and owner is peer:
+                    self.update_window(state, now - request_time)
+
+            self.received[block_hash] = block
+            self.deliver()
+            # The delivery may have moved the max_ahead limit
+            requests = self.fill_windows()
+        self.send_requests(requests)
+
+    def not_found(self, peer, message):
+        """This method must be called when a peer answers with a
+        NotFound message, the blocks are requested to other peers.
+
+        :param peer: The BitcoinClient that received the message
+        :param message: The NotFound message
+        """
+        with self.lock:
+            state = self.peers.get(peer)
+            missing = []
+            for inventory in message.inventory:
+                block_hash = fields.HashValue(
+                    fields.hash_to_bytes(inventory.inv_hash))
+                request = self.in_flight.get(block_hash)
+                if request is None or request[0] is not peer:
+                    continue
+                del self.in_flight[block_hash]
+                state.in_flight.discard(block_hash)
+                missing.append(block_hash)
+            self.requeue(missing)
+            requests = self.fill_windows()
+        self.send_requests(requests)
+
+    def check_stalls(self, peer=None):
+        """Move the requests older than the stall timeout to the queue,
+        halving the window of the peers that stalled, and fill the
+        windows of the peers again. This method should be called
+        periodically.
+
+        :param peer: The BitcoinClient calling this method, if any
+                     (not used, kept for compatibility).
+        """
+        now = time.time()
+        with self.lock:
+            stalled = [block_hash
+                for block_hash, (owner, request_time)
+                in self.in_flight.iteritems()
+                if now - request_time >= self.stall_timeout]
+            stalled_peers = set()
+            for block_hash in stalled:
+                owner, request_time = self.in_flight.pop(block_hash)
+                state = self.peers[owner]
+                state.in_flight.discard(block_hash)
+                if owner not in stalled_peers:
+                    stalled_peers.add(owner)
+                    state.stalls += 1
+                    state.window = max(self.min_window, state.window // 2)
+            self.requeue(stalled)
+            requests = self.fill_windows()
+        self.send_requests(requests)
+
+    def update_window(self, state, latency):
+        """Update the throughput of the peer and size its window to
+        the number of blocks it delivers in window_time.
+
+        :param state: The PeerDownload of the peer
+        :param latency: The time taken to deliver the last block
+        """
+        # With N blocks in flight, a block delivered after latency
+        # seconds means a rate of N / latency blocks per second
+        rate = (len(state.in_flight) + 1) / max(latency, 1e-3)
+        if state.blocks_per_second is None:
+            state.blocks_per_second = rate
+        else:
+            state.blocks_per_second += \
+                self.rate_smoothing * (rate - state.blocks_per_second)
+        window = int(state.blocks_per_second * self.window_time)
+        state.window = max(self.min_window, min(self.max_window, window))
+
+    def request_blocks(self, peer):
+        """Fill the window of the peer with requests from the queue,
+        in a single GetData message. When the requests reach the
+        max_ahead limit, the block blocking the delivery is requested
+        from this peer if its request is older than half the stall
+        timeout. It must be called holding the lock, the message is
+        sent by send_requests() once the lock is released.
+
+        :param peer: The BitcoinClient to use
+        :returns: The GetData message, or None
+        """
+        state = self.peers[peer]
+        now = time.time()
+        limit = self.next_index + self.max_ahead
+        requested = []
+        while self.queue and \
+                len(state.in_flight) + len(requested) < state.window:
+            block_hash = self.queue[0]
+            if block_hash not in self.wanted or \
+                    block_hash in self.received or \
+                    block_hash in self.in_flight:
+                self.queue.popleft()
+                continue
+            if self.position[block_hash] >= limit:
+                break
+            self.queue.popleft()
+            requested.append(block_hash)
+
+        if len(state.in_flight) + len(requested) < state.window and \
+                self.next_index < len(self.order):
+            blocking_hash = self.order[self.next_index]
+            request = self.in_flight.get(blocking_hash)
+            if request is not None and request[0] is not peer and \
+                    now - request[1] >= self.stall_timeout / 2.0 and \
+                    (not self.queue or self.position[self.queue[0]] >= limit):
+                owner_state = self.peers[request[0]]
+                owner_state.in_flight.discard(blocking_hash)
+                owner_state.window = max(self.min_window,
+                    owner_state.window // 2)
+                requested.insert(0, blocking_hash)
+
+        if not requested:
+            return None
+        getdata = GetData()
+        for block_hash in requested:
+            inventory = Inventory()
+            inventory.inv_type = fields.INVENTORY_TYPE["MSG_BLOCK"]
+            inventory.inv_hash = block_hash
+            getdata.inventory.append(inventory)
+            state.in_flight.add(block_hash)
+            self.in_flight[block_hash] = (peer, now)
+        return getdata
+
+    def fill_windows(self):
+        """Request the queued blocks from all the peers with room in
+        their window, see request_blocks().
+
+        :returns: A list of (peer, GetData message)
+        """
+        requests = []
+        for peer, state in self.peers.items():
+            if len(state.in_flight) < state.window:
+                requests.append((peer, self.request_blocks(peer)))
+        return requests
+
+    def send_requests(self, requests):
+        """Send the GetData messages built by request_blocks(), without
+        holding the lock, so a slow peer doesn't block the scheduling.
+
+        :param requests: A list of (peer, GetData message or None)
+        """
+        for peer, getdata in requests:
+            if getdata is not None:
+                peer.send_message(getdata)
+
+    def requeue(self, block_hashes):
+        """Put the block hashes back at the front of the queue, keeping
+        the download order."""
+        for block_hash in sorted(block_hashes, key=self.position.get,
+                                 reverse=True):
+            self.queue.appendleft(block_hash)
+
+    def deliver(self):
+        """Deliver to the consumer the blocks received in order."""
+        while self.next_index < len(self.order):
+            block_hash = self.order[self.next_index]
+            block = self.received.pop(block_hash, None)
+            if block is None:
+                break
+            self.next_index += 1
+            self.wanted.discard(block_hash)
+            self.consumer(block)
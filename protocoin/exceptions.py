@@ -5,9 +5,27 @@ class NodeDisconnectException(Exception):
     pass
 
 
+class NodeTimeoutException(NodeDisconnectException):
+    """This exception is thrown when the node it is connected
+    doesn't answer in time (handshake or idle timeouts)."""
+    pass
+
+
+class NodeMisbehaviorException(NodeDisconnectException):
+    """This exception is thrown when the node it is connected
+    sends too many corrupt messages."""
+    pass
+
+
 class InvalidMessageChecksum(Exception):
     """This exception is thrown when the checksum for a
     message in a message header doesn't match the actual
     checksum of the message."""
     pass
 
+
+class PayloadWorkerException(Exception):
+    """This exception is thrown when the function run by a worker
+    process raises an exception, the message has the traceback
+    of the worker."""
+    pass
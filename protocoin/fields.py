@@ -41,24 +41,131 @@ INVENTORY_TYPE = {
     "MSG_BLOCK": 2,
 }
 
+#: The type of the compact block filters (BIP 158)
+FILTER_TYPE = {
+    "BASIC": 0,
+}
+
+_uint8_struct = struct.Struct("<B")
+_varint_structs = {
+    0xFD: struct.Struct("<H"),
+    0xFE: struct.Struct("<I"),
+    0xFF: struct.Struct("<Q"),
+}
+
+def unpack_varint_from(buffer, offset):
+    """Unpack the variable size integer present in the buffer at
+    the specified offset.
+
+    :param buffer: the buffer (str, bytearray, memoryview, mmap)
+    :param offset: the offset of the integer in the buffer
+    :returns: a tuple with the integer and the offset where it ends
+    """
+    int_id = _uint8_struct.unpack_from(buffer, offset)[0]
+    if int_id < 0xFD:
+        return int_id, offset + 1
+    int_struct = _varint_structs[int_id]
+    return (int_struct.unpack_from(buffer, offset + 1)[0],
+        offset + 1 + int_struct.size)
+
+def read_bytes_from(buffer, offset, size):
+    """Read a string of bytes from the buffer at the specified
+    offset.
+
+    :param buffer: the buffer (str, bytearray, memoryview, mmap)
+    :param offset: the offset of the bytes in the buffer
+    :param size: the number of bytes to read
+    :returns: the string with the bytes
+    """
+    data = buffer[offset:offset + size]
+    if data.__class__ is not str:
+        data = data.tobytes() if isinstance(data, memoryview) else str(data)
+    if len(data) != size:
+        raise struct.error("unpack_from requires a buffer of at least %d bytes"
+            % (offset + size))
+    return data
+
+def skip_bytes(stream, size):
+    """Advance the stream by a number of bytes, seeking when the
+    stream supports it.
+
+    :param stream: the data stream
+    :param size: the number of bytes to skip
+    """
+    seek = getattr(stream, "seek", None)
+    if seek is not None:
+        seek(size, 1)
+    else:
+        stream.read(size)
+
+def varint_size(value):
+    """Returns the number of bytes used to serialize the value as a
+    variable size integer.
+
+    :param value: the integer value
+    """
+    if value < 0xFD:
+        return 1
+    if value <= 0xFFFF:
+        return 3
+    if value <= 0xFFFFFFFF:
+        return 5
+    return 9
+
+def pack_varint_into(buffer, offset, value):
+    """Pack the value as a variable size integer into the buffer at
+    the specified offset.
+
+    :param buffer: a writable buffer (bytearray, memoryview, mmap)
+    :param offset: the offset where the integer will be written
+    :param value: the integer value
+    :returns: the offset where the integer ends
+    """
+    if value < 0xFD:
+        _uint8_struct.pack_into(buffer, offset, value)
+        return offset + 1
+    if value <= 0xFFFF:
+        int_id = 0xFD
+    elif value <= 0xFFFFFFFF:
+        int_id = 0xFE
+    else:
+        int_id = 0xFF
+    int_struct = _varint_structs[int_id]
+    _uint8_struct.pack_into(buffer, offset, int_id)
+    int_struct.pack_into(buffer, offset + 1, value)
+    return offset + 1 + int_struct.size
+
+def write_bytes_into(buffer, offset, data):
+    """Write a string of bytes into the buffer at the specified offset.
+
+    :param buffer: a writable buffer (bytearray, memoryview, mmap)
+    :param offset: the offset where the bytes will be written
+    :param data: the string of bytes (str, bytearray or memoryview)
+    :returns: the offset where the bytes end
+    """
+    if data.__class__ is not str:
+        # bytearray slices only accept exact str instances
+        data = data.tobytes() if isinstance(data, memoryview) else str(data)
+    end = offset + len(data)
+    buffer[offset:end] = data
+    return end
+
 class Field(object):
     """Base class for the Fields. This class only implements
     the counter to keep the order of the fields on the
-    serializer classes."""
+    serializer classes. Fields keep no state about the values
+    they serialize, so the same field (and serializer) instance
+    can be safely shared by many threads."""
     counter = 0
 
+    #: The serialized size of the fields that always use the
+    #: same number of bytes, None for variable size fields
+    fixed_size = None
+
     def __init__(self):
         self.count = Field.counter
         Field.counter += 1
 
-    def parse(self, value):
-        """This method should be implemented to parse the value
-        parameter into the field internal representation.
-
-        :param value: value to be parsed
-        """
-        raise NotImplemented
-
     def deserialize(self, stream):
         """This method must read the stream data and then
         deserialize and return the deserialized content.
@@ -68,20 +175,74 @@ class Field(object):
         """
         raise NotImplemented
 
-    def serialize(self):
-        """Serialize the internal representation and return
-        the serialized data.
+    def deserialize_from(self, buffer, offset):
+        """This method must deserialize the content present in
+        the buffer at the specified offset, without copying the
+        buffer.
+
+        :param buffer: the buffer (str, bytearray, memoryview, mmap)
+        :param offset: the offset of the content in the buffer
+        :returns: a tuple with the deserialized content and the
+                  offset where the content ends
+        """
+        raise NotImplemented
+
+    def skip(self, stream):
+        """Advance the stream past the content of the field without
+        deserializing it. The default implementation deserializes
+        the variable size fields, override it to avoid that.
+
+        :param stream: stream of data to read
+        """
+        if self.fixed_size is not None:
+            skip_bytes(stream, self.fixed_size)
+        else:
+            self.deserialize(stream)
+
+    def skip_from(self, buffer, offset):
+        """Returns the offset where the content of the field present
+        in the buffer at the specified offset ends, without
+        deserializing it.
+
+        :param buffer: the buffer (str, bytearray, memoryview, mmap)
+        :param offset: the offset of the content in the buffer
+        """
+        if self.fixed_size is not None:
+            return offset + self.fixed_size
+        return self.deserialize_from(buffer, offset)[1]
 
+    def serialize(self, value):
+        """Serialize the value and return the serialized data.
+
+        :param value: the value to be serialized
         :returns: the serialized data
         """
         raise NotImplemented
 
-    def __repr__(self):
-        return "<%s [%r]>" % (self.__class__.__name__,
-            repr(self.value))
+    def serialized_size(self, value):
+        """Returns the number of bytes of the serialized value. The
+        default implementation serializes the value, override it
+        to avoid that.
+
+        :param value: the value to be serialized
+        """
+        return len(self.serialize(value))
+
+    def serialize_into(self, value, buffer, offset):
+        """Serialize the value directly into the buffer at the
+        specified offset, the buffer must be large enough (see
+        serialized_size()). The default implementation copies the
+        result of serialize(), override it to avoid that.
+
+        :param value: the value to be serialized
+        :param buffer: a writable buffer (bytearray, memoryview, mmap)
+        :param offset: the offset where the value will be written
+        :returns: the offset where the serialized value ends
+        """
+        return write_bytes_into(buffer, offset, self.serialize(value))
 
-    def __str__(self):
-        return str(self.value)
+    def __repr__(self):
+        return "<%s>" % self.__class__.__name__
 
 class PrimaryField(Field):
     """This is a base class for all fields that has only
@@ -93,14 +254,11 @@ class PrimaryField(Field):
         class UInt32LEField(PrimaryField):
             datatype = "<I"
     """
-
-    def parse(self, value):
-        """This method will set the internal value to the
-        specified value.
-
-        :param value: the value to be set
-        """
-        self.value = value
+    def __init__(self):
+        super(PrimaryField, self).__init__()
+        self.struct = struct.Struct(self.datatype)
+        self.unpack_from = self.struct.unpack_from
+        self.fixed_size = self.struct.size
 
     def deserialize(self, stream):
         """Deserialize the stream using the struct data type
@@ -112,12 +270,31 @@ class PrimaryField(Field):
         data = stream.read(data_size)
         return struct.unpack(self.datatype, data)[0]
 
-    def serialize(self):
-        """Serialize the internal data and then return the
-        serialized data."""
-        data = struct.pack(self.datatype, self.value)
+    def deserialize_from(self, buffer, offset):
+        """Deserialize the buffer using the struct data type
+        specified.
+
+        :param buffer: the data buffer
+        :param offset: the offset of the data in the buffer
+        """
+        return (self.unpack_from(buffer, offset)[0],
+            offset + self.struct.size)
+
+    def serialize(self, value):
+        """Serialize the value and then return the serialized data.
+
+        :param value: the value to be serialized
+        """
+        data = struct.pack(self.datatype, value)
         return data
 
+    def serialized_size(self, value):
+        return self.struct.size
+
+    def serialize_into(self, value, buffer, offset):
+        self.struct.pack_into(buffer, offset, value)
+        return offset + self.struct.size
+
 class Int32LEField(PrimaryField):
     """32-bit little-endian integer field."""
     datatype = "<i"
@@ -146,6 +323,10 @@ class UInt16BEField(PrimaryField):
     """16-bit big-endian unsigned integer field."""
     datatype = ">H"
 
+class UInt8Field(PrimaryField):
+    """8-bit unsigned integer field."""
+    datatype = "<B"
+
 class FixedStringField(Field):
     """A fixed length string field.
 
@@ -161,20 +342,32 @@ class FixedStringField(Field):
     def __init__(self, length):
         super(FixedStringField, self).__init__()
         self.length = length
-
-    def parse(self, value):
-        self.value = value[:self.length]
+        self.fixed_size = length
 
     def deserialize(self, stream):
         data = stream.read(self.length)
         return data.split("\x00", 1)[0]
 
-    def serialize(self):
+    def deserialize_from(self, buffer, offset):
+        data = read_bytes_from(buffer, offset, self.length)
+        return data.split("\x00", 1)[0], offset + self.length
+
+    def serialize(self, value):
+        value = value[:self.length]
         bin_data = StringIO()
-        bin_data.write(self.value[:self.length])
-        bin_data.write("\x00" * (12 - len(self.value)))
+        bin_data.write(value)
+        bin_data.write("\x00" * (self.length - len(value)))
         return bin_data.getvalue()
 
+    def serialized_size(self, value):
+        return self.length
+
+    def serialize_into(self, value, buffer, offset):
+        value = value[:self.length]
+        end = write_bytes_into(buffer, offset, value)
+        write_bytes_into(buffer, end, "\x00" * (self.length - len(value)))
+        return offset + self.length
+
 class NestedField(Field):
     """A field used to nest another serializer.
 
@@ -190,15 +383,29 @@ class NestedField(Field):
         super(NestedField, self).__init__()
         self.serializer_class = serializer_class
         self.serializer = self.serializer_class()
+        if not self.serializer._variable_field_items:
+            self.fixed_size = self.serializer._fixed_size
 
-    def parse(self, value):
-        self.value = value
+    def deserialize(self, stream, fields=None):
+        return self.serializer.deserialize(stream, fields)
 
-    def deserialize(self, stream):
-        return self.serializer.deserialize(stream)
+    def deserialize_from(self, buffer, offset, fields=None):
+        return self.serializer.deserialize_from(buffer, offset, fields)
+
+    def skip(self, stream):
+        self.serializer.skip(stream)
+
+    def skip_from(self, buffer, offset):
+        return self.serializer.skip_from(buffer, offset)
 
-    def serialize(self):
-        return self.serializer.serialize(self.value)
+    def serialize(self, value):
+        return self.serializer.serialize(value)
+
+    def serialized_size(self, value):
+        return self.serializer.serialized_size(value)
+
+    def serialize_into(self, value, buffer, offset):
+        return self.serializer.serialize_into(value, buffer, offset)
 
 class ListField(Field):
     """A field used to serialize/deserialize a list of serializers.
@@ -215,58 +422,108 @@ class ListField(Field):
     def __init__(self, serializer_class):
         super(ListField, self).__init__()
         self.serializer_class = serializer_class
+        self.serializer = self.serializer_class()
         self.var_int = VariableIntegerField()
 
-    def parse(self, value):
-        self.value = value
-
-    def serialize(self):
+    def serialize(self, value):
         bin_data = StringIO()
-        self.var_int.parse(len(self))
-        bin_data.write(self.var_int.serialize())
-        serializer = self.serializer_class()
-        for item in self:
+        bin_data.write(self.var_int.serialize(len(value)))
+        serializer = self.serializer
+        for item in value:
             bin_data.write(serializer.serialize(item))
         return bin_data.getvalue()
 
-    def deserialize(self, stream):
+    def serialized_size(self, value):
+        if not self.serializer._variable_field_items:
+            return varint_size(len(value)) + \
+                self.serializer._fixed_size * len(value)
+        serialized_size = self.serializer.serialized_size
+        return varint_size(len(value)) + \
+            sum(serialized_size(item) for item in value)
+
+    def serialize_into(self, value, buffer, offset):
+        offset = pack_varint_into(buffer, offset, len(value))
+        serialize_into = self.serializer.serialize_into
+        for item in value:
+            offset = serialize_into(item, buffer, offset)
+        return offset
+
+    def deserialize(self, stream, fields=None):
         count = self.var_int.deserialize(stream)
         items = []
-        serializer = self.serializer_class()
+        serializer = self.serializer
+        if fields is not None:
+            # Resolve the projection once for all the items
+            fields = serializer.projection(fields)
         for i in xrange(count):
-            data = serializer.deserialize(stream)
+            data = serializer.deserialize(stream, fields)
             items.append(data)
         return items
 
-    def __iter__(self):
-        return iter(self.value)
+    def deserialize_from(self, buffer, offset, fields=None):
+        count, offset = unpack_varint_from(buffer, offset)
+        items = []
+        deserialize_from = self.serializer.deserialize_from
+        if fields is None:
+            for i in xrange(count):
+                data, offset = deserialize_from(buffer, offset)
+                items.append(data)
+            return items, offset
+
+        fields = self.serializer.projection(fields)
+        for i in xrange(count):
+            data, offset = deserialize_from(buffer, offset, fields)
+            items.append(data)
+        return items, offset
 
-    def __len__(self):
-        return len(self.value)
+    def skip(self, stream):
+        count = self.var_int.deserialize(stream)
+        serializer = self.serializer
+        if not serializer._variable_field_items:
+            skip_bytes(stream, serializer._fixed_size * count)
+            return
+        for i in xrange(count):
+            serializer.skip(stream)
+
+    def skip_from(self, buffer, offset):
+        count, offset = unpack_varint_from(buffer, offset)
+        serializer = self.serializer
+        if not serializer._variable_field_items:
+            return offset + serializer._fixed_size * count
+        skip_from = serializer.skip_from
+        for i in xrange(count):
+            offset = skip_from(buffer, offset)
+        return offset
 
 class IPv4AddressField(Field):
     """An IPv4 address field without timestamp and reserved IPv6 space."""
     reserved = "\x00"*10 + "\xff"*2
-
-    def parse(self, value):
-        self.value = value
+    fixed_size = 16
 
     def deserialize(self, stream):
         unused_reserved = stream.read(12)
         addr = stream.read(4)
         return socket.inet_ntoa(addr)
 
-    def serialize(self):
+    def deserialize_from(self, buffer, offset):
+        addr = read_bytes_from(buffer, offset + 12, 4)
+        return socket.inet_ntoa(addr), offset + 16
+
+    def serialize(self, value):
         bin_data = StringIO()
         bin_data.write(self.reserved)
-        bin_data.write(socket.inet_aton(self.value))
+        bin_data.write(socket.inet_aton(value))
         return bin_data.getvalue()
 
+    def serialized_size(self, value):
+        return 16
+
+    def serialize_into(self, value, buffer, offset):
+        offset = write_bytes_into(buffer, offset, self.reserved)
+        return write_bytes_into(buffer, offset, socket.inet_aton(value))
+
 class VariableIntegerField(Field):
     """A variable size integer field."""
-    def parse(self, value):
-        self.value = int(value)
-
     def deserialize(self, stream):
         int_id_raw = stream.read(struct.calcsize("<B"))
         int_id = struct.unpack("<B", int_id_raw)[0]
@@ -281,77 +538,317 @@ class VariableIntegerField(Field):
             int_id = struct.unpack("<Q", data)[0]
         return int_id
 
-    def serialize(self):
-        if self.value < 0xFD:
-            return chr(self.value)
-        if self.value <= 0xFFFF:
-            return chr(0xFD) + struct.pack("<H", self.value)
-        if self.value <= 0xFFFFFFFF:
-            return chr(0xFE) + struct.pack("<I", self.value)
-        return chr(0xFF) + struct.pack("<Q", self.value)
+    def deserialize_from(self, buffer, offset):
+        return unpack_varint_from(buffer, offset)
+
+    def skip_from(self, buffer, offset):
+        return unpack_varint_from(buffer, offset)[1]
+
+    def serialize(self, value):
+        value = int(value)
+        if value < 0xFD:
+            return chr(value)
+        if value <= 0xFFFF:
+            return chr(0xFD) + struct.pack("<H", value)
+        if value <= 0xFFFFFFFF:
+            return chr(0xFE) + struct.pack("<I", value)
+        return chr(0xFF) + struct.pack("<Q", value)
+
+    def serialized_size(self, value):
+        return varint_size(int(value))
+
+    def serialize_into(self, value, buffer, offset):
+        return pack_varint_into(buffer, offset, int(value))
+
+class InternPool(object):
+    """A bounded pool of interned strings, the strings decoded with
+    the same value (the standard scripts paying to the same address,
+    the user agents of the nodes) share a single object. The pool
+    keeps two generations of at most max_size strings each: when
+    the current generation is full it replaces the old one, so the
+    strings not seen since then are released.
+
+    Example of use::
+
+        pool = InternPool()
+        TxOutSerializer.intern_field("pk_script", pool)
+        VersionSerializer.intern_field("user_agent", pool)
+        print pool.get_stats()
+
+    :param max_size: The maximum number of strings of a generation
+    :param max_length: The strings longer than this are not interned
+    """
+    def __init__(self, max_size=100000, max_length=128):
+        self.max_size = max_size
+        self.max_length = max_length
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved_bytes = 0
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def intern(self, value):
+        """Returns the string of the pool equal to the value, adding
+        the value to the pool when it isn't there.
+
+        :param value: The string
+        """
+        if len(value) > self.max_length:
+            return value
+        interned = self.current.get(value)
+        if interned is None:
+            interned = self.previous.get(value)
+            if interned is None:
+                self.misses += 1
+                interned = value
+            else:
+                self.hits += 1
+                self.saved_bytes += len(value)
+            if len(self.current) >= self.max_size:
+                self.previous = self.current
+                self.current = {}
+            self.current[interned] = interned
+            return interned
+        self.hits += 1
+        self.saved_bytes += len(value)
+        return interned
+
+    def clear(self):
+        """Remove all the strings of the pool."""
+        self.current = {}
+        self.previous = {}
+
+    def get_stats(self):
+        """Returns a dict with the size, hits, misses, hit_rate and
+        saved_bytes (the size of the duplicated strings released) of
+        the pool."""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "saved_bytes": self.saved_bytes,
+        }
 
 class VariableStringField(Field):
-    """A variable length string field."""
+    """A variable length string field.
 
-    def __init__(self):
+    :param intern_pool: The InternPool of the strings deserialized,
+                        see Serializer.intern_field().
+    """
+
+    def __init__(self, intern_pool=None):
         super(VariableStringField, self).__init__()
         self.var_int = VariableIntegerField()
-
-    def parse(self, value):
-        self.value = str(value)
+        self.intern_pool = intern_pool
 
     def deserialize(self, stream):
         string_length = self.var_int.deserialize(stream)
         string_data = stream.read(string_length)
+        if self.intern_pool is not None:
+            string_data = self.intern_pool.intern(string_data)
         return string_data
 
-    def serialize(self):
-        self.var_int.parse(len(self))
+    def deserialize_from(self, buffer, offset):
+        string_length, offset = unpack_varint_from(buffer, offset)
+        string_data = read_bytes_from(buffer, offset, string_length)
+        if self.intern_pool is not None:
+            string_data = self.intern_pool.intern(string_data)
+        return string_data, offset + string_length
+
+    def skip(self, stream):
+        skip_bytes(stream, self.var_int.deserialize(stream))
+
+    def skip_from(self, buffer, offset):
+        string_length, offset = unpack_varint_from(buffer, offset)
+        return offset + string_length
+
+    def serialize(self, value):
+        value = str(value)
         bin_data = StringIO()
-        bin_data.write(self.var_int.serialize())
-        bin_data.write(self.value)
+        bin_data.write(self.var_int.serialize(len(value)))
+        bin_data.write(value)
         return bin_data.getvalue()
 
-    def __len__(self):
-        return len(self.value)
+    def serialized_size(self, value):
+        value_size = len(str(value))
+        return varint_size(value_size) + value_size
+
+    def serialize_into(self, value, buffer, offset):
+        value = str(value)
+        offset = pack_varint_into(buffer, offset, len(value))
+        return write_bytes_into(buffer, offset, value)
+
+class HashValue(str):
+    """An immutable 32-byte hash, kept as the raw bytes in the
+    same byte order used by the protocol. The integer and the
+    hex forms are computed only when requested.
+
+    Example of use::
+
+        inv_hash = HashValue.from_hex(block.calculate_hash())
+        print inv_hash.to_hex(), int(inv_hash)
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_int(klass, value):
+        """Create a new HashValue from its integer representation.
+
+        :param value: The hash as an integer
+        """
+        return klass(_hash_struct.pack(value & 0xFFFFFFFFFFFFFFFF,
+            (value >> 64) & 0xFFFFFFFFFFFFFFFF,
+            (value >> 128) & 0xFFFFFFFFFFFFFFFF,
+            value >> 192))
+
+    @classmethod
+    def from_hex(klass, hexvalue):
+        """Create a new HashValue from its hex representation (the
+        same used by calculate_hash() and by block explorers).
+
+        :param hexvalue: The hash as a hex string
+        """
+        return klass(hexvalue.decode("hex")[::-1])
+
+    def to_int(self):
+        """Returns the integer representation of the hash."""
+        a, b, c, d = _hash_struct.unpack(self)
+        return a | (b << 64) | (c << 128) | (d << 192)
+
+    def to_hex(self):
+        """Returns the hex representation of the hash."""
+        return self[::-1].encode("hex_codec")
+
+    def __int__(self):
+        return self.to_int()
+
+    def __long__(self):
+        return self.to_int()
+
+    def __repr__(self):
+        return "<%s [%s]>" % (self.__class__.__name__, self.to_hex())
+
+_hash_struct = struct.Struct("<QQQQ")
+
+#: The hash with all bytes set to zero
+NULL_HASH = HashValue("\x00" * 32)
+
+def hash_to_bytes(value):
+    """Converts a hash given as a HashValue, a 32-byte string or an
+    integer to the raw bytes used by the protocol.
+
+    :param value: The hash
+    :raises ValueError: when the value isn't an integer or 32 bytes long
+    """
+    if isinstance(value, (int, long)):
+        return HashValue.from_int(value)
+    if len(value) != 32:
+        raise ValueError("A hash must be 32 bytes long, got %d bytes"
+            % len(value))
+    return value
 
 class Hash(Field):
-    """A hash type field."""
-    datatype = "<I"
+    """A hash type field. The hashes are deserialized as HashValue
+    instances and can be serialized from a HashValue, a 32-byte
+    string or an integer.
+
+    :param as_int: when True, the hashes are deserialized as integers
+                   (like in the previous versions), when omitted the
+                   class attribute with the same name is used.
+    """
+    #: The default for the as_int parameter of all the Hash fields
+    as_int = False
+    fixed_size = 32
 
-    def parse(self, value):
-        self.value = value
+    def __init__(self, as_int=None):
+        super(Hash, self).__init__()
+        if as_int is not None:
+            self.as_int = as_int
 
     def deserialize(self, stream):
-        data_size = struct.calcsize(self.datatype)
-        intvalue = 0
-        for i in range(8):
-            data = stream.read(data_size)
-            val = struct.unpack(self.datatype, data)[0]
-            intvalue += val << (i * 32)
-        return intvalue
-
-    def serialize(self):
-        hash_ = self.value
-        bin_data = StringIO()
-        for i in range(8):
-            pack_data = struct.pack(self.datatype, hash_ & 0xFFFFFFFF)
-            bin_data.write(pack_data)
-            hash_ >>= 32
-        return bin_data.getvalue()
+        data = stream.read(32)
+        if len(data) != 32:
+            raise struct.error("unpack requires a string argument of length 32")
+        value = HashValue(data)
+        if self.as_int:
+            return value.to_int()
+        return value
+
+    def deserialize_from(self, buffer, offset):
+        value = HashValue(read_bytes_from(buffer, offset, 32))
+        if self.as_int:
+            return value.to_int(), offset + 32
+        return value, offset + 32
+
+    def serialize(self, value):
+        return hash_to_bytes(value)
+
+    def serialized_size(self, value):
+        return 32
+
+    def serialize_into(self, value, buffer, offset):
+        return write_bytes_into(buffer, offset, hash_to_bytes(value))
 
 class BlockLocator(Field):
     """A block locator type used for getblocks and getheaders"""
-    datatype = "<I"
 
-    def parse(self, values):
-        self.values = values
+    def serialize(self, values):
+        bin_data = StringIO()
+        for hash_ in values:
+            bin_data.write(hash_to_bytes(hash_))
+        return bin_data.getvalue()
+
+    def serialized_size(self, values):
+        return 32 * len(values)
+
+    def serialize_into(self, values, buffer, offset):
+        for hash_ in values:
+            offset = write_bytes_into(buffer, offset, hash_to_bytes(hash_))
+        return offset
 
-    def serialize(self):
+class HashListField(Field):
+    """A list of hashes prefixed by the number of hashes, the hashes
+    are deserialized as HashValue instances."""
+
+    def __init__(self):
+        super(HashListField, self).__init__()
+        self.var_int = VariableIntegerField()
+
+    def deserialize(self, stream):
+        count = self.var_int.deserialize(stream)
+        data = stream.read(32 * count)
+        if len(data) != 32 * count:
+            raise struct.error("unpack requires a string argument of length %d"
+                % (32 * count))
+        return [HashValue(data[i:i + 32]) for i in xrange(0, len(data), 32)]
+
+    def deserialize_from(self, buffer, offset):
+        count, offset = unpack_varint_from(buffer, offset)
+        data = read_bytes_from(buffer, offset, 32 * count)
+        return ([HashValue(data[i:i + 32]) for i in xrange(0, len(data), 32)],
+            offset + 32 * count)
+
+    def skip_from(self, buffer, offset):
+        count, offset = unpack_varint_from(buffer, offset)
+        return offset + 32 * count
+
+    def serialize(self, values):
         bin_data = StringIO()
-        for hash_ in self.values:
-            for i in range(8):
-                pack_data = struct.pack(self.datatype, hash_ & 0xFFFFFFFF)
-                bin_data.write(pack_data)
-                hash_ >>= 32
+        bin_data.write(self.var_int.serialize(len(values)))
+        for hash_ in values:
+            bin_data.write(hash_to_bytes(hash_))
         return bin_data.getvalue()
+
+    def serialized_size(self, values):
+        return varint_size(len(values)) + 32 * len(values)
+
+    def serialize_into(self, values, buffer, offset):
+        offset = pack_varint_into(buffer, offset, len(values))
+        for hash_ in values:
+            offset = write_bytes_into(buffer, offset, hash_to_bytes(hash_))
+        return offset
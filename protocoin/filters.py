@@ -0,0 +1,296 @@
+"""Compact block filters (BIP 158). The basic filter of a block is a
+Golomb-coded set of the output scripts of the block and of the scripts
+spent by its inputs, so light clients can test their scripts against
+the filters (received in cfilter messages) and fetch only the blocks
+that match.
+"""
+import struct
+import hashlib
+import binascii
+
+from . import fields
+from .fields import unpack_varint_from
+from .serializers import MESSAGE_SERIALIZERS
+
+#: The Golomb-Rice parameter of the basic filter
+BASIC_FILTER_P = 19
+
+#: The inverse false positive rate of the basic filter
+BASIC_FILTER_M = 784931
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_siphash_key = struct.Struct("<QQ")
+
+def siphash24(k0, k1, data):
+    """Computes the SipHash-2-4 of the data.
+
+    :param k0: The first 64 bits of the key (little-endian)
+    :param k1: The last 64 bits of the key (little-endian)
+    :param data: The string to hash
+    :returns: The hash, a 64-bit integer
+    """
+    v0 = k0 ^ 0x736f6d6570736575
+    v1 = k1 ^ 0x646f72616e646f6d
+    v2 = k0 ^ 0x6c7967656e657261
+    v3 = k1 ^ 0x7465646279746573
+
+    length = len(data)
+    tail_size = length & 7
+    words = struct.unpack_from("<%dQ" % (length >> 3), data)
+    tail = data[length - tail_size:] + "\x00" * (7 - tail_size) + \
+        chr(length & 0xFF)
+    words += struct.unpack("<Q", tail)
+
+    for m in words:
+        v3 ^= m
+        for i in (0, 1):
+            v0 = (v0 + v1) & _MASK64
+            v1 = ((v1 << 13) | (v1 >> 51)) & _MASK64
+            v1 ^= v0
+            v0 = ((v0 << 32) | (v0 >> 32)) & _MASK64
+            v2 = (v2 + v3) & _MASK64
+            v3 = ((v3 << 16) | (v3 >> 48)) & _MASK64
+            v3 ^= v2
+            v0 = (v0 + v3) & _MASK64
+            v3 = ((v3 << 21) | (v3 >> 43)) & _MASK64
+            v3 ^= v0
+            v2 = (v2 + v1) & _MASK64
+            v1 = ((v1 << 17) | (v1 >> 47)) & _MASK64
+            v1 ^= v2
+            v2 = ((v2 << 32) | (v2 >> 32)) & _MASK64
+        v0 ^= m
+
+    v2 ^= 0xFF
+    for i in (0, 1, 2, 3):
+        v0 = (v0 + v1) & _MASK64
+        v1 = ((v1 << 13) | (v1 >> 51)) & _MASK64
+        v1 ^= v0
+        v0 = ((v0 << 32) | (v0 >> 32)) & _MASK64
+        v2 = (v2 + v3) & _MASK64
+        v3 = ((v3 << 16) | (v3 >> 48)) & _MASK64
+        v3 ^= v2
+        v0 = (v0 + v3) & _MASK64
+        v3 = ((v3 << 21) | (v3 >> 43)) & _MASK64
+        v3 ^= v0
+        v2 = (v2 + v1) & _MASK64
+        v1 = ((v1 << 17) | (v1 >> 47)) & _MASK64
+        v1 ^= v2
+        v2 = ((v2 << 32) | (v2 >> 32)) & _MASK64
+    return v0 ^ v1 ^ v2 ^ v3
+
+def _double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+class GCSFilter(object):
+    """A Golomb-coded set filter, keyed by the hash of its block.
+
+    Example of use::
+
+        gcs_filter = GCSFilter.from_bytes(cfilter.block_hash,
+            cfilter.filter_bytes)
+        matched = gcs_filter.match_many(wallet_scripts)
+
+    :param block_hash: The hash of the block (the first 16 bytes are
+                       the SipHash key).
+    :param count: The number of elements in the filter
+    :param data: The Golomb-Rice coded deltas
+    :param p: The Golomb-Rice parameter
+    :param m: The inverse false positive rate
+    """
+    def __init__(self, block_hash, count, data, p=BASIC_FILTER_P,
+                 m=BASIC_FILTER_M):
+        self.block_hash = fields.HashValue(fields.hash_to_bytes(block_hash))
+        self.count = count
+        self.data = data
+        self.p = p
+        self.m = m
+        self.k0, self.k1 = _siphash_key.unpack_from(self.block_hash, 0)
+
+    def __len__(self):
+        return self.count
+
+    def __repr__(self):
+        return "<%s Block Hash=[%s] Count=[%d] Size=[%d]>" % \
+            (self.__class__.__name__, self.block_hash.to_hex(), self.count,
+                len(self.data))
+
+    @classmethod
+    def from_elements(klass, block_hash, elements, p=BASIC_FILTER_P,
+                      m=BASIC_FILTER_M):
+        """Build the filter of a set of elements.
+
+        :param block_hash: The hash of the block
+        :param elements: An iterable with the elements (strings), the
+                         repeated elements are included once.
+        :param p: The Golomb-Rice parameter
+        :param m: The inverse false positive rate
+        """
+        elements = set(elements)
+        gcs_filter = klass(block_hash, len(elements), "", p, m)
+        values = sorted(gcs_filter.hash_to_range(element)
+            for element in elements)
+
+        bits = []
+        remainder_format = "0%db" % p
+        last_value = 0
+        for value in values:
+            delta = value - last_value
+            last_value = value
+            bits.append("1" * (delta >> p))
+            bits.append("0")
+            bits.append(format(delta & ((1 << p) - 1), remainder_format))
+        gcs_filter.data = _bits_to_bytes("".join(bits))
+        return gcs_filter
+
+    @classmethod
+    def from_bytes(klass, block_hash, filter_bytes, p=BASIC_FILTER_P,
+                   m=BASIC_FILTER_M):
+        """Load a serialized filter (the filter_bytes of a cfilter).
+
+        :param block_hash: The hash of the block
+        :param filter_bytes: The number of elements and the coded data
+        :param p: The Golomb-Rice parameter
+        :param m: The inverse false positive rate
+        """
+        count, offset = unpack_varint_from(filter_bytes, 0)
+        return klass(block_hash, count, filter_bytes[offset:], p, m)
+
+    def serialize(self):
+        """Returns the serialized filter: the number of elements
+        followed by the coded data."""
+        return fields.VariableIntegerField().serialize(self.count) + \
+            self.data
+
+    def filter_hash(self):
+        """Returns the hash of the serialized filter."""
+        return fields.HashValue(_double_sha256(self.serialize()))
+
+    def filter_header(self, previous_header=fields.NULL_HASH):
+        """Returns the header of the filter, chained to the header of
+        the filter of the previous block (NULL_HASH for the genesis
+        block).
+
+        :param previous_header: The previous filter header
+        """
+        previous_header = fields.hash_to_bytes(previous_header)
+        return fields.HashValue(_double_sha256(self.filter_hash() +
+            previous_header))
+
+    def hash_to_range(self, element):
+        """Map an element to its value in [0, count * m)."""
+        return (siphash24(self.k0, self.k1, element) *
+            (self.count * self.m)) >> 64
+
+    def iter_values(self):
+        """Iterate the sorted values coded in the filter."""
+        if not self.count:
+            return
+        p = self.p
+        bits = _bytes_to_bits(self.data)
+        position = 0
+        value = 0
+        for i in xrange(self.count):
+            end = bits.index("0", position)
+            quotient = end - position
+            position = end + 1 + p
+            value += (quotient << p) + int(bits[end + 1:position], 2)
+            yield value
+
+    def match_many(self, elements):
+        """Test many elements against the filter in a single pass over
+        the coded data.
+
+        :param elements: An iterable with the elements (strings)
+        :returns: The set of the elements that (probably) are in the
+                  filter, the false positive rate is 1/m.
+        """
+        if not self.count:
+            return set()
+        queries = sorted((self.hash_to_range(element), element)
+            for element in set(elements))
+        matched = set()
+        index = 0
+        query_count = len(queries)
+        for value in self.iter_values():
+            while index < query_count and queries[index][0] < value:
+                index += 1
+            if index == query_count:
+                break
+            while index < query_count and queries[index][0] == value:
+                matched.add(queries[index][1])
+                index += 1
+        return matched
+
+    def match_any(self, elements):
+        """Returns True if any of the elements matches the filter."""
+        return bool(self.match_many(elements))
+
+    def match(self, element):
+        """Returns True if the element (probably) is in the filter."""
+        return bool(self.match_many([element]))
+
+def _bits_to_bytes(bits):
+    """Convert a string of '0' and '1' to bytes, padding the last byte
+    with zeros."""
+    if not bits:
+        return ""
+    bits += "0" * (-len(bits) % 8)
+    return binascii.unhexlify("%0*x" % (len(bits) // 4, int(bits, 2)))
+
+def _bytes_to_bits(data):
+    """Convert bytes to a string of '0' and '1'."""
+    if not data:
+        return ""
+    return format(int(binascii.hexlify(data), 16), "0%db" % (len(data) * 8))
+
+def basic_filter_elements(block, prev_scripts=()):
+    """Returns the elements of the basic filter of a block: the output
+    scripts (except the empty and OP_RETURN ones) and the scripts spent
+    by the inputs.
+
+    :param block: The Block, it can be deserialized with the fields
+                  {"txns": {"tx_out": ["pk_script"]}} only.
+    :param prev_scripts: The scripts of the outputs spent by the inputs
+                         of the block (from the UTXO set or undo data).
+    """
+    elements = set()
+    for tx in block.txns:
+        for tx_out in tx.tx_out:
+            script = tx_out.pk_script
+            if script and script[0] != "\x6a":
+                elements.add(script)
+    elements.update(script for script in prev_scripts if script)
+    return elements
+
+def build_basic_filter(block, prev_scripts=(), block_hash=None):
+    """Build the basic filter (BIP 158) of a block.
+
+    :param block: The Block, see basic_filter_elements()
+    :param prev_scripts: The scripts spent by the inputs of the block
+    :param block_hash: The hash of the block, computed from the block
+                       when omitted.
+    :returns: A GCSFilter
+    """
+    if block_hash is None:
+        block_hash = block.calculate_hash_value()
+    return GCSFilter.from_elements(block_hash,
+        basic_filter_elements(block, prev_scripts))
+
+def build_basic_filter_from(buffer, offset=0, prev_scripts=()):
+    """Build the basic filter of the raw payload of a block message,
+    deserializing only the output scripts.
+
+    :param buffer: The buffer with the block payload
+    :param offset: The offset of the payload in the buffer
+    :param prev_scripts: The scripts spent by the inputs of the block
+    :returns: A GCSFilter
+    """
+    header = fields.read_bytes_from(buffer, offset, 80)
+    block, unused_offset = MESSAGE_SERIALIZERS["block"].deserialize_from(
+        buffer, offset, _SCRIPTS_PROJECTION)
+    return GCSFilter.from_elements(_double_sha256(header),
+        basic_filter_elements(block, prev_scripts))
+
+#: The fields deserialized by build_basic_filter_from()
+_SCRIPTS_PROJECTION = MESSAGE_SERIALIZERS["block"].projection(
+    {"txns": {"tx_out": ["pk_script"]}})
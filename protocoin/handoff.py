@@ -0,0 +1,250 @@
+"""Handoff of raw payloads to worker processes through shared memory.
+The payloads are copied into the slots of an anonymous shared memory
+map created before the workers are forked, so only the slot number
+and the (compact) results of the workers cross the process queues,
+instead of the pickled payloads and models.
+
+The memory is shared by fork(), so this module requires a platform
+where multiprocessing forks the workers (Linux, BSD, OS X).
+"""
+import mmap
+import hashlib
+import traceback
+import multiprocessing
+from Queue import Empty
+from collections import deque
+
+from .fields import unpack_varint_from
+from .serializers import MESSAGE_SERIALIZERS
+from .exceptions import PayloadWorkerException
+
+class PayloadWorkerPool(object):
+    """A pool of worker processes receiving raw payloads through a
+    fixed number of shared memory slots. When all the slots are in
+    use, submit() blocks until a worker returns a result, bounding
+    the memory used and slowing down the producer (the client loop,
+    for instance) to the speed of the workers.
+
+    Example of use::
+
+        pool = PayloadWorkerPool(summarize_block, raw=True)
+
+        class ParallelClient(BitcoinClient):
+            def handle_raw_block(self, message_header, payload):
+                pool.submit(payload)
+                for tag, summary in pool.iter_ready():
+                    print summary
+
+    :param function: The callable run by the workers, receiving the
+                     deserialized message, or the (buffer, offset,
+                     length) of the payload when raw is True. It must
+                     return a small picklable result.
+    :param processes: The number of worker processes, the number of
+                      CPUs when omitted.
+    :param slots: The number of shared memory slots, twice the number
+                  of processes when omitted.
+    :param slot_size: The size (in bytes) of each slot, the larger
+                      payloads are sent through the queue.
+    :param max_oversized: The number of payloads larger than slot_size
+                          in flight, submit() waits for their results
+                          beyond it. The number of processes when
+                          omitted.
+    :param command: The command of the messages deserialized.
+    :param raw: When True, the function receives the raw payload.
+    :param fields: The fields to deserialize, see
+                   Serializer.projection()
+    """
+    #: The interval (in seconds) used to check that the workers are
+    #: alive while waiting for a result
+    poll_interval = 1.0
+
+    def __init__(self, function, processes=None, slots=None,
+                 slot_size=4 * 1024 * 1024, command="block", raw=False,
+                 fields=None, max_oversized=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if slots is None:
+            slots = 2 * processes
+        if max_oversized is None:
+            max_oversized = processes
+        self.slot_size = slot_size
+        self.max_oversized = max_oversized
+        self.oversized = 0
+        self.memory = mmap.mmap(-1, slots * slot_size)
+        self.free_slots = range(slots)
+        self.tags = {}
+        self.ready = deque()
+        self.next_task = 0
+        self.task_queue = multiprocessing.Queue()
+        self.result_queue = multiprocessing.Queue()
+        self.workers = []
+        for i in xrange(processes):
+            worker = multiprocessing.Process(target=_worker_loop,
+                args=(self.memory, slot_size, self.task_queue,
+                    self.result_queue, function, command, raw, fields))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def __len__(self):
+        """Returns the number of payloads being processed."""
+        return len(self.tags) - len(self.ready)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, payload, tag=None):
+        """Send a payload to the workers, waiting for a free slot when
+        all of them are in use (or for the result of an oversized
+        payload, see max_oversized).
+
+        :param payload: The payload of the message
+        :param tag: Any object, returned with the result, it isn't
+                    sent to the workers.
+        """
+        if isinstance(payload, memoryview):
+            payload = payload.tobytes()
+        elif payload.__class__ is not str:
+            payload = str(payload)
+        length = len(payload)
+        task_id = self.next_task
+        self.next_task += 1
+        if length > self.slot_size:
+            while self.oversized >= self.max_oversized:
+                self.ready.append(self.receive_result())
+            self.task_queue.put((task_id, None, payload))
+            self.oversized += 1
+        else:
+            while not self.free_slots:
+                self.ready.append(self.receive_result())
+            slot = self.free_slots.pop()
+            start = slot * self.slot_size
+            self.memory[start:start + length] = payload
+            self.task_queue.put((task_id, slot, length))
+        self.tags[task_id] = tag
+
+    def receive_result(self):
+        """Wait for the next result of the workers and free its slot
+        (or its place among the oversized payloads).
+
+        :returns: A tuple of (task id, ok, result), the result being
+                  the traceback of the worker when ok is False.
+        :raises PayloadWorkerException: When a worker process died.
+        """
+        while True:
+            try:
+                task_id, slot, ok, result = \
+                    self.result_queue.get(timeout=self.poll_interval)
+                break
+            except Empty:
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise PayloadWorkerException(
+                            "Worker process %d exited with code %s" %
+                            (worker.pid, worker.exitcode))
+        if slot is not None:
+            self.free_slots.append(slot)
+        else:
+            self.oversized -= 1
+        return task_id, ok, result
+
+    def get_result(self):
+        """Wait for a result, in the order they are ready.
+
+        :returns: A tuple of (tag, result)
+        :raises PayloadWorkerException: When the function raised an
+                                         exception in the worker, or
+                                         a worker process died.
+        """
+        if self.ready:
+            task_id, ok, result = self.ready.popleft()
+        else:
+            task_id, ok, result = self.receive_result()
+        tag = self.tags.pop(task_id)
+        if not ok:
+            raise PayloadWorkerException(result)
+        return tag, result
+
+    def iter_ready(self):
+        """Iterate the (tag, result) of the results already returned,
+        without waiting."""
+        while len(self) and not self.result_queue.empty():
+            self.ready.append(self.receive_result())
+        while self.ready:
+            yield self.get_result()
+
+    def iter_results(self):
+        """Iterate the (tag, result) of all the payloads submitted,
+        waiting for the workers."""
+        while self.tags:
+            yield self.get_result()
+
+    def close(self):
+        """Stop the workers, the results not received are lost."""
+        for worker in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.memory.close()
+
+def _worker_loop(memory, slot_size, task_queue, result_queue, function,
+                 command, raw, fields):
+    """The loop of the worker processes."""
+    serializer = MESSAGE_SERIALIZERS[command]
+    if fields is not None:
+        fields = serializer.projection(fields)
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, slot, length = task
+        if slot is None:
+            buffer, offset, length = length, 0, len(length)
+        else:
+            buffer, offset = memory, slot * slot_size
+        try:
+            if raw:
+                result = function(buffer, offset, length)
+            else:
+                result = function(serializer.deserialize_from(buffer,
+                    offset, fields)[0])
+        except Exception:
+            result_queue.put((task_id, slot, False, traceback.format_exc()))
+        else:
+            result_queue.put((task_id, slot, True, result))
+
+def summarize_block(buffer, offset, length):
+    """Summarize the raw payload of a block message, a compact result
+    for the PayloadWorkerPool (with raw=True).
+
+    :param buffer: The buffer with the payload
+    :param offset: The offset of the payload in the buffer
+    :param length: The length of the payload
+    :returns: A tuple of (block hash, txids, total output value), the
+              hashes being 32-byte strings.
+    """
+    sha256 = hashlib.sha256
+    header = buffer[offset:offset + 80]
+    if header.__class__ is not str:
+        header = str(header)
+    block_hash = sha256(sha256(header).digest()).digest()
+
+    tx_serializer = MESSAGE_SERIALIZERS["tx"]
+    values = tx_serializer.projection({"tx_out": ["value"]})
+    tx_count, tx_offset = unpack_varint_from(buffer, offset + 80)
+
+    txids = []
+    total_value = 0
+    for i in xrange(tx_count):
+        tx, tx_end = tx_serializer.deserialize_from(buffer, tx_offset, values)
+        data = buffer[tx_offset:tx_end]
+        if data.__class__ is not str:
+            data = str(data)
+        txids.append(sha256(sha256(data).digest()).digest())
+        total_value += sum(tx_out.value for tx_out in tx.tx_out)
+        tx_offset = tx_end
+    return block_hash, txids, total_value
@@ -0,0 +1,185 @@
+"""Fast path for the headers message. The block headers are sliced
+straight from the payload and hashed in a single pass, checking the
+proof of work and the prev_block linkage without creating the
+BlockHeader models.
+"""
+import struct
+import hashlib
+
+from . import fields
+from .fields import unpack_varint_from
+from .serializers import BlockHeaderSerializer
+
+#: The size of a serialized block header (without the txns_count)
+HEADER_SIZE = 80
+
+#: The maximum number of headers in a headers message
+MAX_HEADERS = 2000
+
+_header_bits = struct.Struct("<I")
+_header_timestamp = struct.Struct("<I")
+
+def bits_to_target(bits):
+    """Converts the compact representation of the proof of work
+    target (the bits field of the block header) to an integer.
+
+    :param bits: The bits of the block header
+    :returns: The target, or None for negative or overflowing targets
+    """
+    exponent = bits >> 24
+    mantissa = bits & 0x007fffff
+    if bits & 0x00800000 and mantissa:
+        return None
+    if exponent <= 3:
+        target = mantissa >> (8 * (3 - exponent))
+    else:
+        target = mantissa << (8 * (exponent - 3))
+    if target >> 256:
+        return None
+    return target
+
+def _target_bytes(bits):
+    """Returns the target of the bits as 32 big-endian bytes, so it
+    can be compared with the reversed hashes as strings."""
+    target = bits_to_target(bits)
+    if target is None:
+        return None
+    return fields.HashValue.from_int(target)[::-1]
+
+class HeaderBatch(object):
+    """The result of parse_headers(). The headers are kept as offsets
+    into the payload, use header() to deserialize a BlockHeader when
+    needed.
+
+    :param payload: The payload of the headers message
+    :param offsets: The offset of each header in the payload
+    :param hashes: The HashValue of each header
+    :param invalid_pow: The indexes of the headers whose hash is above
+                        their target
+    :param broken_link: The index of the first header whose prev_block
+                        isn't the hash of the previous header, or None
+    """
+    header_serializer = BlockHeaderSerializer()
+
+    def __init__(self, payload, offsets, hashes, invalid_pow, broken_link):
+        self.payload = payload
+        self.offsets = offsets
+        self.hashes = hashes
+        self.invalid_pow = invalid_pow
+        self.broken_link = broken_link
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __repr__(self):
+        return "<%s Count=[%d] Valid=[%s]>" % (self.__class__.__name__,
+            len(self), self.is_valid())
+
+    def is_valid(self):
+        """Returns True when all the headers have a valid proof of work
+        and are linked."""
+        return not self.invalid_pow and self.broken_link is None
+
+    @property
+    def prev_block(self):
+        """The prev_block of the first header, as a HashValue."""
+        offset = self.offsets[0] + 4
+        return fields.HashValue(fields.read_bytes_from(self.payload,
+            offset, 32))
+
+    @property
+    def last_hash(self):
+        """The hash of the last header, as a HashValue."""
+        return self.hashes[-1]
+
+    def bits(self, index):
+        """Returns the bits of a header."""
+        return _header_bits.unpack_from(self.payload,
+            self.offsets[index] + 72)[0]
+
+    def timestamp(self, index):
+        """Returns the timestamp of a header."""
+        return _header_timestamp.unpack_from(self.payload,
+            self.offsets[index] + 68)[0]
+
+    def header(self, index):
+        """Deserialize a header of the batch.
+
+        :param index: The index of the header
+        :returns: A BlockHeader
+        """
+        return self.header_serializer.deserialize_from(self.payload,
+            self.offsets[index])[0]
+
+    def __iter__(self):
+        for index in xrange(len(self.offsets)):
+            yield self.header(index)
+
+def parse_headers(payload, prev_hash=None, check_pow=True):
+    """Parse the payload of a headers message (up to 2000 headers of
+    81 bytes), hashing each header and checking its proof of work and
+    the prev_block linkage. Example of use::
+
+        class HeadersClient(BitcoinClient):
+            def handle_raw_headers(self, message_header, payload):
+                batch = parse_headers(payload, self.tip)
+                if batch.is_valid() and len(batch):
+                    self.tip = batch.last_hash
+
+    :param payload: The payload of the headers message, it can be a
+                    string, bytearray, memoryview or mmap.
+    :param prev_hash: The hash expected in the prev_block of the first
+                      header, None to not check it.
+    :param check_pow: When False the proof of work isn't checked.
+    :returns: A HeaderBatch
+    :raises ValueError: when the message has more than MAX_HEADERS
+                        headers.
+    """
+    count, offset = unpack_varint_from(payload, 0)
+    if count > MAX_HEADERS:
+        raise ValueError("Too many headers in the message: %d" % count)
+    if len(payload) == offset + count * (HEADER_SIZE + 1):
+        # The txns_count of all the headers is a single byte
+        offsets = range(offset, len(payload), HEADER_SIZE + 1)
+    else:
+        offsets = []
+        for i in xrange(count):
+            offsets.append(offset)
+            unused, offset = unpack_varint_from(payload, offset + HEADER_SIZE)
+
+    sha256 = hashlib.sha256
+    HashValue = fields.HashValue
+    targets = {}
+    hashes = []
+    append_hash = hashes.append
+    invalid_pow = []
+    broken_link = None
+    if prev_hash is not None:
+        prev_hash = str(fields.hash_to_bytes(prev_hash))
+
+    for index, offset in enumerate(offsets):
+        header = payload[offset:offset + HEADER_SIZE]
+        if type(header) is memoryview:
+            header = header.tobytes()
+        elif type(header) is not str:
+            header = str(header)
+        if len(header) != HEADER_SIZE:
+            raise struct.error("unpack requires a string argument of length %d"
+                % HEADER_SIZE)
+        block_hash = sha256(sha256(header).digest()).digest()
+        if broken_link is None and prev_hash is not None and \
+                not header.startswith(prev_hash, 4):
+            broken_link = index
+        if check_pow:
+            bits = header[72:76]
+            target = targets.get(bits, False)
+            if target is False:
+                target = _target_bytes(_header_bits.unpack(bits)[0])
+                targets[bits] = target
+            # Big-endian strings of the same size compare as integers
+            if target is None or block_hash[::-1] > target:
+                invalid_pow.append(index)
+        prev_hash = block_hash
+        append_hash(HashValue(block_hash))
+
+    return HeaderBatch(payload, offsets, hashes, invalid_pow, broken_link)
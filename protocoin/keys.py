@@ -1,9 +1,16 @@
+import hmac
+import struct
 import binascii
 import hashlib
+import multiprocessing
 
 import ecdsa
+from ecdsa import ellipticcurve
 from . import util
 
+#: The first index of the hardened child keys (BIP 32)
+HARDENED = 0x80000000
+
 class BitcoinPublicKey(object):
     """This is a representation for Bitcoin public keys. In this
     class you'll find methods to import/export keys from multiple
@@ -182,5 +189,326 @@ class BitcoinPrivateKey(object):
     def __repr__(self):
         return "<BitcoinPrivateKey hexkey=[%s]>" % self.to_hex()
 
+_curve = ecdsa.SECP256k1
+_index_struct = struct.Struct(">I")
+
+def _compress_point(point):
+    """Returns the compressed serialization of a curve point."""
+    if hasattr(point, "to_affine"):
+        # The Jacobian points of the newer ecdsa versions would compute
+        # the inverse of z for each coordinate.
+        point = point.to_affine()
+    return chr(2 + (point.y() & 1)) + binascii.unhexlify("%064x" % point.x())
+
+def _decompress_point(key_string):
+    """Returns the curve point of a compressed public key."""
+    curve = _curve.curve
+    prime = curve.p()
+    x = int(binascii.hexlify(key_string[1:]), 16)
+    y = pow((pow(x, 3, prime) + curve.b()) % prime, (prime + 1) // 4, prime)
+    if (y & 1) != ord(key_string[0]) - 2:
+        y = prime - y
+    if not curve.contains_point(x, y):
+        raise ValueError("Invalid public key.")
+    return ellipticcurve.Point(curve, x, y, _curve.order)
+
+def _derive_public(chain_code, public_key, point, index):
+    """Derive the public child key (CKDpub of BIP 32) of a key.
+
+    :returns: A tuple of (chain code, compressed public key, point)
+    """
+    digest = hmac.new(chain_code, public_key + _index_struct.pack(index),
+        hashlib.sha512).digest()
+    tweak = int(binascii.hexlify(digest[:32]), 16)
+    if tweak >= _curve.order:
+        raise ValueError("Invalid child key %d, use the next index." % index)
+    child_point = _curve.generator * tweak + point
+    if child_point == ellipticcurve.INFINITY:
+        raise ValueError("Invalid child key %d, use the next index." % index)
+    return digest[32:], _compress_point(child_point), child_point
+
+class ExtendedKey(object):
+    """This is a representation for the BIP 32 extended keys (xprv
+    and xpub), deriving trees of keys from a seed. The child keys are
+    kept in a cache of their parent, so the keys sharing a path (the
+    addresses of an account, for instance) derive the parent keys
+    only once.
+
+    Example of use::
+
+        master = ExtendedKey.from_seed(seed)
+        account = master.derive("m/44'/0'/0'")
+        print account.neuter().to_string()
+        receiving = account.derive("0")
+        public_keys = receiving.derive_range(0, 100000)
+
+    :param chain_code: The chain code (32 bytes)
+    :param private_key: The private key (an integer), None for the
+                        public extended keys.
+    :param public_key: The compressed public key (33 bytes), computed
+                       from the private key when omitted.
+    :param depth: The depth of the key in the tree
+    :param parent_fingerprint: The fingerprint of the parent key
+    :param child_number: The index of the key in its parent
+    """
+    xprv_prefix = '\x04\x88\xad\xe4'
+    xpub_prefix = '\x04\x88\xb2\x1e'
+
+    #: The maximum number of child keys kept by each key
+    cache_size = 1024
+
+    def __init__(self, chain_code, private_key=None, public_key=None,
+                 depth=0, parent_fingerprint='\x00' * 4, child_number=0):
+        if private_key is None and public_key is None:
+            raise ValueError("A private or a public key is required.")
+        self.chain_code = chain_code
+        self.private_key = private_key
+        self.depth = depth
+        self.parent_fingerprint = parent_fingerprint
+        self.child_number = child_number
+        self._public_key = public_key
+        self._point = None
+        self._fingerprint = None
+        self.children = {}
+
+    @classmethod
+    def from_seed(klass, seed):
+        """This method will create the master key of a seed.
+
+        :param seed: The seed (16 to 64 bytes)
+        :returns: A new private Extended Key
+        """
+        digest = hmac.new("Bitcoin seed", seed, hashlib.sha512).digest()
+        private_key = int(binascii.hexlify(digest[:32]), 16)
+        if not 0 < private_key < _curve.order:
+            raise ValueError("Invalid master key, use another seed.")
+        return klass(digest[32:], private_key)
 
+    @classmethod
+    def from_string(klass, xkey):
+        """This method will import an extended key from its base58
+        representation (xprv or xpub).
 
+        :param xkey: The extended key in base58
+        :returns: A new Extended Key
+        """
+        data = util.base58check_decode(xkey)
+        if len(data) != 78:
+            raise ValueError("Invalid extended key length.")
+        prefix = data[:4]
+        depth = ord(data[4])
+        parent_fingerprint = data[5:9]
+        child_number, = _index_struct.unpack(data[9:13])
+        chain_code = data[13:45]
+        key = data[45:]
+        if prefix == klass.xprv_prefix and key[0] == '\x00':
+            private_key = int(binascii.hexlify(key[1:]), 16)
+            if not 0 < private_key < _curve.order:
+                raise ValueError("Invalid extended private key.")
+            return klass(chain_code, private_key, None, depth,
+                parent_fingerprint, child_number)
+        elif prefix == klass.xpub_prefix and key[0] in '\x02\x03':
+            _decompress_point(key)
+            return klass(chain_code, None, key, depth, parent_fingerprint,
+                child_number)
+        raise ValueError("Invalid extended key version.")
+
+    def is_private(self):
+        """Returns True for the private extended keys (xprv)."""
+        return self.private_key is not None
+
+    @property
+    def point(self):
+        """The curve point of the public key."""
+        if self._point is None:
+            if self._public_key is not None:
+                self._point = _decompress_point(self._public_key)
+            else:
+                self._point = _curve.generator * self.private_key
+        return self._point
+
+    @property
+    def public_key(self):
+        """The compressed public key (33 bytes)."""
+        if self._public_key is None:
+            self._public_key = _compress_point(self.point)
+        return self._public_key
+
+    def identifier(self):
+        """Returns the identifier of the key, the hash160 of the
+        public key."""
+        return util.hash160(self.public_key)
+
+    def fingerprint(self):
+        """Returns the fingerprint of the key (4 bytes)."""
+        if self._fingerprint is None:
+            self._fingerprint = self.identifier()[:4]
+        return self._fingerprint
+
+    def child(self, index):
+        """This method will derive a child key, the private keys can
+        derive the hardened children (index >= HARDENED) and the
+        public keys only the normal ones.
+
+        :param index: The index of the child
+        :returns: The child Extended Key
+        """
+        child = self.children.get(index)
+        if child is not None:
+            return child
+        if not 0 <= index <= 0xFFFFFFFF:
+            raise ValueError("Invalid child index: %d" % index)
+
+        if self.private_key is not None:
+            if index >= HARDENED:
+                data = '\x00' + binascii.unhexlify("%064x" % self.private_key)
+            else:
+                data = self.public_key
+            digest = hmac.new(self.chain_code,
+                data + _index_struct.pack(index), hashlib.sha512).digest()
+            chain_code = digest[32:]
+            tweak = int(binascii.hexlify(digest[:32]), 16)
+            private_key = (tweak + self.private_key) % _curve.order
+            if tweak >= _curve.order or not private_key:
+                raise ValueError("Invalid child key %d, use the next index." %
+                    index)
+            public_key = point = None
+        elif index >= HARDENED:
+            raise ValueError("Hardened keys require a private key.")
+        else:
+            chain_code, public_key, point = _derive_public(self.chain_code,
+                self.public_key, self.point, index)
+            private_key = None
+
+        child = ExtendedKey(chain_code, private_key, public_key,
+            self.depth + 1, self.fingerprint(), index)
+        child._point = point
+        if len(self.children) >= self.cache_size:
+            self.children.clear()
+        self.children[index] = child
+        return child
+
+    def derive(self, path):
+        """This method will derive a descendant key, the intermediate
+        keys are kept in the cache.
+
+        :param path: The path, like "m/44'/0'/0'/0/1" (the ' or h
+                     suffix marks the hardened indexes), relative to
+                     this key when it doesn't start with "m", or a list
+                     of indexes.
+        :returns: The Extended Key
+        """
+        if isinstance(path, basestring):
+            parts = [part for part in path.split("/") if part]
+            if parts and parts[0] == "m":
+                if self.depth:
+                    raise ValueError("The key isn't a master key.")
+                parts = parts[1:]
+            indexes = []
+            for part in parts:
+                if part[-1] in "'hH":
+                    indexes.append(int(part[:-1]) + HARDENED)
+                else:
+                    indexes.append(int(part))
+        else:
+            indexes = path
+
+        key = self
+        for index in indexes:
+            key = key.child(index)
+        return key
+
+    def derive_range(self, start, stop, processes=None, batch_size=1000,
+                     addresses=False):
+        """This method will derive the public keys of a range of
+        (normal) child keys, optionally in a pool of processes. Only
+        the public key and the chain code are sent to the workers.
+
+        :param start: The first index
+        :param stop: The index after the last one
+        :param processes: The number of worker processes, None for the
+                          number of CPUs, 0 to derive in the calling
+                          process.
+        :param batch_size: The number of keys derived by a worker at
+                           once.
+        :param addresses: When True, the addresses of the keys are
+                          returned instead of the public keys.
+        :returns: A list with the compressed public keys (or the
+                  addresses) of the children, in the order of their
+                  indexes.
+        """
+        if start < 0 or stop > HARDENED:
+            raise ValueError("Only the normal child keys can be derived.")
+        tasks = [(self.chain_code, self.public_key, i,
+                min(i + batch_size, stop), addresses)
+            for i in xrange(start, stop, batch_size)]
+        if processes == 0 or len(tasks) <= 1:
+            batches = map(_derive_batch, tasks)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                batches = pool.map(_derive_batch, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        results = []
+        for batch in batches:
+            results.extend(batch)
+        return results
+
+    def neuter(self):
+        """Returns the public extended key of this key."""
+        key = ExtendedKey(self.chain_code, None, self.public_key, self.depth,
+            self.parent_fingerprint, self.child_number)
+        key._point = self._point
+        return key
+
+    def to_string(self):
+        """This method will export the key to its base58
+        representation, xprv for the private keys and xpub for the
+        public keys.
+
+        :returns: The extended key in base58
+        """
+        if self.private_key is not None:
+            prefix = self.xprv_prefix
+            key = '\x00' + binascii.unhexlify("%064x" % self.private_key)
+        else:
+            prefix = self.xpub_prefix
+            key = self.public_key
+        data = prefix + chr(self.depth) + self.parent_fingerprint + \
+            _index_struct.pack(self.child_number) + self.chain_code + key
+        return util.base58check_encode(data)
+
+    def to_private_key(self):
+        """Returns the BitcoinPrivateKey of this key."""
+        if self.private_key is None:
+            raise ValueError("The key isn't a private key.")
+        return BitcoinPrivateKey("%064x" % self.private_key)
+
+    def to_address(self):
+        """This method will convert the (compressed) public key to a
+        bitcoin address.
+
+        :returns: bitcoin address for the public key
+        """
+        return util.base58check_encode('\x00' + self.identifier())
+
+    def __repr__(self):
+        return "<ExtendedKey %s depth=[%d] child=[%d]>" % \
+            ("xprv" if self.private_key is not None else "xpub",
+                self.depth, self.child_number)
+
+def _derive_batch(task):
+    """Derive a range of public child keys in a worker process."""
+    chain_code, public_key, start, stop, addresses = task
+    point = _decompress_point(public_key)
+    results = []
+    for index in xrange(start, stop):
+        child_public_key = _derive_public(chain_code, public_key, point,
+            index)[1]
+        if addresses:
+            child_public_key = util.base58check_encode('\x00' +
+                util.hash160(child_public_key))
+        results.append(child_public_key)
+    return results
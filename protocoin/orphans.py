@@ -0,0 +1,239 @@
+"""The pool of orphan transactions: the transactions received before
+their parents, kept until the parents arrive instead of being dropped
+and requested again.
+"""
+import time
+import random
+from collections import OrderedDict, deque
+
+from . import fields
+from .serializers import MESSAGE_SERIALIZERS
+
+class OrphanEntry(object):
+    """An orphan transaction of the OrphanPool."""
+    __slots__ = ("tx", "txid", "size", "time", "peer", "missing")
+
+    def __init__(self, tx, txid, size, time, peer, missing):
+        self.tx = tx
+        self.txid = txid
+        self.size = size
+        self.time = time
+        self.peer = peer
+        self.missing = missing
+
+    def __repr__(self):
+        return "<%s Hash=[%064x] Size=[%d] Missing=[%d]>" % \
+            (self.__class__.__name__, self.txid, self.size,
+                len(self.missing))
+
+class OrphanPool(object):
+    """This class keeps the orphan transactions indexed by the hashes
+    of their missing parents (the out_hash of the OutPoint of their
+    inputs). When a parent is accepted, release() returns the orphans
+    that have no more missing parents, with their own orphan children,
+    in topological order (each parent before its children). Random
+    orphans are evicted when the pool is full, so a peer sending many
+    orphans can't choose which ones are evicted, and the orphans older
+    than expire_time are removed by expire().
+
+    Example of use::
+
+        orphans = OrphanPool()
+
+        def handle_tx(self, message_header, tx):
+            missing = [tx_in.previous_output.out_hash
+                for tx_in in tx.tx_in
+                if tx_in.previous_output.out_hash not in mempool]
+            if missing:
+                orphans.add(tx, missing, peer=self)
+                return
+            if not mempool.accept(tx):
+                return
+            txid = tx.calculate_hash_value()
+            for child in orphans.release(txid, mempool.accept):
+                print "Accepted orphan", child
+
+    :param max_orphans: The maximum number of orphans in the pool
+    :param max_size: The maximum total size (in bytes) of the orphans
+    :param max_tx_size: The size (in bytes) of the largest orphan
+                        accepted in the pool.
+    :param expire_time: The time (in seconds) after which the orphans
+                        are removed by expire().
+    """
+    def __init__(self, max_orphans=100, max_size=5 * 1000 * 1000,
+                 max_tx_size=100 * 1000, expire_time=20 * 60.0):
+        self.max_orphans = max_orphans
+        self.max_size = max_size
+        self.max_tx_size = max_tx_size
+        self.expire_time = expire_time
+        self.orphans = OrderedDict()
+        self.by_parent = {}
+        self.total_size = 0
+        self.added = 0
+        self.released = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.orphans)
+
+    def __contains__(self, txid):
+        return fields.hash_to_bytes(txid) in self.orphans
+
+    def get(self, txid):
+        """Returns the orphan transaction of a hash, or None."""
+        entry = self.orphans.get(fields.hash_to_bytes(txid))
+        return entry.tx if entry is not None else None
+
+    def get_missing(self):
+        """Returns the list of the hashes of the missing parents, the
+        transactions to request from the peers."""
+        return self.by_parent.keys()
+
+    def add(self, tx, missing=None, peer=None, txid=None, size=None,
+            now=None):
+        """Add an orphan transaction, evicting random orphans (maybe
+        this one) when the pool is full.
+
+        :param tx: The Tx
+        :param missing: The hashes of the parents not known by the
+                        caller, all the parents when omitted.
+        :param peer: The peer that sent the transaction, see
+                     remove_peer()
+        :param txid: The hash of the transaction, computed when omitted
+        :param size: The size (in bytes) of the transaction, computed
+                     when omitted.
+        :param now: The current time, time.time() when omitted
+        :returns: True if the transaction was added
+        """
+        if txid is None:
+            txid = tx.calculate_hash_value()
+        txid = fields.hash_to_bytes(txid)
+        if txid in self.orphans:
+            return False
+        if size is None:
+            size = MESSAGE_SERIALIZERS["tx"].serialized_size(tx)
+        if size > self.max_tx_size:
+            return False
+        if missing is None:
+            missing = [tx_in.previous_output.out_hash for tx_in in tx.tx_in]
+        missing = set(fields.hash_to_bytes(parent) for parent in missing)
+        if not missing:
+            return False
+
+        entry = OrphanEntry(tx, txid, size,
+            now if now is not None else time.time(), peer, missing)
+        self.orphans[txid] = entry
+        self.total_size += size
+        for parent in missing:
+            children = self.by_parent.get(parent)
+            if children is None:
+                self.by_parent[parent] = children = set()
+            children.add(txid)
+        self.added += 1
+
+        while len(self.orphans) > self.max_orphans or \
+                self.total_size > self.max_size:
+            self.remove(random.choice(self.orphans.keys()))
+            self.evicted += 1
+        return txid in self.orphans
+
+    def remove(self, txid):
+        """Remove an orphan transaction.
+
+        :param txid: The hash of the transaction
+        :returns: The Tx removed, or None
+        """
+        entry = self.orphans.pop(fields.hash_to_bytes(txid), None)
+        if entry is None:
+            return None
+        self.total_size -= entry.size
+        for parent in entry.missing:
+            children = self.by_parent.get(parent)
+            if children is not None:
+                children.discard(entry.txid)
+                if not children:
+                    del self.by_parent[parent]
+        return entry.tx
+
+    def remove_peer(self, peer):
+        """Remove the orphans sent by a peer (when it disconnects).
+
+        :param peer: The peer given to add()
+        :returns: The number of orphans removed
+        """
+        txids = [entry.txid for entry in self.orphans.itervalues()
+            if entry.peer is peer]
+        for txid in txids:
+            self.remove(txid)
+        return len(txids)
+
+    def expire(self, now=None):
+        """Remove the orphans older than expire_time.
+
+        :param now: The current time, time.time() when omitted
+        :returns: The number of orphans removed
+        """
+        if now is None:
+            now = time.time()
+        limit = now - self.expire_time
+        count = 0
+        while self.orphans:
+            oldest = next(self.orphans.itervalues())
+            if oldest.time > limit:
+                break
+            self.remove(oldest.txid)
+            count += 1
+        self.expired += count
+        return count
+
+    def release(self, txid, accept=None):
+        """Release the orphans waiting for a parent transaction, once
+        it is accepted. The orphans without other missing parents are
+        removed from the pool and released, then their own children,
+        in topological order.
+
+        :param txid: The hash of the parent transaction accepted
+        :param accept: A callable receiving each orphan released and
+                       returning True if it is accepted, the children
+                       of the orphans not accepted aren't released.
+                       When omitted, all the orphans are accepted.
+        :returns: The list of the Tx accepted, each parent before its
+                  children.
+        """
+        accepted = []
+        parents = deque([fields.hash_to_bytes(txid)])
+        while parents:
+            parent = parents.popleft()
+            children = self.by_parent.pop(parent, None)
+            if not children:
+                continue
+            ready = []
+            for child in children:
+                entry = self.orphans[child]
+                entry.missing.discard(parent)
+                if not entry.missing:
+                    ready.append(entry)
+            # Release in the order the orphans were received
+            ready.sort(key=lambda entry: entry.time)
+            for entry in ready:
+                self.remove(entry.txid)
+                self.released += 1
+                if accept is None or accept(entry.tx):
+                    accepted.append(entry.tx)
+                    parents.append(entry.txid)
+        return accepted
+
+    def get_stats(self):
+        """Returns a dict with the size of the pool (orphans, bytes,
+        missing parents) and the number of orphans added, released,
+        evicted and expired."""
+        return {
+            "orphans": len(self.orphans),
+            "size": self.total_size,
+            "missing_parents": len(self.by_parent),
+            "added": self.added,
+            "released": self.released,
+            "evicted": self.evicted,
+            "expired": self.expired,
+        }
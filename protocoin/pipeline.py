@@ -0,0 +1,295 @@
+"""A multi-stage pipeline to process the messages received by the
+clients. Each stage runs a function in a number of threads (or
+processes) and the stages are linked by bounded queues, so a slow
+stage blocks the previous ones and, through the PipelineClient, the
+reading of the socket: the memory used stays bounded during bursts
+of messages.
+"""
+import time
+import threading
+import multiprocessing
+from Queue import Queue, Full
+from collections import deque
+
+from .clients import BitcoinClient
+from .serializers import MESSAGE_SERIALIZERS
+
+#: The item sent through the queues to stop the workers
+_STOP = object()
+
+def decode_message(item):
+    """A stage function that deserializes the (command, payload)
+    items put by the PipelineClient.
+
+    :param item: A tuple of (command, payload)
+    :returns: The message deserialized
+    """
+    command, payload = item
+    return MESSAGE_SERIALIZERS[command].deserialize_from(payload)[0]
+
+class Stage(object):
+    """A stage of the Pipeline. The function receives each item of the
+    stage and its result is sent to the next stage, the None results
+    are dropped. With many workers, the order of the items isn't kept.
+    The items whose function raises an exception are dropped too, the
+    exceptions are counted and the last one is kept in last_error
+    (see get_stats()).
+
+    :param name: The name of the stage, used in the statistics
+    :param function: The callable receiving each item
+    :param workers: The number of worker threads, or processes
+    :param queue_size: The maximum number of items waiting in the
+                       queue of the stage.
+    :param processes: When True, the function is run in a pool of
+                      worker processes, it must be defined at the
+                      module level and the items and results must
+                      be picklable, return compact results (see
+                      handoff.summarize_block()) instead of models.
+    """
+    def __init__(self, name, function, workers=1, queue_size=64,
+                 processes=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue_size = queue_size
+        self.processes = processes
+        self.queue = Queue(queue_size)
+        self.next_stage = None
+        self.pool = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.running = 0
+        self.received = 0
+        self.produced = 0
+        self.errors = 0
+        self.last_error = None
+        self.busy_time = 0.0
+
+    def __repr__(self):
+        return "<%s Name=[%s] Workers=[%d] Queue=[%d/%d]>" % \
+            (self.__class__.__name__, self.name, self.workers,
+                self.queue.qsize(), self.queue_size)
+
+    def prepare(self, next_stage):
+        """Link the stage to the next one and create the pool of
+        processes, before any worker thread is started.
+
+        :param next_stage: The Stage receiving the results, or None
+        """
+        self.next_stage = next_stage
+        if self.processes:
+            self.pool = multiprocessing.Pool(self.workers)
+
+    def start(self):
+        """Start the worker threads of the stage."""
+        self.running = self.workers
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.run,
+                name="%s-%d" % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        """The loop of the worker threads."""
+        queue = self.queue
+        next_stage = self.next_stage
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                break
+            start = time.time()
+            try:
+                if self.pool is not None:
+                    result = self.pool.apply(self.function, (item,))
+                else:
+                    result = self.function(item)
+            except Exception as exc:
+                with self.lock:
+                    self.errors += 1
+                    self.last_error = exc
+                continue
+            finally:
+                elapsed = time.time() - start
+                with self.lock:
+                    self.received += 1
+                    self.busy_time += elapsed
+            if result is None:
+                continue
+            with self.lock:
+                self.produced += 1
+            if next_stage is not None:
+                next_stage.queue.put(result)
+
+        with self.lock:
+            self.running -= 1
+            last_worker = not self.running
+        if last_worker:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            if next_stage is not None:
+                next_stage.stop()
+
+    def stop(self):
+        """Stop the workers after the items already queued."""
+        for i in xrange(self.workers):
+            self.queue.put(_STOP)
+
+    def join(self):
+        """Wait for the workers to stop."""
+        for thread in self.threads:
+            thread.join()
+
+    def get_stats(self, elapsed):
+        """Returns a dict with the statistics of the stage.
+
+        :param elapsed: The time (in seconds) since the start
+        """
+        with self.lock:
+            elapsed = max(elapsed, 1e-6)
+            return {
+                "name": self.name,
+                "queue_depth": self.queue.qsize(),
+                "queue_size": self.queue_size,
+                "received": self.received,
+                "produced": self.produced,
+                "errors": self.errors,
+                "last_error": self.last_error,
+                "throughput": self.received / elapsed,
+                "utilization": self.busy_time / (elapsed * self.workers),
+            }
+
+class Pipeline(object):
+    """The pipeline of stages, the items put in the pipeline go to the
+    first stage and the results of each stage go to the next one.
+
+    Example of use::
+
+        header_fields = MESSAGE_SERIALIZERS["block"].projection(
+            ["version", "prev_block", "merkle_root", "timestamp", "bits",
+             "nonce"])
+
+        def store(item):
+            # Check the proof of work and archive the original payload
+            command, payload = item
+            header = MESSAGE_SERIALIZERS["block"].deserialize_from(payload,
+                0, header_fields)[0]
+            block_hash = header.calculate_hash_value()
+            target = bits_to_target(header.bits)
+            if target is None or int(block_hash) > target:
+                return None
+            archive.append(payload, block_hash=block_hash)
+            return payload
+
+        def summarize(payload):
+            # Only the compact summary is sent back by the processes
+            return summarize_block(payload, 0, len(payload))
+
+        def index(summary):
+            block_hash, txids, total_value = summary
+            for txid in txids:
+                tx_index[txid] = block_hash
+
+        pipeline = Pipeline([
+            Stage("store", store),
+            Stage("summarize", summarize, workers=4, processes=True),
+            Stage("index", index),
+        ])
+        pipeline.start()
+        client = PipelineClient(sock, pipeline, commands=("block",))
+        client.handshake()
+        client.loop()
+
+    :param stages: The list of Stage
+    """
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.start_time = None
+
+    def start(self):
+        """Start the workers of all the stages."""
+        # The processes are forked before starting the threads
+        next_stage = None
+        for stage in reversed(self.stages):
+            stage.prepare(next_stage)
+            next_stage = stage
+        self.start_time = time.time()
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item, block=True, timeout=None):
+        """Put an item in the queue of the first stage.
+
+        :param item: The item
+        :param block: When False, return instead of waiting when the
+                      queue is full.
+        :param timeout: The maximum time (in seconds) to wait
+        :returns: True if the item was queued
+        """
+        try:
+            self.stages[0].queue.put(item, block, timeout)
+        except Full:
+            return False
+        return True
+
+    def close(self):
+        """Process the items queued and stop the workers of all the
+        stages."""
+        self.stages[0].stop()
+        for stage in self.stages:
+            stage.join()
+
+    def get_stats(self):
+        """Returns a list with the statistics of each stage, a dict
+        with the name, queue_depth, queue_size, received, produced,
+        errors, last_error (the last exception raised by the function
+        of the stage, or None), throughput (items per second) and
+        utilization (the busy fraction of the workers) of the stage."""
+        elapsed = time.time() - self.start_time
+        return [stage.get_stats(elapsed) for stage in self.stages]
+
+class PipelineClient(BitcoinClient):
+    """A client putting the (command, payload) of the messages of some
+    commands in a Pipeline, the payloads aren't deserialized by the
+    client (see decode_message()). When the first stage of the pipeline
+    is full, the client stops reading the socket until it has room.
+
+    :param socket: The socket connected to the node
+    :param pipeline: The Pipeline receiving the messages
+    :param commands: The commands sent to the pipeline
+    """
+    def __init__(self, socket, pipeline, commands=("block", "tx"), **kwargs):
+        self.pipeline = pipeline
+        self.pipeline_pending = deque()
+        super(PipelineClient, self).__init__(socket, **kwargs)
+        for command in commands:
+            self.register_handler(command, self.handle_pipeline_payload,
+                raw=True)
+
+    def handle_pipeline_payload(self, message_header, payload):
+        """This method will queue the payload of the messages sent to
+        the pipeline.
+
+        :param message_header: The message header
+        :param payload: The payload of the message
+        """
+        self.pipeline_pending.append((message_header.command, payload))
+        self.flush_pipeline()
+
+    def flush_pipeline(self, block=False):
+        """Put the pending messages in the pipeline, while it has room.
+        Call it with block=True after the loop() ends, so the messages
+        received before a disconnection aren't lost.
+
+        :param block: When True, wait for room for all the messages
+        """
+        pending = self.pipeline_pending
+        while pending:
+            if not self.pipeline.put(pending[0], block=block):
+                return
+            pending.popleft()
+
+    def receive_paused(self):
+        self.flush_pipeline()
+        return bool(self.pipeline_pending)
@@ -8,15 +8,48 @@ from collections import OrderedDict
 from . import fields
 from . import util
 
+_skip_bytes = fields.skip_bytes
+
 class SerializerMeta(type):
     """The serializer meta class. This class will create an attribute
     called '_fields' in each serializer with the ordered dict of
-    fields present on the subclasses.
+    fields present on the subclasses, and an attribute called
+    '_field_items' with the same (name, field) pairs in a tuple,
+    which is faster to iterate. The sum of the sizes of the fixed
+    size fields is kept in '_fixed_size' and the other fields in
+    '_variable_field_items'. The '_skip_items' attribute has a tuple
+    of (size, field) pairs used to skip the binary data: the size of
+    the fixed size fields before each variable size field.
     """
     def __new__(meta, name, bases, attrs):
         attrs["_fields"] = meta.get_fields(bases, attrs, fields.Field)
+        field_items = tuple(attrs["_fields"].items())
+        attrs["_field_items"] = field_items
+        attrs["_fixed_size"] = sum(field_obj.fixed_size
+            for field_name, field_obj in field_items
+            if field_obj.fixed_size is not None)
+        attrs["_variable_field_items"] = tuple((field_name, field_obj)
+            for field_name, field_obj in field_items
+            if field_obj.fixed_size is None)
+        attrs["_skip_items"] = meta.get_skip_items(field_items)
         return super(SerializerMeta, meta).__new__(meta, name, bases, attrs)
 
+    @staticmethod
+    def get_skip_items(field_items):
+        """This method will group the fixed size fields preceding
+        each variable size field."""
+        skip_items = []
+        size = 0
+        for field_name, field_obj in field_items:
+            if field_obj.fixed_size is not None:
+                size += field_obj.fixed_size
+            else:
+                skip_items.append((size, field_obj))
+                size = 0
+        if size:
+            skip_items.append((size, None))
+        return tuple(skip_items)
+
     @classmethod
     def get_fields(meta, bases, attrs, field_class):
         """This method will construct an ordered dict with all
@@ -32,6 +65,22 @@ class SerializerMeta(type):
         fields.sort(key=lambda it: it[1].count)
         return OrderedDict(fields)
 
+class Projection(object):
+    """The fields of a serializer selected to be deserialized, see
+    Serializer.projection(). Each item is a tuple of (field name,
+    field, nested projection, skip size), the items with no field
+    name are skipped: by skip size bytes for the runs of fixed size
+    fields or using the skip methods of the field otherwise.
+    """
+    __slots__ = ("items",)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __repr__(self):
+        return "<%s Fields=[%s]>" % (self.__class__.__name__,
+            ", ".join(item[0] for item in self.items if item[0]))
+
 class SerializerABC(object):
     """The serializer abstract base class."""
     __metaclass__ = SerializerMeta
@@ -52,44 +101,278 @@ class Serializer(SerializerABC):
         :param obj: The object to serializer.
         """
         bin_data = StringIO()
-        for field_name, field_obj in self._fields.iteritems():
+        for field_name, field_obj in self._field_items:
             if fields:
                 if field_name not in fields:
                     continue
             attr = getattr(obj, field_name, None)
-            field_obj.parse(attr)
-            bin_data.write(field_obj.serialize())
+            bin_data.write(field_obj.serialize(attr))
 
         return bin_data.getvalue()
 
-    def deserialize(self, stream):
+    def deserialize(self, stream, fields=None):
         """This method will read the stream and then will deserialize the
         binary data information present on it.
 
         :param stream: A file-like object (StringIO, file, socket, etc.)
+        :param fields: The fields to deserialize (see projection()),
+                       the other fields are skipped and keep the
+                       default value of the model.
         """
         model = self.model_class()
-        for field_name, field_obj in self._fields.iteritems():
-            value = field_obj.deserialize(stream)
-            setattr(model, field_name, value)
+        if fields is None:
+            for field_name, field_obj in self._field_items:
+                value = field_obj.deserialize(stream)
+                setattr(model, field_name, value)
+            return model
+
+        if not isinstance(fields, Projection):
+            fields = self.projection(fields)
+        for field_name, field_obj, nested, skip_size in fields.items:
+            if field_name is None:
+                if skip_size is not None:
+                    _skip_bytes(stream, skip_size)
+                else:
+                    field_obj.skip(stream)
+            elif nested is None:
+                setattr(model, field_name, field_obj.deserialize(stream))
+            else:
+                setattr(model, field_name,
+                    field_obj.deserialize(stream, nested))
         return model
 
+    def deserialize_from(self, buffer, offset=0, fields=None):
+        """This method will deserialize the binary data present in the
+        buffer at the specified offset. The buffer is never copied, so
+        this method is faster than deserialize() and it can be used to
+        parse objects out of large buffers.
+
+        :param buffer: A str, bytearray, memoryview or mmap object
+        :param offset: The offset of the binary data in the buffer
+        :param fields: The fields to deserialize (see projection()),
+                       the other fields are skipped and keep the
+                       default value of the model.
+        :returns: A tuple with the object and the offset where the
+                  binary data of the object ends
+        """
+        model = self.model_class()
+        if fields is None:
+            for field_name, field_obj in self._field_items:
+                value, offset = field_obj.deserialize_from(buffer, offset)
+                setattr(model, field_name, value)
+            return model, offset
+
+        if not isinstance(fields, Projection):
+            fields = self.projection(fields)
+        for field_name, field_obj, nested, skip_size in fields.items:
+            if field_name is None:
+                if skip_size is not None:
+                    offset += skip_size
+                else:
+                    offset = field_obj.skip_from(buffer, offset)
+            elif nested is None:
+                value, offset = field_obj.deserialize_from(buffer, offset)
+                setattr(model, field_name, value)
+            else:
+                value, offset = field_obj.deserialize_from(buffer, offset,
+                    nested)
+                setattr(model, field_name, value)
+        if offset > len(buffer):
+            raise struct.error("unpack_from requires a buffer of at least "
+                "%d bytes" % offset)
+        return model, offset
+
+    def projection(self, fields):
+        """This method will resolve the fields to deserialize, the
+        result can be passed to deserialize() and deserialize_from()
+        many times. The fields are a list of field names or a dict
+        mapping the field names to the fields to deserialize of the
+        nested and list fields (or None for all of them).
+
+        Example of use::
+
+            # Only the values of the outputs of each transaction
+            serializer = MESSAGE_SERIALIZERS["block"]
+            values = serializer.projection({"txns": {"tx_out": ["value"]}})
+            block, offset = serializer.deserialize_from(payload, 0, values)
+
+        :param fields: The fields to deserialize
+        :returns: A Projection
+        """
+        if isinstance(fields, Projection):
+            return fields
+        if not isinstance(fields, dict):
+            fields = dict.fromkeys(fields)
+        unknown = set(fields).difference(self._fields)
+        if unknown:
+            raise ValueError("Unknown fields for %s: %s" %
+                (self.__class__.__name__, ", ".join(sorted(unknown))))
+
+        items = []
+        for field_name, field_obj in self._field_items:
+            if field_name in fields:
+                nested = fields[field_name]
+                if nested is not None:
+                    nested_serializer = getattr(field_obj, "serializer", None)
+                    if nested_serializer is None:
+                        raise ValueError("The field %s has no nested fields"
+                            % field_name)
+                    nested = nested_serializer.projection(nested)
+                items.append((field_name, field_obj, nested, None))
+            elif field_obj.fixed_size is None:
+                items.append((None, field_obj, None, None))
+            elif items and items[-1][0] is None and \
+                    items[-1][3] is not None:
+                # Merge the runs of fixed size fields skipped
+                items[-1] = (None, None, None,
+                    items[-1][3] + field_obj.fixed_size)
+            else:
+                items.append((None, None, None, field_obj.fixed_size))
+        return Projection(tuple(items))
+
+    @classmethod
+    def intern_field(klass, field_name, intern_pool):
+        """Intern the strings deserialized by a variable string field
+        of the serializer, the field is shared by all the serializers
+        using it (the serializers of the messages nesting it too).
+
+        :param field_name: The name of the field
+        :param intern_pool: The InternPool, None to stop interning
+        """
+        field_obj = klass._fields.get(field_name)
+        if not isinstance(field_obj, fields.VariableStringField):
+            raise ValueError("%s isn't a variable string field of %s" %
+                (field_name, klass.__name__))
+        field_obj.intern_pool = intern_pool
+
+    def skip(self, stream):
+        """This method will advance the stream past the binary data of
+        an object without deserializing it.
+
+        :param stream: A file-like object (StringIO, file, socket, etc.)
+        """
+        for size, field_obj in self._skip_items:
+            if size:
+                _skip_bytes(stream, size)
+            if field_obj is not None:
+                field_obj.skip(stream)
+
+    def skip_from(self, buffer, offset=0):
+        """This method will return the offset where the binary data of
+        the object present in the buffer at the specified offset ends,
+        without deserializing it.
+
+        :param buffer: A str, bytearray, memoryview or mmap object
+        :param offset: The offset of the binary data in the buffer
+        """
+        for size, field_obj in self._skip_items:
+            offset += size
+            if field_obj is not None:
+                offset = field_obj.skip_from(buffer, offset)
+        return offset
+
+    def serialized_size(self, obj, fields=None):
+        """This method will compute the number of bytes needed to
+        serialize the object, without serializing it.
+
+        :param obj: The object to serialize.
+        :param fields: The names of the fields to serialize, all
+                       the fields are serialized when omitted.
+        """
+        if not fields:
+            size = self._fixed_size
+            for field_name, field_obj in self._variable_field_items:
+                attr = getattr(obj, field_name, None)
+                size += field_obj.serialized_size(attr)
+            return size
+
+        size = 0
+        for field_name, field_obj in self._field_items:
+            if field_name not in fields:
+                continue
+            attr = getattr(obj, field_name, None)
+            size += field_obj.serialized_size(attr)
+        return size
+
+    def serialize_into(self, obj, buffer, offset=0, fields=None):
+        """This method will serialize the object directly into the
+        buffer at the specified offset, the buffer must be large
+        enough to hold the serialized object (see serialized_size()).
+
+        :param obj: The object to serialize.
+        :param buffer: A bytearray, writable memoryview or mmap object
+        :param offset: The offset where the object will be written
+        :param fields: The names of the fields to serialize, all
+                       the fields are serialized when omitted.
+        :returns: The offset where the serialized object ends
+        """
+        for field_name, field_obj in self._field_items:
+            if fields:
+                if field_name not in fields:
+                    continue
+            attr = getattr(obj, field_name, None)
+            offset = field_obj.serialize_into(attr, buffer, offset)
+        return offset
+
+class SlottedModel(object):
+    """The base of the models using __slots__ to save memory. Without
+    __dict__ these models can't be pickled with the protocols 0 and 1,
+    so their state is provided as a dict of the slots set."""
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        state.update(getattr(self, "__dict__", {}))
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
+
 class SerializableMessage(object):
+    __slots__ = ()
+
     def get_message(self, coin="bitcoin"):
         """Get the binary version of this message, complete with header."""
-        message_header = MessageHeader(coin)
-        message_header_serial = MessageHeaderSerializer()
+        buffer = bytearray()
+        self.serialize_message_into(buffer, 0, coin)
+        return str(buffer)
+
+    def serialize_message_into(self, buffer, offset=0, coin="bitcoin"):
+        """Write the binary version of this message, complete with
+        header, into the buffer at the specified offset. The size of
+        the message is computed first and the buffer is extended when
+        needed, so the same bytearray can be reused for many messages.
+
+        :param buffer: A bytearray (or a large enough writable buffer)
+        :param offset: The offset where the message will be written
+        :param coin: The coin used to set the magic of the header
+        :returns: The offset where the message ends
+        """
+        serializer = MESSAGE_SERIALIZERS[self.command]
+        header_size = MessageHeaderSerializer.calcsize()
+        payload_offset = offset + header_size
+        payload_size = serializer.serialized_size(self)
+        end = payload_offset + payload_size
+        if len(buffer) < end:
+            buffer.extend(bytearray(end - len(buffer)))
+
+        serializer.serialize_into(self, buffer, payload_offset)
+        payload = memoryview(buffer)[payload_offset:end]
+        payload_checksum = MessageHeaderSerializer.calc_checksum(payload)
+        del payload
 
-        serializer = MESSAGE_MAPPING[self.command]()
-        bin_message = serializer.serialize(self)
-        payload_checksum = \
-            MessageHeaderSerializer.calc_checksum(bin_message)
+        message_header = MessageHeader(coin)
         message_header.checksum = payload_checksum
-        message_header.length = len(bin_message)
+        message_header.length = payload_size
         message_header.command = self.command
-
-        bin_header = message_header_serial.serialize(message_header)
-        return bin_header + bin_message
+        MESSAGE_HEADER_SERIALIZER.serialize_into(message_header,
+            buffer, offset)
+        return end
 
 class MessageHeader(object):
     """The header of all bitcoin messages."""
@@ -130,10 +413,22 @@ class MessageHeaderSerializer(Serializer):
         :param payload: The binary data payload.
         """
         sha256hash = hashlib.sha256(payload)
+        return MessageHeaderSerializer.finish_checksum(sha256hash)
+
+    @staticmethod
+    def finish_checksum(sha256hash):
+        """Calculate the checksum from a SHA256 hash object that
+        was already fed with the whole payload.
+
+        :param sha256hash: The SHA256 hash object of the payload.
+        """
         sha256hash = hashlib.sha256(sha256hash.digest())
         checksum = sha256hash.digest()[:4]
         return struct.unpack("<I", checksum)[0]
 
+#: The shared instance of the message header serializer
+MESSAGE_HEADER_SERIALIZER = MessageHeaderSerializer()
+
 class IPv4Address(object):
     """The IPv4 Address (without timestamp)."""
     def __init__(self):
@@ -242,11 +537,13 @@ class PongSerializer(Serializer):
     model_class = Pong
     nonce = fields.UInt64LEField()
 
-class Inventory(SerializableMessage):
+class Inventory(SerializableMessage, SlottedModel):
     """The Inventory representation."""
+    __slots__ = ("inv_type", "inv_hash")
+
     def __init__(self):
         self.inv_type = fields.INVENTORY_TYPE["MSG_TX"]
-        self.inv_hash = 0
+        self.inv_hash = fields.NULL_HASH
 
     def type_to_text(self):
         """Converts the inventory type to text representation."""
@@ -328,10 +625,12 @@ class NotFoundSerializer(Serializer):
     model_class = NotFound
     inventory = fields.ListField(InventorySerializer)
 
-class OutPoint(object):
+class OutPoint(SlottedModel):
     """The OutPoint representation."""
+    __slots__ = ("out_hash", "index")
+
     def __init__(self):
-        self.out_hash = 0
+        self.out_hash = fields.NULL_HASH
         self.index = 0
 
     def __repr__(self):
@@ -345,8 +644,10 @@ class OutPointSerializer(Serializer):
     out_hash = fields.Hash()
     index = fields.UInt32LEField()
 
-class TxIn(object):
+class TxIn(SlottedModel):
     """The transaction input representation."""
+    __slots__ = ("previous_output", "signature_script", "sequence")
+
     def __init__(self):
         self.previous_output = None
         self.signature_script = "Empty"
@@ -365,8 +666,10 @@ class TxInSerializer(Serializer):
     signature_script = fields.VariableStringField()
     sequence = fields.UInt32LEField()
 
-class TxOut(object):
+class TxOut(SlottedModel):
     """The transaction output."""
+    __slots__ = ("value", "pk_script")
+
     def __init__(self):
         self.value = 0
         self.pk_script = "Empty"
@@ -384,10 +687,11 @@ class TxOutSerializer(Serializer):
     value = fields.Int64LEField()
     pk_script = fields.VariableStringField()
 
-class Tx(SerializableMessage):
+class Tx(SerializableMessage, SlottedModel):
     """The main transaction representation, this object will
     contain all the inputs and outputs of the transaction."""
     command = "tx"
+    __slots__ = ("version", "tx_in", "tx_out", "lock_time")
 
     def __init__(self):
         self.version = 1
@@ -406,14 +710,19 @@ class Tx(SerializableMessage):
             text = time.ctime(self.lock_time)
         return text
 
-    def calculate_hash(self):
-        """This method will calculate the hash of the transaction."""
+    def calculate_hash_value(self):
+        """This method will calculate the hash of the transaction
+        and return it as a HashValue."""
         hash_fields = ["version", "tx_in", "tx_out", "lock_time"]
-        serializer = TxSerializer()
+        serializer = MESSAGE_SERIALIZERS["tx"]
         bin_data = serializer.serialize(self, hash_fields)
         h = hashlib.sha256(bin_data).digest()
         h = hashlib.sha256(h).digest()
-        return h[::-1].encode("hex_codec")
+        return fields.HashValue(h)
+
+    def calculate_hash(self):
+        """This method will calculate the hash of the transaction."""
+        return self.calculate_hash_value().to_hex()
 
     def __repr__(self):
         return "<%s Version=[%d] Lock Time=[%s] TxIn Count=[%d] Hash=[%s] TxOut Count=[%d]>" \
@@ -432,22 +741,27 @@ class BlockHeader(SerializableMessage):
     """The header of the block."""
     def __init__(self):
         self.version = 0
-        self.prev_block = 0
-        self.merkle_root = 0
+        self.prev_block = fields.NULL_HASH
+        self.merkle_root = fields.NULL_HASH
         self.timestamp = 0
         self.bits = 0
         self.nonce = 0
         self.txns_count = 0
 
-    def calculate_hash(self):
-        """This method will calculate the hash of the block."""
+    def calculate_hash_value(self):
+        """This method will calculate the hash of the block and
+        return it as a HashValue."""
         hash_fields = ["version", "prev_block", "merkle_root",
             "timestamp", "bits", "nonce"]
-        serializer = BlockSerializer()
+        serializer = MESSAGE_SERIALIZERS["block"]
         bin_data = serializer.serialize(self, hash_fields)
         h = hashlib.sha256(bin_data).digest()
         h = hashlib.sha256(h).digest()
-        return h[::-1].encode("hex_codec")
+        return fields.HashValue(h)
+
+    def calculate_hash(self):
+        """This method will calculate the hash of the block."""
+        return self.calculate_hash_value().to_hex()
 
     def __repr__(self):
         return "<%s Version=[%d] Timestamp=[%s] Nonce=[%d] Hash=[%s] Tx Count=[%d]>" % \
@@ -472,8 +786,8 @@ class Block(BlockHeader):
 
     def __init__(self):
         self.version = 0
-        self.prev_block = 0
-        self.merkle_root = 0
+        self.prev_block = fields.NULL_HASH
+        self.merkle_root = fields.NULL_HASH
         self.timestamp = 0
         self.bits = 0
         self.nonce = 0
@@ -501,6 +815,94 @@ class BlockSerializer(Serializer):
     nonce = fields.UInt32LEField()
     txns = fields.ListField(TxSerializer)
 
+class BlockStreamDecoder(object):
+    """An incremental decoder for the payload of the block message.
+    The payload can be fed in chunks as it arrives from the socket,
+    the block header is decoded first and then every transaction
+    is decoded as soon as all of its bytes are available, so only
+    the bytes of one transaction are kept in memory.
+
+    Example of use::
+
+        decoder = BlockStreamDecoder()
+        for chunk in chunks:
+            for item in decoder.feed(chunk):
+                print item
+    """
+    def __init__(self):
+        self.pending = ""
+        self.block_header = None
+        self.txns_left = None
+        self.header_serializer = BlockHeaderSerializer()
+        self.tx_serializer = MESSAGE_SERIALIZERS["tx"]
+
+    def done(self):
+        """Returns True when all the transactions of the block
+        were decoded."""
+        return self.txns_left == 0
+
+    def feed(self, data):
+        """Feed the decoder with more payload data.
+
+        :param data: The next chunk of the block payload.
+        :returns: A list with the objects decoded so far, the first
+                  one is the BlockHeader and the next ones are Tx.
+        """
+        if self.pending:
+            self.pending += data
+        else:
+            self.pending = data
+
+        items = []
+        offset = 0
+        if self.block_header is None:
+            if _block_header_end(self.pending, 0) is None:
+                return items
+            self.block_header, offset = \
+                self.header_serializer.deserialize_from(self.pending, 0)
+            self.txns_left = self.block_header.txns_count
+            items.append(self.block_header)
+
+        while self.txns_left:
+            if _tx_end(self.pending, offset) is None:
+                break
+            tx, offset = self.tx_serializer.deserialize_from(self.pending,
+                offset)
+            items.append(tx)
+            self.txns_left -= 1
+
+        self.pending = self.pending[offset:]
+        return items
+
+def _block_header_end(data, offset):
+    """Returns the offset where the block header (with the
+    transaction count) starting at the offset ends, or None if
+    the data is incomplete."""
+    try:
+        unused_count, offset = fields.unpack_varint_from(data, offset + 80)
+    except struct.error:
+        return None
+    return offset
+
+def _tx_end(data, offset):
+    """Returns the offset where the transaction starting at the
+    offset ends, or None if the data is incomplete."""
+    try:
+        tx_in_count, offset = fields.unpack_varint_from(data, offset + 4)
+        for i in xrange(tx_in_count):
+            script_size, offset = fields.unpack_varint_from(data, offset + 36)
+            offset += script_size + 4
+        tx_out_count, offset = fields.unpack_varint_from(data, offset)
+        for i in xrange(tx_out_count):
+            script_size, offset = fields.unpack_varint_from(data, offset + 8)
+            offset += script_size
+    except struct.error:
+        return None
+    offset += 4
+    if offset > len(data):
+        return None
+    return offset
+
 class HeaderVector(SerializableMessage):
     """The header only vector."""
     command = "headers"
@@ -546,7 +948,7 @@ class GetBlocks(SerializableMessage):
     def __init__(self, hashes):
         self.version = fields.PROTOCOL_VERSION
         self.hash_count = len(hashes)
-        self.hash_stop = 0
+        self.hash_stop = fields.NULL_HASH
         self.block_hashes = hashes
 
 class GetBlocksSerializer(Serializer):
@@ -556,6 +958,82 @@ class GetBlocksSerializer(Serializer):
     block_hashes = fields.BlockLocator()
     hash_stop = fields.Hash()
 
+class GetCFilters(SerializableMessage):
+    """The getcfilters command (BIP 157), requests the compact
+    filters of the blocks from start_height to stop_hash."""
+    command = "getcfilters"
+
+    def __init__(self):
+        self.filter_type = fields.FILTER_TYPE["BASIC"]
+        self.start_height = 0
+        self.stop_hash = fields.NULL_HASH
+
+    def __repr__(self):
+        return "<%s Type=[%d] Start Height=[%d] Stop Hash=[%064x]>" % \
+            (self.__class__.__name__, self.filter_type, self.start_height,
+                self.stop_hash)
+
+class GetCFiltersSerializer(Serializer):
+    """The serializer for the getcfilters command."""
+    model_class = GetCFilters
+    filter_type = fields.UInt8Field()
+    start_height = fields.UInt32LEField()
+    stop_hash = fields.Hash()
+
+class CFilter(SerializableMessage):
+    """The cfilter message (BIP 157), the compact filter of a block,
+    see protocoin.filters.GCSFilter to decode it."""
+    command = "cfilter"
+
+    def __init__(self):
+        self.filter_type = fields.FILTER_TYPE["BASIC"]
+        self.block_hash = fields.NULL_HASH
+        self.filter_bytes = ""
+
+    def __repr__(self):
+        return "<%s Type=[%d] Block Hash=[%064x] Size=[%d]>" % \
+            (self.__class__.__name__, self.filter_type,
+                self.block_hash, len(self.filter_bytes))
+
+class CFilterSerializer(Serializer):
+    """The serializer for the cfilter message."""
+    model_class = CFilter
+    filter_type = fields.UInt8Field()
+    block_hash = fields.Hash()
+    filter_bytes = fields.VariableStringField()
+
+class GetCFHeaders(GetCFilters):
+    """The getcfheaders command (BIP 157), requests the filter hashes
+    of the blocks from start_height to stop_hash."""
+    command = "getcfheaders"
+
+class GetCFHeadersSerializer(GetCFiltersSerializer):
+    """The serializer for the getcfheaders command."""
+    model_class = GetCFHeaders
+
+class CFHeaders(SerializableMessage):
+    """The cfheaders message (BIP 157), the answer to getcfheaders."""
+    command = "cfheaders"
+
+    def __init__(self):
+        self.filter_type = fields.FILTER_TYPE["BASIC"]
+        self.stop_hash = fields.NULL_HASH
+        self.previous_filter_header = fields.NULL_HASH
+        self.filter_hashes = []
+
+    def __repr__(self):
+        return "<%s Type=[%d] Stop Hash=[%064x] Count=[%d]>" % \
+            (self.__class__.__name__, self.filter_type,
+                self.stop_hash, len(self.filter_hashes))
+
+class CFHeadersSerializer(Serializer):
+    """The serializer for the cfheaders message."""
+    model_class = CFHeaders
+    filter_type = fields.UInt8Field()
+    stop_hash = fields.Hash()
+    previous_filter_header = fields.Hash()
+    filter_hashes = fields.HashListField()
+
 
 MESSAGE_MAPPING = {
     "version": VersionSerializer,
@@ -572,4 +1050,13 @@ MESSAGE_MAPPING = {
     "mempool": MemPoolSerializer,
     "getaddr": GetAddrSerializer,
     "getblocks": GetBlocksSerializer,
+    "getcfilters": GetCFiltersSerializer,
+    "cfilter": CFilterSerializer,
+    "getcfheaders": GetCFHeadersSerializer,
+    "cfheaders": CFHeadersSerializer,
 }
+
+#: The shared serializer instance of each message command, the
+#: serializers keep no state so they can be used by many threads
+MESSAGE_SERIALIZERS = dict((command, serializer_class())
+    for command, serializer_class in MESSAGE_MAPPING.iteritems())
@@ -0,0 +1,375 @@
+"""Transaction signing. The SignatureHasher computes the signature
+hashes of the inputs of a transaction, serializing the transaction only
+once: the legacy hashes (SIGHASH_ALL) reuse the hash midstates of the
+shared prefixes and the BIP 143 hashes (segwit inputs) reuse the
+hashPrevouts, hashSequence and hashOutputs of the transaction. The
+TransactionSigner signs the hashes with deterministic (RFC 6979) low-S
+signatures in a pool of processes.
+"""
+import struct
+import hashlib
+import multiprocessing
+
+import ecdsa
+from ecdsa.util import sigencode_der
+
+from . import fields
+from .util import hash160
+from .serializers import OutPointSerializer, TxOutSerializer
+
+SIGHASH_ALL = 0x01
+SIGHASH_NONE = 0x02
+SIGHASH_SINGLE = 0x03
+SIGHASH_ANYONECANPAY = 0x80
+
+#: The hash "signed" by SIGHASH_SINGLE inputs without a matching output
+SIGHASH_SINGLE_BUG = fields.HashValue("\x01" + "\x00" * 31)
+
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+
+#: The size of a serialized input with an empty script
+_EMPTY_INPUT_SIZE = 41
+
+def _double_sha256(data):
+    return hashlib.sha256(hashlib.sha256(data).digest()).digest()
+
+def push_data(data):
+    """Returns the script operation pushing the data to the stack.
+
+    :param data: The string to push
+    """
+    length = len(data)
+    if length < 0x4C:
+        return chr(length) + data
+    elif length <= 0xFF:
+        return "\x4c" + chr(length) + data
+    elif length <= 0xFFFF:
+        return "\x4d" + struct.pack("<H", length) + data
+    return "\x4e" + _uint32.pack(length) + data
+
+def p2pkh_script(public_key):
+    """Returns the pay-to-pubkey-hash script of a public key, the
+    script code signed by its P2PKH and P2WPKH inputs.
+
+    :param public_key: The BitcoinPublicKey, or the serialized key
+    """
+    if not isinstance(public_key, str):
+        public_key = public_key.to_string()
+    return "\x76\xa9\x14" + hash160(public_key) + "\x88\xac"
+
+class SignatureHasher(object):
+    """This class computes the signature hashes of the inputs of a
+    transaction. The transaction is serialized when the hasher is
+    created, so create a new hasher after changing the inputs or the
+    outputs (the signature scripts aren't used).
+
+    Example of use::
+
+        hasher = SignatureHasher(tx)
+        for index, tx_in in enumerate(tx.tx_in):
+            sighash = hasher.legacy_sighash(index, script_codes[index])
+
+    :param tx: The Tx
+    """
+    def __init__(self, tx):
+        outpoint_serializer = OutPointSerializer()
+        tx_out_serializer = TxOutSerializer()
+        var_int = fields.VariableIntegerField()
+
+        self.tx = tx
+        self.input_count = len(tx.tx_in)
+        self.version = _uint32.pack(tx.version)
+        self.lock_time = _uint32.pack(tx.lock_time)
+        self.outpoints = [outpoint_serializer.serialize(tx_in.previous_output)
+            for tx_in in tx.tx_in]
+        self.sequences = [_uint32.pack(tx_in.sequence) for tx_in in tx.tx_in]
+        self.outputs = [tx_out_serializer.serialize(tx_out)
+            for tx_out in tx.tx_out]
+
+        # The inputs with empty scripts, as serialized in the legacy
+        # hashes, and the outputs.
+        self.empty_inputs = "".join(outpoint + "\x00" + sequence
+            for outpoint, sequence in zip(self.outpoints, self.sequences))
+        self.all_outputs = var_int.serialize(len(self.outputs)) + \
+            "".join(self.outputs)
+
+        prefix = hashlib.sha256(self.version)
+        prefix.update(var_int.serialize(self.input_count))
+        self.prefix_midstates = [prefix]
+
+        self.hash_prevouts = _double_sha256("".join(self.outpoints))
+        self.hash_sequence = _double_sha256("".join(self.sequences))
+        self.hash_outputs = _double_sha256("".join(self.outputs))
+
+    def _prefix_midstate(self, index):
+        """Returns a copy of the hash midstate of the serialization
+        before the input, with the previous inputs empty."""
+        midstates = self.prefix_midstates
+        while len(midstates) <= index:
+            start = (len(midstates) - 1) * _EMPTY_INPUT_SIZE
+            midstate = midstates[-1].copy()
+            midstate.update(buffer(self.empty_inputs, start,
+                _EMPTY_INPUT_SIZE))
+            midstates.append(midstate)
+        return midstates[index].copy()
+
+    def legacy_sighash(self, index, script_code, hash_type=SIGHASH_ALL):
+        """Compute the legacy signature hash of an input.
+
+        :param index: The index of the input
+        :param script_code: The script of the output spent by the input
+                            (with the OP_CODESEPARATOR removed), the
+                            redeem script for P2SH outputs.
+        :param hash_type: The SIGHASH type
+        :returns: The hash, a HashValue
+        """
+        if index >= self.input_count:
+            raise IndexError("Input index out of range: %d" % index)
+        if hash_type & 0x1F not in (SIGHASH_NONE, SIGHASH_SINGLE) and \
+           not hash_type & SIGHASH_ANYONECANPAY:
+            start = (index + 1) * _EMPTY_INPUT_SIZE
+            sha256 = self._prefix_midstate(index)
+            sha256.update(self.outpoints[index])
+            sha256.update(fields.VariableStringField().serialize(script_code))
+            sha256.update(self.sequences[index])
+            sha256.update(buffer(self.empty_inputs, start))
+            sha256.update(self.all_outputs)
+            sha256.update(self.lock_time)
+            sha256.update(_uint32.pack(hash_type))
+            return fields.HashValue(hashlib.sha256(sha256.digest()).digest())
+        return self._legacy_sighash_other(index, script_code, hash_type)
+
+    def _legacy_sighash_other(self, index, script_code, hash_type):
+        """Compute the legacy signature hash of the SIGHASH_NONE,
+        SIGHASH_SINGLE and SIGHASH_ANYONECANPAY inputs."""
+        var_int = fields.VariableIntegerField()
+        base_type = hash_type & 0x1F
+        if base_type == SIGHASH_SINGLE and index >= len(self.outputs):
+            return SIGHASH_SINGLE_BUG
+
+        current_input = self.outpoints[index] + \
+            fields.VariableStringField().serialize(script_code) + \
+            self.sequences[index]
+        if hash_type & SIGHASH_ANYONECANPAY:
+            inputs = [current_input]
+        else:
+            inputs = []
+            for i in xrange(self.input_count):
+                if i == index:
+                    inputs.append(current_input)
+                elif base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+                    inputs.append(self.outpoints[i] + "\x00" +
+                        "\x00\x00\x00\x00")
+                else:
+                    inputs.append(self.outpoints[i] + "\x00" +
+                        self.sequences[i])
+
+        if base_type == SIGHASH_NONE:
+            outputs = var_int.serialize(0)
+        elif base_type == SIGHASH_SINGLE:
+            blank_output = _int64.pack(-1) + "\x00"
+            outputs = var_int.serialize(index + 1) + \
+                blank_output * index + self.outputs[index]
+        else:
+            outputs = self.all_outputs
+
+        data = self.version + var_int.serialize(len(inputs)) + \
+            "".join(inputs) + outputs + self.lock_time + \
+            _uint32.pack(hash_type)
+        return fields.HashValue(_double_sha256(data))
+
+    def segwit_sighash(self, index, script_code, amount,
+                       hash_type=SIGHASH_ALL):
+        """Compute the BIP 143 signature hash of a segwit input.
+
+        :param index: The index of the input
+        :param script_code: The script code of the input, the
+                            p2pkh_script() of the key for P2WPKH
+                            inputs or the witness script for P2WSH.
+        :param amount: The value (in satoshis) of the output spent
+        :param hash_type: The SIGHASH type
+        :returns: The hash, a HashValue
+        """
+        if index >= self.input_count:
+            raise IndexError("Input index out of range: %d" % index)
+        base_type = hash_type & 0x1F
+        null_hash = fields.NULL_HASH
+        anyone_can_pay = hash_type & SIGHASH_ANYONECANPAY
+
+        hash_prevouts = null_hash if anyone_can_pay else self.hash_prevouts
+        if anyone_can_pay or base_type in (SIGHASH_NONE, SIGHASH_SINGLE):
+            hash_sequence = null_hash
+        else:
+            hash_sequence = self.hash_sequence
+        if base_type not in (SIGHASH_NONE, SIGHASH_SINGLE):
+            hash_outputs = self.hash_outputs
+        elif base_type == SIGHASH_SINGLE and index < len(self.outputs):
+            hash_outputs = _double_sha256(self.outputs[index])
+        else:
+            hash_outputs = null_hash
+
+        data = "".join((self.version, hash_prevouts, hash_sequence,
+            self.outpoints[index],
+            fields.VariableStringField().serialize(script_code),
+            _int64.pack(amount), self.sequences[index], hash_outputs,
+            self.lock_time, _uint32.pack(hash_type)))
+        return fields.HashValue(_double_sha256(data))
+
+def _sigencode_der_low_s(r, s, order):
+    """Encode the signature in DER, with the low S value (BIP 62)."""
+    if s > order // 2:
+        s = order - s
+    return sigencode_der(r, s, order)
+
+#: The signing keys cached by a worker process of the pool, by private
+#: key string (None in the other processes, see _init_worker())
+_worker_keys = None
+
+def _init_worker():
+    """Initialize the key cache of a worker process of the pool."""
+    global _worker_keys
+    _worker_keys = {}
+
+def _signing_key(private_key, keys):
+    """Returns the ecdsa signing key of a private key string, cached in
+    the keys dict."""
+    signing_key = keys.get(private_key)
+    if signing_key is None:
+        if len(keys) >= 1024:
+            keys.clear()
+        signing_key = ecdsa.SigningKey.from_string(private_key,
+            curve=ecdsa.SECP256k1)
+        keys[private_key] = signing_key
+    return signing_key
+
+def sign_digest(private_key, digest, hash_type=SIGHASH_ALL, keys=None):
+    """Sign a signature hash, with a deterministic (RFC 6979) low-S
+    signature.
+
+    :param private_key: The BitcoinPrivateKey, or the private key string
+    :param digest: The signature hash
+    :param hash_type: The SIGHASH type appended to the signature
+    :param keys: A dict caching the signing keys of the private key
+                 strings, the key isn't cached when omitted.
+    :returns: The DER signature followed by the hash type
+    """
+    if isinstance(private_key, str):
+        signing_key = _signing_key(private_key,
+            keys if keys is not None else {})
+    else:
+        signing_key = private_key.private_key
+    signature = signing_key.sign_digest_deterministic(str(digest),
+        hashfunc=hashlib.sha256, sigencode=_sigencode_der_low_s)
+    return signature + chr(hash_type)
+
+def _sign_batch(tasks):
+    """Sign a batch of (private key string, digest, hash type), the
+    signing keys are cached for the lifetime of the worker processes
+    and for the batch only in the calling process."""
+    keys = _worker_keys if _worker_keys is not None else {}
+    return [sign_digest(private_key, digest, hash_type, keys)
+        for private_key, digest, hash_type in tasks]
+
+class TransactionSigner(object):
+    """This class signs the inputs of transactions, the signature
+    hashes are computed in the calling process (see SignatureHasher)
+    and signed in a pool of processes.
+
+    Example of use::
+
+        with TransactionSigner() as signer:
+            signer.sign_p2pkh(tx, [private_key] * len(tx.tx_in))
+        print tx.get_message().encode("hex")
+
+    :param processes: The number of worker processes, the number of
+                      CPUs when omitted, 0 to sign in the calling
+                      process.
+    :param batch_size: The number of signatures sent to a worker at
+                       once.
+    """
+    def __init__(self, processes=None, batch_size=64):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def sign_digests(self, tasks):
+        """Sign many signature hashes.
+
+        :param tasks: A list of (private key, digest, hash type), the
+                      keys being BitcoinPrivateKey or key strings.
+        :returns: The list of signatures, in the order of the tasks
+        """
+        tasks = [(private_key if isinstance(private_key, str)
+                else private_key.to_string(), str(digest), hash_type)
+            for private_key, digest, hash_type in tasks]
+        if self.processes == 0 or len(tasks) <= self.batch_size:
+            return _sign_batch(tasks)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes,
+                _init_worker)
+        size = self.batch_size
+        batches = [tasks[i:i + size] for i in xrange(0, len(tasks), size)]
+        signatures = []
+        for batch in self.pool.imap(_sign_batch, batches):
+            signatures.extend(batch)
+        return signatures
+
+    def sign(self, tx, inputs):
+        """Compute the signature hashes of inputs of a transaction and
+        sign them, the signature scripts (or witnesses) are left to the
+        caller.
+
+        :param tx: The Tx
+        :param inputs: A list of (index, private key, script code,
+                       amount, hash type), the amount being None for
+                       the legacy inputs and the value of the output
+                       spent for the segwit inputs.
+        :returns: The list of signatures, in the order of the inputs
+        """
+        hasher = SignatureHasher(tx)
+        tasks = []
+        for index, private_key, script_code, amount, hash_type in inputs:
+            if amount is None:
+                digest = hasher.legacy_sighash(index, script_code, hash_type)
+            else:
+                digest = hasher.segwit_sighash(index, script_code, amount,
+                    hash_type)
+            tasks.append((private_key, digest, hash_type))
+        return self.sign_digests(tasks)
+
+    def sign_p2pkh(self, tx, private_keys, hash_type=SIGHASH_ALL):
+        """Sign all the inputs of a transaction spending P2PKH outputs
+        (of the uncompressed public keys) and set their signature
+        scripts.
+
+        :param tx: The Tx
+        :param private_keys: The BitcoinPrivateKey of each input
+        :param hash_type: The SIGHASH type
+        """
+        public_keys = {}
+        inputs = []
+        for index, private_key in enumerate(private_keys):
+            public_key = public_keys.get(id(private_key))
+            if public_key is None:
+                public_key = private_key.generate_public_key().to_string()
+                public_keys[id(private_key)] = public_key
+            inputs.append((index, private_key, p2pkh_script(public_key),
+                None, hash_type))
+        signatures = self.sign(tx, inputs)
+        for index, private_key in enumerate(private_keys):
+            tx.tx_in[index].signature_script = push_data(signatures[index]) + \
+                push_data(public_keys[id(private_key)])
+
+    def close(self):
+        """Stop the worker processes."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,168 @@
+import time
+
+class Timer(object):
+    """A timer scheduled in a TimerWheel, use the cancel() method
+    to cancel it."""
+    __slots__ = ("wheel", "deadline_tick", "interval", "callback", "args",
+        "active")
+
+    def __init__(self, wheel, callback, args, interval):
+        self.wheel = wheel
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.deadline_tick = 0
+        self.active = False
+
+    def cancel(self):
+        """Cancel the timer, a cancelled timer is never called."""
+        self.wheel.cancel(self)
+
+    def __repr__(self):
+        return "<%s Callback=[%r] Active=[%s]>" % \
+            (self.__class__.__name__, self.callback, self.active)
+
+class TimerWheel(object):
+    """A hashed timer wheel. The time is divided in ticks and each
+    timer is placed in the slot of the tick of its deadline, so the
+    timers can be scheduled and cancelled in O(1), and advancing the
+    wheel only looks at the slots of the elapsed ticks. It is suited
+    for many timers (keepalives, timeouts) that are mostly cancelled
+    or rescheduled before firing.
+
+    The wheel is not thread-safe, it must be used by the thread that
+    calls advance(), usually inside the client loop::
+
+        wheel = TimerWheel()
+        timer = wheel.schedule(60.0, handshake_timeout)
+        wheel.schedule_periodic(120.0, send_ping)
+        while True:
+            select.select(rlist, wlist, [], wheel.timeout())
+            wheel.advance()
+
+    :param tick: The duration of a tick, in seconds; the timers
+                 fire at most one tick after their deadline.
+    :param slots: The number of slots of the wheel.
+    """
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [set() for i in xrange(slots)]
+        self.start = time.time()
+        self.current_tick = 0
+        self.count = 0
+        # A tick not after the earliest deadline (or the end of the
+        # turn of the wheel), None when it must be searched again
+        self.wake_tick = None
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Schedule a callback to be called once after a delay.
+
+        :param delay: The delay, in seconds
+        :param callback: The callable to call
+        :param args: The arguments of the callable
+        :returns: The Timer scheduled
+        """
+        timer = Timer(self, callback, args, None)
+        self.add(timer, delay)
+        return timer
+
+    def schedule_periodic(self, interval, callback, *args):
+        """Schedule a callback to be called at each interval, until
+        the timer is cancelled.
+
+        :param interval: The interval, in seconds
+        :param callback: The callable to call
+        :param args: The arguments of the callable
+        :returns: The Timer scheduled
+        """
+        timer = Timer(self, callback, args, interval)
+        self.add(timer, interval)
+        return timer
+
+    def reschedule(self, timer, delay):
+        """Move a timer (active or not) to a new deadline.
+
+        :param timer: The Timer to move
+        :param delay: The new delay, in seconds, from now
+        """
+        self.cancel(timer)
+        self.add(timer, delay)
+
+    def add(self, timer, delay):
+        """Place the timer in the slot of its deadline tick."""
+        elapsed = time.time() - self.start
+        deadline_tick = int((elapsed + delay) / self.tick) + 1
+        timer.deadline_tick = max(deadline_tick, self.current_tick + 1)
+        timer.active = True
+        self.slots[timer.deadline_tick % len(self.slots)].add(timer)
+        self.count += 1
+        if self.wake_tick is not None and \
+                timer.deadline_tick < self.wake_tick:
+            self.wake_tick = timer.deadline_tick
+
+    def cancel(self, timer):
+        """Cancel a timer, cancelling an inactive timer does nothing.
+
+        :param timer: The Timer to cancel
+        """
+        if not timer.active:
+            return
+        timer.active = False
+        self.slots[timer.deadline_tick % len(self.slots)].discard(timer)
+        self.count -= 1
+
+    def timeout(self):
+        """Returns the time (in seconds) until the first occupied slot,
+        at most one turn of the wheel, or None when there are no timers,
+        to be used as the select() timeout. The tick found is kept until
+        the wheel advances past it, the cancelled timers can only make
+        the loop wake up early."""
+        if not self.count:
+            return None
+        if self.wake_tick is None:
+            slots = self.slots
+            slot_count = len(slots)
+            first_tick = self.current_tick + 1
+            self.wake_tick = first_tick + slot_count - 1
+            for tick in xrange(first_tick, first_tick + slot_count):
+                if slots[tick % slot_count]:
+                    self.wake_tick = tick
+                    break
+        deadline = self.start + self.wake_tick * self.tick
+        return max(0.0, deadline - time.time())
+
+    def advance(self):
+        """Call the callbacks of the timers whose deadline has passed.
+
+        :returns: The number of callbacks called
+        """
+        target_tick = int((time.time() - self.start) / self.tick)
+        if target_tick <= self.current_tick:
+            return 0
+
+        fired = 0
+        slot_count = len(self.slots)
+        # After a whole turn every slot was already visited
+        first_tick = max(self.current_tick + 1, target_tick - slot_count + 1)
+        self.current_tick = target_tick
+        if self.wake_tick is not None and self.wake_tick <= target_tick:
+            self.wake_tick = None
+        for tick in xrange(first_tick, target_tick + 1):
+            slot = self.slots[tick % slot_count]
+            if not slot:
+                continue
+            expired = [timer for timer in slot
+                if timer.deadline_tick <= target_tick]
+            for timer in expired:
+                # A callback may have cancelled this timer
+                if not timer.active:
+                    continue
+                self.cancel(timer)
+                if timer.interval is not None:
+                    self.add(timer, timer.interval)
+                timer.callback(*timer.args)
+                fired += 1
+        return fired
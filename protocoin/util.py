@@ -1,6 +1,8 @@
 # The Base58 digits
 base58_digits = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 
+import hashlib
+
 from . import fields
 
 def base58_encode(address_bignum):
@@ -31,6 +33,41 @@ def base58_decode(address):
         address_bignum += digit
     return address_bignum
 
+def base58check_encode(data):
+    """This function appends the checksum (the first 4 bytes of the
+    double SHA-256) to the data and converts it to base58, with a
+    '1' for each leading zero byte.
+
+    :param data: The string to encode
+    :returns: The string in base58
+    """
+    checksum = hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    data += checksum
+    leading_zeros = len(data) - len(data.lstrip("\x00"))
+    return "1" * leading_zeros + base58_encode(int(data.encode("hex"), 16))
+
+def base58check_decode(address):
+    """This function converts a base58 string with checksum (see
+    base58check_encode()) to the data encoded.
+
+    :param address: The base58 string
+    :returns: The data, without the checksum
+    """
+    leading_zeros = len(address) - len(address.lstrip("1"))
+    value = base58_decode(address)
+    data = "%x" % value if value else ""
+    data = "\x00" * leading_zeros + ("0" * (len(data) % 2) + data).decode("hex")
+    data, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4] != checksum:
+        raise RuntimeError("Invalid checksum for the address.")
+    return data
+
+def hash160(data):
+    """Returns the RIPEMD-160 of the SHA-256 of the data."""
+    ripemd160 = hashlib.new("ripemd160")
+    ripemd160.update(hashlib.sha256(data).digest())
+    return ripemd160.digest()
+
 def services_to_text(services):
     """Converts the services field into a textual
     representation."""
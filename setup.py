@@ -1,7 +1,8 @@
 from setuptools import setup
 import protocoin
 
-install_requirements = ['ecdsa>=0.10']
+install_requirements = ['ecdsa>=0.11']
+extras_requirements = {'columnar': ['numpy']}
 
 setup(
     name='protocoin',
@@ -13,6 +14,7 @@ setup(
     description='A pure Python bitcoin protocol implementation.',
     long_description='A pure Python bitcoin protocol implementation.',
     install_requires=install_requirements,
+    extras_require=extras_requirements,
     packages=['protocoin'],
     keywords='bitcoin, protocol',
     platforms='Any',